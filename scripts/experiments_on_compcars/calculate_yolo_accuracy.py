@@ -1,11 +1,11 @@
 import json
 import os
-from statistics import mean
 
+import numpy as np
 from tqdm import tqdm
 
 from wsl_survey.segmentation.irn.voc12 import dataloader
-from wsl_survey.utils.iou import bb_intersection_over_union
+from wsl_survey.utils.iou import box_iou
 
 yolo_result_path = '/Users/cenk.bircanoglu/wsl/wsl_survey/compcars_outputs/compcars/yolo/bbox'
 category_list = set()
@@ -38,32 +38,43 @@ with open('compcars_outputs/compcars/yolo/te_results.txt', mode='r') as f:
                 f.write('%s\t%s\t%s\t%s\n' % (x1, y1, w1, h1))
 
 
+def _read_bbox(path, sep, line_index):
+    try:
+        with open(path, mode='r') as f:
+            line = f.readlines()[line_index]
+        return [float(v) for v in line.strip().split(sep)]
+    except Exception as e:
+        print(e)
+        return [np.nan] * 4
+
+
 def run():
     voc12_root = './data/compcars/'
     bbox_out_dir = yolo_result_path
-    dataset = dataloader.VOC12ImageDataset('./data/compcars/train/test.txt',
-                                           voc12_root=voc12_root,
-                                           img_normal=None,
-                                           to_torch=False)
+    img_names = [
+        dataloader.decode_int_filename(name) for name in
+        dataloader.load_img_name_list('./data/compcars/train/test.txt')
+    ]
+
+    # (N, 4) ground truth xyxy and predicted xywh boxes of the whole split
+    gt = np.array([
+        _read_bbox(
+            os.path.join(voc12_root,
+                         img_name.replace('image', 'label') + '.txt'), ' ', -1)
+        for img_name in tqdm(img_names)
+    ])
+    pred = np.array([
+        _read_bbox(
+            os.path.join(bbox_out_dir,
+                         img_name + '.txt').replace('data/image/', ''), '\t', 0)
+        for img_name in tqdm(img_names)
+    ])
 
-    preds = []
-    error_cnt = 0
-    for data in tqdm(dataset):
-        img_name = data['name']
-        bbox_org_path = os.path.join(voc12_root, img_name.replace('image', 'label') + '.txt')
-        try:
-            with open(bbox_org_path, mode='r') as f:
-                bbox_org = f.readlines()[-1].strip().split(' ')
-            bbox_path = os.path.join(bbox_out_dir, img_name + '.txt').replace('data/image/', '')
-            with open(bbox_path, mode='r') as f:
-                bbox = f.readlines()[0].strip().split('\t')
-            iou = bb_intersection_over_union(bbox, bbox_org)
-            preds.append(iou)
-        except Exception as e:
-            print(e)
-            error_cnt += 1
+    valid = ~(np.isnan(gt).any(axis=1) | np.isnan(pred).any(axis=1))
+    preds = box_iou(np.trunc(pred[valid]), np.trunc(gt[valid]), fmt_a='xywh')
+    error_cnt = len(img_names) - len(preds)
 
-    print({'miou': mean(preds)}, len(preds), error_cnt, bbox_out_dir)
+    print({'miou': np.mean(preds)}, len(preds), error_cnt, bbox_out_dir)
 
 
 if __name__ == '__main__':
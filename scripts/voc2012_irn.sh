@@ -9,7 +9,7 @@ export OUTPUT_FOLDER=./outputs/voc12/results/$MODEL/
 python3 wsl_survey/segmentation/irn_unique/main.py \
     --voc12_root=$ROOT_FOLDER \
     --chainer_eval_set=train \
-    --class_label_dict_path=./data/voc12/cls_labels_unique.npy \
+    --class_label_dict_path=./data/voc12/cls_labels_unique \
     --train_list=./data/voc12/train_aug.txt \
     --val_list=./data/voc12/train.txt \
     --infer_list=./data/voc12/train.txt \
@@ -40,7 +40,7 @@ python3 wsl_survey/segmentation/irn_unique/main.py \
 python3 wsl_survey/segmentation/irn_unique/main.py \
     --voc12_root=$ROOT_FOLDER \
     --chainer_eval_set=val \
-    --class_label_dict_path=./data/voc12/cls_labels_unique.npy \
+    --class_label_dict_path=./data/voc12/cls_labels_unique \
     --train_list=./data/voc12/val.txt \
     --val_list=./data/voc12/val.txt \
     --infer_list=./data/voc12/val.txt \
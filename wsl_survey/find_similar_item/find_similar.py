@@ -38,7 +38,7 @@ for pack in train_data_loader:
 dataset = dataloader.VOC12ClassificationDatasetMSF(
     "data/voc12/train_aug.txt",
     voc12_root='./datasets/voc2012/VOCdevkit/VOC2012/',
-    class_label_dict_path='./data/voc12/cls_labels_unique.npy')
+    class_label_dict_path='./data/voc12/cls_labels_unique')
 
 data_loader = DataLoader(dataset,
                          batch_size=1,
@@ -0,0 +1,149 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from wsl_survey.segmentation.irn.misc import camstore
+from wsl_survey.segmentation.irn.step.eval_cam import cam_to_label
+
+
+def dir_size(root):
+    size = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def load_gt(voc12_root, chainer_eval_set):
+    from chainercv.datasets import VOCSemanticSegmentationDataset
+
+    dataset = VOCSemanticSegmentationDataset(split=chainer_eval_set,
+                                             data_dir=voc12_root)
+    return dataset.ids, dataset
+
+
+def miou_of(confusion):
+    gtj = confusion.sum(axis=1)
+    resj = confusion.sum(axis=0)
+    gtjresj = np.diag(confusion)
+    denominator = gtj + resj - gtjresj
+    return np.nanmean(gtjresj / denominator)
+
+
+def bench_precision(reader, names, precision, out_root, args, gt=None,
+                    ref_labels=None):
+    out_dir = os.path.join(out_root, precision)
+
+    t = time.time()
+    with camstore.open_cam_writer(out_dir, args.cam_format,
+                                  precision=precision) as writer:
+        for name in names:
+            writer.write(name, **reader[name])
+    write_time = time.time() - t
+
+    store = camstore.open_cam_reader(out_dir)
+
+    t = time.time()
+    cam_dicts = [store[name] for name in names]
+    for cam_dict in cam_dicts:
+        # touch every byte so memory-mapped reads are not measured lazily
+        np.add.reduce(cam_dict['high_res'], axis=None)
+    read_time = time.time() - t
+
+    labels = [
+        cam_to_label(cam_dict, args.cam_eval_thres) for cam_dict in cam_dicts
+    ]
+
+    stats = {
+        'precision': precision,
+        'bytes_per_image': dir_size(out_dir) / len(names),
+        'write_img_per_sec': len(names) / max(write_time, 1e-12),
+        'read_img_per_sec': len(names) / max(read_time, 1e-12),
+    }
+
+    if ref_labels is not None:
+        agree = sum(np.sum(a == b) for a, b in zip(labels, ref_labels))
+        total = sum(a.size for a in labels)
+        stats['label_agreement'] = agree / total
+
+    if gt is not None:
+        from chainercv.evaluations import calc_semantic_segmentation_confusion
+
+        gt_labels = [
+            gt.get_example_by_keys(i, (1, ))[0] for i in range(len(names))
+        ]
+        confusion = calc_semantic_segmentation_confusion(labels, gt_labels)
+        stats['miou'] = miou_of(confusion)
+
+    return stats, labels
+
+
+def run(args):
+    reader = camstore.open_cam_reader(args.cam_out_dir)
+
+    gt = None
+    if args.voc12_root is not None:
+        names, gt = load_gt(args.voc12_root, args.chainer_eval_set)
+    else:
+        names = reader.keys()
+    names = list(names)[:args.num_images]
+
+    out_root = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        results = []
+        ref_labels = None
+        for precision in args.precisions:
+            stats, labels = bench_precision(reader, names, precision, out_root,
+                                            args, gt, ref_labels)
+            if ref_labels is None:
+                ref_labels = labels
+            results.append(stats)
+    finally:
+        shutil.rmtree(out_root)
+
+    base = results[0]
+    print('%d images, format: %s, reference: %s' %
+          (len(names), args.cam_format, base['precision']))
+    for stats in results:
+        line = '%-6s %10.0f bytes/img (x%.2f)  write %7.1f img/s  ' \
+               'read %7.1f img/s' % (
+                   stats['precision'], stats['bytes_per_image'],
+                   base['bytes_per_image'] / stats['bytes_per_image'],
+                   stats['write_img_per_sec'], stats['read_img_per_sec'])
+        if 'label_agreement' in stats:
+            line += '  label agreement %.5f' % stats['label_agreement']
+        if 'miou' in stats:
+            line += '  mIoU %.4f (%+.4f)' % (stats['miou'],
+                                             stats['miou'] - base['miou'])
+        print(line)
+
+    return results
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Compares storage size, throughput and accuracy of the '
+        'cam precisions on existing cams.')
+    parser.add_argument("--cam_out_dir", required=True, type=str)
+    parser.add_argument("--cam_format",
+                        default="store",
+                        type=str,
+                        choices=["npy", "store"])
+    parser.add_argument("--precisions",
+                        default=list(camstore.PRECISIONS),
+                        nargs='+',
+                        choices=camstore.PRECISIONS)
+    parser.add_argument("--cam_eval_thres", default=0.15, type=float)
+    parser.add_argument("--num_images", default=200, type=int)
+    parser.add_argument("--voc12_root", default=None, type=str)
+    parser.add_argument("--chainer_eval_set", default="train", type=str)
+    parser.add_argument("--tmp_dir", default=None, type=str)
+    return parser
+
+
+if __name__ == '__main__':
+    run(make_parser().parse_args())
@@ -0,0 +1,115 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+from wsl_survey.segmentation.irn.misc import imgcache
+from wsl_survey.segmentation.irn.voc12 import dataloader
+
+
+def dir_size(root):
+    size = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def bench_reads(names, voc12_root, img_cache):
+    t = time.time()
+    for name in names:
+        img = dataloader.load_img(name, voc12_root, img_cache, exact=False)
+        # touch every byte so memory-mapped reads are not measured lazily
+        np.add.reduce(img, axis=None)
+    return len(names) / max(time.time() - t, 1e-12)
+
+
+def bench_loader(names, args, img_cache):
+    # the training transform of train_cam
+    dataset = dataloader.VOC12ImageDataset(names,
+                                           voc12_root=args.voc12_root,
+                                           resize_long=(320, 640),
+                                           hor_flip=True,
+                                           crop_size=512,
+                                           crop_method="random",
+                                           img_cache=img_cache)
+    data_loader = DataLoader(dataset,
+                             batch_size=args.batch_size,
+                             shuffle=False,
+                             num_workers=args.num_workers)
+
+    t = time.time()
+    n = 0
+    for pack in data_loader:
+        n += len(pack['img'])
+    return n / max(time.time() - t, 1e-12)
+
+
+def run(args):
+    names = [
+        dataloader.decode_int_filename(name)
+        for name in dataloader.load_img_name_list(args.img_list)
+    ][:args.num_images]
+
+    cache_dir = args.cache_dir
+    if cache_dir is None:
+        cache_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        t = time.time()
+        imgcache.build_image_cache(names, args.voc12_root, cache_dir,
+                                   args.max_long, args.num_workers)
+        build_time = time.time() - t
+        cache = imgcache.ImageCache(cache_dir)
+
+        results = []
+        for source, img_cache in (('jpeg', None), ('cache', cache)):
+            results.append({
+                'source': source,
+                'read_img_per_sec': bench_reads(names, args.voc12_root,
+                                                img_cache),
+                'loader_img_per_sec': bench_loader(names, args, img_cache)
+            })
+        bytes_per_image = dir_size(cache_dir) / len(names)
+    finally:
+        if args.cache_dir is None:
+            shutil.rmtree(cache_dir)
+
+    print('%d images, cache %.0f bytes/img (max long %s), built in %.1fs' %
+          (len(names), bytes_per_image, args.max_long, build_time))
+    base = results[0]
+    for stats in results:
+        print('%-5s read %7.1f img/s (x%.2f)  loader %7.1f img/s (x%.2f)' %
+              (stats['source'], stats['read_img_per_sec'],
+               stats['read_img_per_sec'] / base['read_img_per_sec'],
+               stats['loader_img_per_sec'],
+               stats['loader_img_per_sec'] / base['loader_img_per_sec']))
+
+    return results
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Compares decoding the jpegs against reading the image '
+        'cache, raw and through the train_cam data loader.')
+    parser.add_argument("--voc12_root", required=True, type=str)
+    parser.add_argument("--img_list", required=True, type=str)
+    parser.add_argument("--num_images", default=500, type=int)
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        type=str,
+        help="An image cache to use (missing images are added), a temporary "
+        "one by default.")
+    parser.add_argument("--max_long", default=None, type=int)
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--num_workers", default=4, type=int)
+    parser.add_argument("--tmp_dir", default=None, type=str)
+    return parser
+
+
+if __name__ == '__main__':
+    run(make_parser().parse_args())
@@ -0,0 +1,111 @@
+import argparse
+import random
+import timeit
+
+import numpy as np
+from PIL import Image
+
+from wsl_survey.segmentation.irn.misc import imutils
+
+
+# the implementations the current imutils ones replace
+def legacy_pil_resize(img, size, order):
+    if size[0] == img.shape[0] and size[1] == img.shape[1]:
+        return img
+
+    if order == 3:
+        resample = Image.BICUBIC
+    elif order == 0:
+        resample = Image.NEAREST
+
+    return np.asarray(Image.fromarray(img).resize(size[::-1], resample))
+
+
+def legacy_crop(img, cropsize, default_value, box):
+    if len(img.shape) == 3:
+        cont = np.ones((cropsize, cropsize, img.shape[2]),
+                       img.dtype) * default_value
+    else:
+        cont = np.ones((cropsize, cropsize), img.dtype) * default_value
+    cont[box[0]:box[1], box[2]:box[3]] = img[box[4]:box[5], box[6]:box[7]]
+    return cont
+
+
+def _cases(args):
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 256, (args.height, args.width, 3)).astype(np.uint8)
+    normalized = rng.randn(args.height, args.width, 3).astype(np.float32)
+    label = rng.randint(0, 21, (args.height, args.width)).astype(np.uint8)
+    box = imutils.get_random_crop_box(img.shape[:2], args.crop_size)
+    small_box = imutils.get_random_crop_box(img.shape[:2],
+                                            max(img.shape[:2]) + 64)
+    label_size = (int(np.round(args.height * 0.25)),
+                  int(np.round(args.width * 0.25)))
+    crop_out = np.empty((args.crop_size, args.crop_size, 3), np.float32)
+
+    # name: (legacy, current)
+    return {
+        'crop float': (lambda: legacy_crop(normalized, args.crop_size, 0, box),
+                       lambda: imutils.crop_into(normalized, args.crop_size, 0,
+                                                 box)),
+        'crop float, out': (lambda: legacy_crop(normalized, args.crop_size, 0,
+                                                box),
+                            lambda: imutils.crop_into(
+                                normalized, args.crop_size, 0, box, crop_out)),
+        'crop padded label': (lambda: legacy_crop(
+            label,
+            max(img.shape[:2]) + 64, 255, small_box),
+                              lambda: imutils.crop_into(
+                                  label,
+                                  max(img.shape[:2]) + 64, 255, small_box)),
+        'resize label nearest': (lambda: legacy_pil_resize(
+            label, label_size, 0), lambda: imutils.pil_resize(
+                label, label_size, 0)),
+        'resize float nearest': (lambda: legacy_pil_resize(
+            normalized[..., 0], label_size, 0), lambda: imutils.pil_resize(
+                normalized[..., 0], label_size, 0)),
+        'resize img nearest': (lambda: legacy_pil_resize(img, label_size, 0),
+                               lambda: imutils.pil_resize(img, label_size, 0)),
+        'resize img bicubic': (lambda: legacy_pil_resize(img, label_size, 3),
+                               lambda: imutils.pil_resize(img, label_size, 3)),
+    }
+
+
+def run(args):
+    random.seed(0)
+    results = []
+    for name, (legacy, current) in _cases(args).items():
+        # the outputs have to agree exactly
+        assert np.array_equal(legacy(), current()), name
+
+        legacy_time = min(
+            timeit.repeat(legacy, number=args.number,
+                          repeat=args.repeat)) / args.number
+        current_time = min(
+            timeit.repeat(current, number=args.number,
+                          repeat=args.repeat)) / args.number
+        results.append((name, legacy_time, current_time))
+
+    print('%dx%d image, crop %d' % (args.height, args.width, args.crop_size))
+    for name, legacy_time, current_time in results:
+        print('%-22s legacy %8.3f ms  current %8.3f ms  (x%.2f)' %
+              (name, legacy_time * 1e3, current_time * 1e3,
+               legacy_time / current_time))
+
+    return results
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Times the crop and resize helpers of imutils against '
+        'the implementations they replace.')
+    parser.add_argument("--height", default=375, type=int)
+    parser.add_argument("--width", default=500, type=int)
+    parser.add_argument("--crop_size", default=512, type=int)
+    parser.add_argument("--number", default=50, type=int)
+    parser.add_argument("--repeat", default=5, type=int)
+    return parser
+
+
+if __name__ == '__main__':
+    run(make_parser().parse_args())
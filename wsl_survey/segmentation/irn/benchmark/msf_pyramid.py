@@ -0,0 +1,140 @@
+import argparse
+import importlib
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from wsl_survey.segmentation.irn.benchmark.cam_precision import load_gt
+from wsl_survey.segmentation.irn.misc import evaluation
+from wsl_survey.segmentation.irn.step import make_cam
+from wsl_survey.segmentation.irn.step.eval_cam import cam_to_label
+from wsl_survey.segmentation.irn.voc12 import dataloader
+
+
+def _nbytes(imgs):
+    if not isinstance(imgs, list):
+        imgs = [imgs]
+    return sum(img.numel() * img.element_size() for img in imgs)
+
+
+def bench_pyramid(model, names, device_pyramid, args, device):
+    """Cams and labels of names with the scales built by pil in the workers
+    or on the device."""
+    args.cam_device_pyramid = device_pyramid
+    dataset = dataloader.VOC12ClassificationDatasetMSF(
+        names,
+        voc12_root=args.voc12_root,
+        scales=args.cam_scales,
+        class_label_dict_path=args.class_label_dict_path,
+        device_pyramid=device_pyramid)
+    data_loader = DataLoader(dataset,
+                             shuffle=False,
+                             num_workers=args.num_workers,
+                             pin_memory=False)
+
+    cams, labels = [], []
+    n_bytes = 0
+    t = time.time()
+    with torch.no_grad():
+        for pack in data_loader:
+            n_bytes += _nbytes(pack['img'])
+            imgs = make_cam.msf_imgs(pack, args, device)
+            if not isinstance(imgs, list):
+                imgs = [imgs]
+            size = (int(pack['size'][0][0]), int(pack['size'][1][0]))
+
+            valid_cat, _, highres_cam = next(
+                make_cam.make_cams(model, imgs, size, pack['label'], device))
+            cam_dict = {
+                'keys': valid_cat.numpy(),
+                'high_res': highres_cam.cpu().numpy()
+            }
+            cams.append(cam_dict['high_res'])
+            labels.append(cam_to_label(cam_dict, args.cam_eval_thres))
+    elapsed = time.time() - t
+
+    return {
+        'pyramid': 'device' if device_pyramid else 'pil',
+        'img_per_sec': len(names) / max(elapsed, 1e-12),
+        'mb_per_image': n_bytes / len(names) / 2**20
+    }, cams, labels
+
+
+def run(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    model = getattr(importlib.import_module(args.cam_network_module),
+                    args.cam_network + 'CAM')(num_classes=args.num_classes)
+    model.load_state_dict(torch.load(args.cam_weights_name + '.pth',
+                                     map_location='cpu'),
+                          strict=True)
+    model.eval()
+    model.to(device)
+
+    names, gt = load_gt(args.voc12_root, args.chainer_eval_set)
+    names = list(names)[:args.num_images]
+    gt_labels = [gt.get_example_by_keys(i, (1, ))[0] for i in range(len(names))]
+
+    results = []
+    ref_cams, ref_labels = None, None
+    for device_pyramid in (False, True):
+        stats, cams, labels = bench_pyramid(model, names, device_pyramid,
+                                            args, device)
+
+        confusion = sum(
+            evaluation.confusion_matrix(label, gt_label, 21)
+            for label, gt_label in zip(labels, gt_labels))
+        stats['miou'] = np.nanmean(evaluation.iou_from_confusion(confusion))
+
+        if ref_labels is None:
+            ref_cams, ref_labels = cams, labels
+        stats['label_agreement'] = sum(
+            np.sum(a == b) for a, b in zip(labels, ref_labels)) / sum(
+                a.size for a in labels)
+        stats['max_cam_diff'] = max(
+            float(np.abs(a - b).max()) if a.size > 0 else 0.
+            for a, b in zip(cams, ref_cams))
+        results.append(stats)
+
+    base = results[0]
+    print('%d images, scales %s, %s' %
+          (len(names), tuple(args.cam_scales), device))
+    for stats in results:
+        print('%-6s %7.2f img/s (x%.2f)  %6.2f MB/img loaded  mIoU %.4f '
+              '(%+.4f)  label agreement %.5f  max cam diff %.4f' %
+              (stats['pyramid'], stats['img_per_sec'],
+               stats['img_per_sec'] / base['img_per_sec'],
+               stats['mb_per_image'], stats['miou'],
+               stats['miou'] - base['miou'], stats['label_agreement'],
+               stats['max_cam_diff']))
+
+    return results
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Checks the cams of the device pyramid of make_cam '
+        'against the pil one for mIoU parity and compares their speed.')
+    parser.add_argument("--voc12_root", required=True, type=str)
+    parser.add_argument("--chainer_eval_set", default="train", type=str)
+    parser.add_argument("--class_label_dict_path", required=True, type=str)
+    parser.add_argument("--cam_weights_name", required=True, type=str)
+    parser.add_argument("--cam_network", default="ResNet50", type=str)
+    parser.add_argument("--cam_network_module",
+                        default="wsl_survey.segmentation.irn.net.resnet_cam",
+                        type=str)
+    parser.add_argument("--num_classes", default=20, type=int)
+    parser.add_argument("--cam_scales",
+                        default=(1.0, 0.5, 1.5, 2.0),
+                        nargs='+',
+                        type=float)
+    parser.add_argument("--cam_eval_thres", default=0.15, type=float)
+    parser.add_argument("--num_images", default=100, type=int)
+    parser.add_argument("--num_workers", default=4, type=int)
+    return parser
+
+
+if __name__ == '__main__':
+    run(make_parser().parse_args())
@@ -0,0 +1,129 @@
+import argparse
+import importlib
+import itertools
+import multiprocessing
+import resource
+import time
+
+import torch
+import torch.nn.functional as F
+
+from wsl_survey.segmentation.irn.misc import torchutils, indexing
+
+
+def _make_model(args):
+    module = importlib.import_module(args.network_module)
+    if args.model == 'cam':
+        return getattr(module, args.network)(num_classes=args.num_classes)
+
+    path_index = indexing.PathIndex(radius=10,
+                                    default_size=(args.crop_size // 4,
+                                                  args.crop_size // 4))
+    return getattr(module, args.network + 'AffinityDisplacementLoss')(
+        path_index)
+
+
+def _loss(model, img, args):
+    if args.model == 'cam':
+        label = torch.zeros(img.size(0), args.num_classes)
+        label[:, 0] = 1
+        return F.multilabel_soft_margin_loss(model(img).float(), label)
+
+    losses = [loss.float().mean() for loss in model(img, True)]
+    return sum(losses) / len(losses)
+
+
+def bench(args, amp, channels_last):
+    """Images/sec and peak resident memory of training steps on random
+    images, run in a fresh process so the peak is its own."""
+    torch.manual_seed(0)
+    torch.set_num_threads(args.num_threads)
+
+    model = _make_model(args)
+    precision = torchutils.MixedPrecision(amp, 'cpu')
+    if channels_last:
+        model = torchutils.to_channels_last(model)
+    model.train()
+
+    param_groups = model.trainable_parameters()
+    optimizer = torchutils.PolyOptimizer([{
+        'params': param_groups[0]
+    }, {
+        'params': param_groups[1]
+    }],
+                                         lr=0.01,
+                                         weight_decay=1e-4,
+                                         max_step=args.warmup + args.steps)
+
+    img = torch.randn(args.batch_size, 3, args.crop_size, args.crop_size)
+    if channels_last:
+        img = torchutils.to_channels_last(img)
+
+    for step in range(args.warmup + args.steps):
+        if step == args.warmup:
+            start = time.time()
+        with precision.autocast():
+            loss = _loss(model, img, args)
+        optimizer.backward_step(loss, precision)
+    elapsed = time.time() - start
+
+    return {
+        'amp': str(precision),
+        'channels_last': channels_last and
+        torchutils.channels_last_available(),
+        'img_per_sec': args.steps * args.batch_size / elapsed,
+        # kilobytes on linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+        1024
+    }
+
+
+def run(args):
+    if args.network_module is None:
+        args.network_module = 'wsl_survey.segmentation.irn.net.resnet_' + \
+            args.model
+
+    ctx = multiprocessing.get_context('spawn')
+
+    results = []
+    for amp, channels_last in itertools.product([False, True], repeat=2):
+        with ctx.Pool(1) as pool:
+            results.append(pool.apply(bench, (args, amp, channels_last)))
+
+    print('%s %s, batch %d, crop %d, %d threads' %
+          (args.model, args.network, args.batch_size, args.crop_size,
+           args.num_threads))
+    base = results[0]
+    for stats in results:
+        print('amp %-8s channels_last %-5s %7.2f img/s (x%.2f)  '
+              'peak %7.0f MB' %
+              (stats['amp'], stats['channels_last'], stats['img_per_sec'],
+               stats['img_per_sec'] / base['img_per_sec'],
+               stats['peak_rss_mb']))
+
+    return results
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Compares cpu training throughput and peak memory of the '
+        'cam or irn networks with and without amp and channels last.')
+    parser.add_argument("--model",
+                        default="cam",
+                        type=str,
+                        choices=["cam", "irn"])
+    parser.add_argument("--network", default="ResNet50", type=str)
+    parser.add_argument("--network_module", default=None, type=str)
+    parser.add_argument("--num_classes", default=20, type=int)
+    parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--crop_size", default=512, type=int)
+    parser.add_argument("--warmup", default=2, type=int)
+    parser.add_argument("--steps", default=10, type=int)
+    parser.add_argument("--num_threads",
+                        default=torch.get_num_threads(),
+                        type=int)
+    return parser
+
+
+if __name__ == '__main__':
+    run(make_parser().parse_args())
@@ -7,6 +7,41 @@ def make_parser():
     # Environment
     parser.add_argument("--num_workers", default=64, type=int)
     parser.add_argument("--num_classes", default=20, type=int)
+    parser.add_argument(
+        "--amp",
+        default=False,
+        type=bool,
+        help="Train with autocast, bfloat16 on the cpu and float16 on cuda.")
+    parser.add_argument("--channels_last",
+                        default=False,
+                        type=bool,
+                        help="Train with channels last memory format.")
+    parser.add_argument(
+        "--normalize_on_device",
+        default=False,
+        type=bool,
+        help="The data loaders of train_cam, train_irn and make_cam pass "
+        "uint8 images, normalized batch-wise on the device.")
+    parser.add_argument(
+        "--ddp",
+        default=False,
+        type=bool,
+        help="Train cam and irn with DistributedDataParallel, in ddp_procs "
+        "local processes or in the group of a launcher such as torchrun.")
+    parser.add_argument("--ddp_procs", default=1, type=int)
+    parser.add_argument("--ddp_backend", default="gloo", type=str)
+    parser.add_argument("--ddp_port", default=29500, type=int)
+    parser.add_argument(
+        "--checkpoint_interval",
+        default=0,
+        type=int,
+        help="Every checkpoint_interval steps train_cam and train_irn save "
+        "a checkpoint next to their weights (.ckpt), 0 disables it.")
+    parser.add_argument(
+        "--resume",
+        default=False,
+        type=bool,
+        help="Continue train_cam and train_irn from their checkpoint.")
     parser.add_argument(
         "--voc12_root",
         type=str,
@@ -22,7 +57,23 @@ def make_parser():
         help="voc12/train_aug.txt to train a fully supervised model, "
              "voc12/train.txt or voc12/val.txt to quickly check the quality of the labels."
     )
+    parser.add_argument(
+        "--img_cache_dir",
+        default=None,
+        type=str,
+        help="Image cache built by misc/imgcache.py, the datasets read the "
+        "images it holds instead of decoding the jpegs.")
     parser.add_argument("--chainer_eval_set", type=str)
+    parser.add_argument(
+        "--eval_threads",
+        default=False,
+        type=bool,
+        help="Load the evaluated images in threads instead of processes.")
+    parser.add_argument(
+        "--eval_per_image_out",
+        default=None,
+        type=str,
+        help="Csv file for the iou, fp and fn of every evaluated image.")
 
     # Class Activation Map
     parser.add_argument("--cam_network", type=str)
@@ -33,13 +84,38 @@ def make_parser():
     parser.add_argument("--cam_learning_rate", default=0.1, type=float)
     parser.add_argument("--cam_weight_decay", default=1e-4, type=float)
     parser.add_argument("--cam_eval_thres", default=0.15, type=float)
+    parser.add_argument(
+        "--cam_eval_thres_sweep",
+        default=None,
+        nargs="+",
+        type=float,
+        help="Background thresholds evaluated together by eval_cam in one "
+        "pass over the cams, replaces cam_eval_thres.")
     parser.add_argument("--cam_scales",
                         default=(1.0, 0.5, 1.5, 2.0),
                         help="Multi-scale inferences")
+    parser.add_argument(
+        "--cam_infer_batch_size",
+        default=1,
+        type=int,
+        help="Number of same-sized images forwarded together for every "
+        "scale in make_cam, 1 keeps the per-image inference.")
+    parser.add_argument(
+        "--cam_device_pyramid",
+        default=False,
+        type=bool,
+        help="make_cam and stream_labels load only the scale 1.0 images and "
+        "build the scales and flips on the inference device.")
 
     # Mining Inter-pixel Relations
     parser.add_argument("--conf_fg_thres", default=0.30, type=float)
     parser.add_argument("--conf_bg_thres", default=0.05, type=float)
+    parser.add_argument(
+        "--crf_scale",
+        default=1.0,
+        type=float,
+        help="Runs the crf of the ir labels on the image rescaled by this "
+        "factor, the labels are upsampled to the full size.")
 
     # Inter-pixel Relation Network (IRNet)
     parser.add_argument("--irn_network", type=str)
@@ -49,6 +125,24 @@ def make_parser():
     parser.add_argument("--irn_num_epoches", default=3, type=int)
     parser.add_argument("--irn_learning_rate", default=0.1, type=float)
     parser.add_argument("--irn_weight_decay", default=1e-4, type=float)
+    parser.add_argument(
+        "--irn_aff_label_on_device",
+        default=False,
+        type=bool,
+        help="Ship only the reduced label maps from the data loader workers "
+        "and make the affinity labels batch-wise on the training device.")
+    parser.add_argument(
+        "--irn_dp_mean_samples",
+        default=0,
+        type=int,
+        help="Number of last training images the mean displacement is "
+        "accumulated over, 0 takes the last epoch.")
+    parser.add_argument(
+        "--irn_dp_mean_pass",
+        default=False,
+        type=bool,
+        help="Estimate the mean displacement with a separate pass over "
+        "infer_list after training instead.")
 
     # Random Walk Params
     parser.add_argument("--beta", default=10)
@@ -58,6 +152,30 @@ def make_parser():
         help=
         "Hyper-parameter that controls the number of random walk iterations,"
         "The random walk is performed 2^{exp_times}.")
+    parser.add_argument(
+        "--rw_sparse",
+        default=False,
+        type=bool,
+        help="Propagate with sparse mat-vec products instead of squaring "
+        "the dense (H*W)x(H*W) transition matrix.")
+    parser.add_argument(
+        "--rw_tol",
+        default=None,
+        type=float,
+        help="Stop the sparse random walk early once the maximum change "
+        "between two steps drops below this value.")
+    parser.add_argument(
+        "--path_index_cache_size",
+        default=16,
+        type=int,
+        help="Number of PathIndex objects (one per feature map size) kept "
+        "by each inference process.")
+    parser.add_argument(
+        "--centroid_tol",
+        default=None,
+        type=float,
+        help="Stop the centroid refinement of make_ins_seg_labels once no "
+        "centroid moves more than this many pixels in one step.")
     parser.add_argument("--ins_seg_bg_thres", default=0.25)
     parser.add_argument("--sem_seg_bg_thres", default=0.25)
 
@@ -66,6 +184,26 @@ def make_parser():
     parser.add_argument("--cam_weights_name", type=str)
     parser.add_argument("--irn_weights_name", type=str)
     parser.add_argument("--cam_out_dir", type=str)
+    parser.add_argument(
+        "--cam_format",
+        default="npy",
+        type=str,
+        choices=["npy", "store"],
+        help="npy: one pickled .npy per image, store: sharded memory-mappable "
+        "cam store (see misc/camstore.py). Readers detect the format.")
+    parser.add_argument(
+        "--cam_precision",
+        default="fp32",
+        type=str,
+        choices=["fp32", "fp16", "uint8"],
+        help="Storage precision of the saved cams, uint8 keeps a per-channel "
+        "scale. Readers convert back to float32.")
+    parser.add_argument(
+        "--manifest_verify",
+        default=False,
+        type=bool,
+        help="Re-hash the files recorded in the completion manifests when "
+        "deciding which images a resumed step still has to process.")
     parser.add_argument("--ir_label_out_dir", type=str)
     parser.add_argument("--sem_seg_out_dir", type=str)
     parser.add_argument("--ins_seg_out_dir", type=str)
@@ -83,6 +221,19 @@ def make_parser():
     parser.add_argument("--eval_sem_seg_pass", default=False, type=bool)
     parser.add_argument("--eval_bbox_pass", default=False, type=bool)
     parser.add_argument("--eval_cam_accuracy_pass", default=False, type=bool)
+    parser.add_argument(
+        "--stream_labels_pass",
+        default=False,
+        type=bool,
+        help="Runs cam inference, irn inference and the random walk for "
+        "each image of infer_list in one pass, see --stream_outputs.")
+    parser.add_argument(
+        "--stream_outputs",
+        default=["sem_seg"],
+        nargs="+",
+        choices=["cam", "ir_label", "sem_seg", "ins_seg"],
+        help="Artifacts written by the streaming pass, everything else stays "
+        "in memory.")
 
 
     return parser
@@ -53,6 +53,13 @@ if __name__ == '__main__':
         timer = pyutils.Timer('step.train_irn:')
         step.train_irn.run(args)
 
+    if args.stream_labels_pass:
+        import step.stream_labels
+
+        print('stream_labels')
+        timer = pyutils.Timer('step.stream_labels:')
+        step.stream_labels.run(args)
+
     if args.make_ins_seg_pass:
         import step.make_ins_seg_labels
 
@@ -0,0 +1,92 @@
+import glob
+import os
+
+import cv2
+import numpy as np
+
+BBOX_PATTERN = 'bboxes-%s.tsv'
+
+
+def largest_bbox(label, thres=100, closing_iterations=8):
+    """(x, y, w, h) of the largest contour of label > thres after a
+    closing, or None when there is none. Same as thresholding the gray png
+    of the label.
+
+    >>> label = np.zeros((20, 30), np.uint8)
+    >>> label[2:6, 3:8] = 255
+    >>> label[10:18, 12:27] = 255
+    >>> largest_bbox(label, closing_iterations=0)
+    (12, 10, 15, 8)
+    """
+    threshed_img = np.where(np.asarray(label) > thres, 255, 0).astype(np.uint8)
+    kernel = np.ones((3, 3), np.uint8)
+    closing = cv2.morphologyEx(threshed_img,
+                               cv2.MORPH_CLOSE,
+                               kernel,
+                               iterations=closing_iterations)
+
+    contours, hierarchy = cv2.findContours(closing, cv2.RETR_TREE,
+                                           cv2.CHAIN_APPROX_SIMPLE)[-2:]
+    biggest_area = float('-inf')
+    bbox = None
+    for cnt in contours:
+        area = cv2.contourArea(cnt)
+        if area > biggest_area:
+            biggest_area = area
+            bbox = tuple(int(v) for v in cv2.boundingRect(cnt))
+    return bbox
+
+
+class BboxWriter:
+    """Appends one "name x y w h" row per image to the bbox file of one
+    process, images without a box get empty coordinates.
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> with BboxWriter(root, 0) as writer:
+    ...     writer.write('a', (1, 2, 3, 4))
+    ...     writer.write('b', None)
+    >>> with BboxWriter(root, 1) as writer:
+    ...     writer.write('a', (5, 6, 7, 8))
+    >>> names, bboxes = load_bboxes(root)
+    >>> names.tolist(), bboxes.tolist()
+    (['a', 'b'], [[5.0, 6.0, 7.0, 8.0], [nan, nan, nan, nan]])
+    """
+    def __init__(self, root, writer_id=0):
+        os.makedirs(root, exist_ok=True)
+        self.f = open(os.path.join(root, BBOX_PATTERN % writer_id), 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, name, bbox):
+        if bbox is None:
+            bbox = ('', ) * 4
+        self.f.write('\t'.join([name] + [str(v) for v in bbox]) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def load_bboxes(root):
+    """Names and (N, 4) float xywh boxes of all bbox files in root, nan for
+    images without a box. A name written again (a redone image) keeps its
+    last row."""
+    rows = dict()
+    for path in sorted(glob.glob(os.path.join(root, BBOX_PATTERN % '*'))):
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 5:
+                    # a row cut short by an interrupted writer
+                    continue
+                rows[fields[0]] = [float(v) if v else np.nan
+                                   for v in fields[1:]]
+
+    names = np.array(list(rows.keys()), dtype=str)
+    bboxes = np.array(list(rows.values()), np.float64).reshape(-1, 4)
+    return names, bboxes
@@ -0,0 +1,271 @@
+import glob
+import json
+import os
+
+import numpy as np
+
+from wsl_survey.segmentation.irn.misc import manifest
+
+INDEX_PATTERN = 'index-%s.jsonl'
+SHARD_PATTERN = 'shard-%s.bin'
+ALIGNMENT = 64
+
+CAM_FIELDS = ('keys', 'cam', 'high_res')
+QUANTIZED_FIELDS = ('cam', 'high_res')
+PRECISIONS = ('fp32', 'fp16', 'uint8')
+
+
+def is_cam_store(root):
+    return len(glob.glob(os.path.join(root, INDEX_PATTERN % '*'))) > 0
+
+
+def encode_cams(arrays, precision='fp32'):
+    """
+    >>> cam = np.random.rand(2, 4, 5).astype(np.float32)
+    >>> encoded = encode_cams({'cam': cam}, 'uint8')
+    >>> encoded['cam'].dtype, encoded['cam_scale'].shape
+    (dtype('uint8'), (2,))
+    >>> bool(np.abs(decode_cams(encoded)['cam'] - cam).max() <= 0.5 / 255)
+    True
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('unknown cam precision: %s' % precision)
+
+    out = dict()
+    for key, arr in arrays.items():
+        arr = np.asarray(arr)
+        if key not in QUANTIZED_FIELDS or precision == 'fp32':
+            out[key] = arr
+        elif precision == 'fp16':
+            out[key] = arr.astype(np.float16)
+        else:
+            # per-channel scale, cams are non-negative
+            scale = np.max(arr.reshape(arr.shape[0], -1), axis=1) \
+                if arr.size > 0 else np.zeros(arr.shape[0])
+            scale = np.maximum(scale, 1e-12).astype(np.float32)
+            out[key] = np.round(
+                arr / scale.reshape((-1, ) + (1, ) * (arr.ndim - 1)) *
+                255).astype(np.uint8)
+            out[key + '_scale'] = scale
+    return out
+
+
+def decode_cams(arrays):
+    out = dict()
+    for key, arr in arrays.items():
+        if key.endswith('_scale') and key[:-len('_scale')] in arrays:
+            continue
+        if key + '_scale' in arrays:
+            scale = arrays[key + '_scale'] / np.float32(255)
+            arr = arr.astype(np.float32) * scale.reshape(
+                (-1, ) + (1, ) * (arr.ndim - 1))
+        elif arr.dtype == np.float16:
+            arr = arr.astype(np.float32)
+        out[key] = arr
+    return out
+
+
+def load_index(root):
+    index = dict()
+    for index_path in sorted(glob.glob(os.path.join(root,
+                                                    INDEX_PATTERN % '*'))):
+        with open(index_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by an interrupted writer
+                    continue
+                index[entry['name']] = entry
+    return index
+
+
+class CamStoreWriter:
+    """Appends the cams of one process to its own shard.
+
+    The index line of an image is written only after its arrays have been
+    flushed to the shard, so an interrupted write never shows up in the index.
+    """
+    def __init__(self, root, writer_id=0, precision='fp32'):
+        os.makedirs(root, exist_ok=True)
+
+        self.root = root
+        self.precision = precision
+        self.shard_name = SHARD_PATTERN % writer_id
+        self.names = set(load_index(root).keys())
+
+        self.shard = open(os.path.join(root, self.shard_name), 'ab')
+        self.index = open(os.path.join(root, INDEX_PATTERN % writer_id), 'a')
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, name, **arrays):
+        entry = {'name': name, 'shard': self.shard_name, 'arrays': dict()}
+
+        for key, arr in encode_cams(arrays, self.precision).items():
+            arr = np.ascontiguousarray(np.asarray(arr))
+
+            self.shard.write(b'\0' * (-self.shard.tell() % ALIGNMENT))
+            offset = self.shard.tell()
+            self.shard.write(arr.tobytes())
+
+            entry['arrays'][key] = [offset, arr.dtype.str, list(arr.shape)]
+
+        self.shard.flush()
+
+        self.index.write(json.dumps(entry) + '\n')
+        self.index.flush()
+
+        self.names.add(name)
+
+    def close(self):
+        self.shard.close()
+        self.index.close()
+
+
+class CamStore:
+    def __init__(self, root):
+        self.root = root
+        self.index = load_index(root)
+        self.__shards = dict()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def __get_shard(self, shard_name, end):
+        shard = self.__shards.get(shard_name)
+        if shard is None or shard.shape[0] < end:
+            # (re)map, the shard may have grown since it was last mapped
+            shard = np.memmap(os.path.join(self.root, shard_name),
+                              dtype=np.uint8,
+                              mode='r')
+            self.__shards[shard_name] = shard
+        return shard
+
+    def __getitem__(self, name):
+        entry = self.index[name]
+
+        out = dict()
+        for key, (offset, dtype, shape) in entry['arrays'].items():
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+
+            shard = self.__get_shard(entry['shard'], offset + nbytes)
+            out[key] = shard[offset:offset + nbytes].view(dtype).reshape(shape)
+
+        return decode_cams(out)
+
+
+class NpyCamWriter:
+    def __init__(self, root, writer_id=0, precision='fp32'):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.precision = precision
+        self.manifest = manifest.ManifestWriter(root, writer_id)
+
+    def __contains__(self, name):
+        return name in self.manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, name, **arrays):
+        path = os.path.join(self.root, name + '.npy')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, encode_cams(arrays, self.precision))
+        self.manifest.add(name, path)
+
+    def close(self):
+        self.manifest.close()
+
+
+class NpyCamReader:
+    def __init__(self, root, verify=False):
+        self.root = root
+        self.verify = verify
+        self.__done = None
+
+    def __contains__(self, name):
+        # only cams recorded as complete in the manifest count
+        if self.__done is None:
+            self.__done = manifest.load_manifest(self.root, self.verify)
+        return name in self.__done
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        names = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.npy'):
+                    path = os.path.join(dirpath, filename[:-len('.npy')])
+                    names.append(os.path.relpath(path, self.root))
+        return sorted(names)
+
+    def __getitem__(self, name):
+        cam_dict = np.load(os.path.join(self.root, name + '.npy'),
+                           allow_pickle=True).item()
+        # older files hold torch tensors for 'keys' and 'cam'
+        return decode_cams({k: np.asarray(v) for k, v in cam_dict.items()})
+
+
+def open_cam_reader(root, verify=False):
+    # store entries are indexed only once complete, verify is for npy files
+    if is_cam_store(root):
+        return CamStore(root)
+    return NpyCamReader(root, verify)
+
+
+def open_cam_writer(root, cam_format='npy', writer_id=0, precision='fp32'):
+    if cam_format == 'store':
+        return CamStoreWriter(root, writer_id=writer_id, precision=precision)
+    elif cam_format == 'npy':
+        return NpyCamWriter(root, writer_id=writer_id, precision=precision)
+    raise ValueError('unknown cam format: %s' % cam_format)
+
+
+def convert_npy_to_store(npy_dir, store_root, writer_id=0, precision='fp32'):
+    from tqdm import tqdm
+
+    reader = NpyCamReader(npy_dir)
+    with CamStoreWriter(store_root, writer_id=writer_id,
+                        precision=precision) as writer:
+        for name in tqdm(reader.keys()):
+            if name not in writer:
+                writer.write(name, **reader[name])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Converts a directory of per-image cam .npy files into '
+        'a sharded cam store.')
+    parser.add_argument("--npy_dir", required=True, type=str)
+    parser.add_argument("--store_dir", required=True, type=str)
+    parser.add_argument("--precision",
+                        default="fp32",
+                        type=str,
+                        choices=PRECISIONS)
+    args = parser.parse_args()
+
+    convert_npy_to_store(args.npy_dir,
+                         args.store_dir,
+                         precision=args.precision)
@@ -0,0 +1,130 @@
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+
+def _to_cpu(obj):
+    # a copy the training loop can go on updating in place
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_states():
+    states = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+class CheckpointWriter:
+    """Saves checkpoints in a background thread.
+
+    The state is copied to the cpu before save returns, the file is written
+    next to its destination and renamed over it, so an interrupted write
+    never leaves a truncated checkpoint. A save waits for the previous one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.thread = None
+
+    def _write(self, state):
+        tmp_path = self.path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def save(self, state):
+        self.wait()
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.thread = threading.Thread(target=self._write,
+                                       args=(_to_cpu(state), ))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location='cpu')
+
+
+def training_state(model, optimizer, epoch, precision=None, **extra):
+    """Everything to go on training from the current step of a
+    PolyOptimizer, epoch being the one the step is in."""
+    state = {
+        'model': getattr(model, 'module', model).state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'global_step': optimizer.global_step,
+        'epoch': epoch,
+        'rng': get_rng_states()
+    }
+    if precision is not None and precision.scaler is not None:
+        state['scaler'] = precision.scaler.state_dict()
+    state.update(extra)
+    return state
+
+
+def restore_training_state(state, model, optimizer, precision=None):
+    getattr(model, 'module', model).load_state_dict(state['model'])
+    # the momentum buffers, the poly lr follows from global_step
+    optimizer.load_state_dict(state['optimizer'])
+    optimizer.global_step = state['global_step']
+    if precision is not None and precision.scaler is not None \
+            and 'scaler' in state:
+        precision.scaler.load_state_dict(state['scaler'])
+    set_rng_states(state['rng'])
+
+
+class ResumableSampler(Sampler):
+    """Passes on the indices of sampler, the first skip of them only once,
+    to pick an epoch up in the middle. sampler has to give the same order
+    again for the epoch, e.g. a DistributedSampler."""
+    def __init__(self, sampler, skip=0):
+        self.sampler = sampler
+        self.skip = skip
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        for i, index in enumerate(self.sampler):
+            if i >= skip:
+                yield index
+
+    def __len__(self):
+        return len(self.sampler) - self.skip
+
+
+def resumable_sampler(dataset, rank, world_size):
+    """A shuffling sampler of the share of rank that can be resumed within
+    an epoch: the order of an epoch only depends on the epoch."""
+    return ResumableSampler(
+        DistributedSampler(dataset, num_replicas=world_size, rank=rank))
@@ -0,0 +1,256 @@
+import csv
+import time
+from multiprocessing.pool import Pool, ThreadPool
+
+import numpy as np
+from tqdm import tqdm
+
+
+def confusion_matrix(pred, gt, n_class=None):
+    """(n_class, n_class) confusion with gt along the rows, gt pixels that
+    are negative or >= n_class (ignore labels) are skipped, as are pixels
+    predicted out of range. Without n_class the confusion grows to the
+    largest label, as calc_semantic_segmentation_confusion of chainercv.
+
+    >>> gt = np.array([[0, 1], [1, -1]])
+    >>> pred = np.array([[0, 1], [0, 1]])
+    >>> confusion_matrix(pred, gt, 2).tolist()
+    [[1, 0], [1, 1]]
+    >>> confusion_matrix(pred + 2, gt).shape
+    (4, 4)
+    """
+    gt = np.asarray(gt).reshape(-1)
+    pred = np.asarray(pred).reshape(-1)
+    if n_class is None:
+        mask = (gt >= 0) & (pred >= 0)
+        n_class = max(int(gt[mask].max()), int(pred[mask].max())) + 1 \
+            if np.any(mask) else 0
+    else:
+        mask = (gt >= 0) & (gt < n_class) & (pred >= 0) & (pred < n_class)
+    return np.bincount(n_class * gt[mask].astype(np.int64) + pred[mask],
+                       minlength=n_class**2).reshape(n_class, n_class)
+
+
+def compact_confusion(pred, gt):
+    """The labels present in pred or gt and the confusion among only them,
+    small even when the labels are large.
+
+    >>> classes, confusion = compact_confusion([5, 0], [0, 0])
+    >>> classes.tolist(), confusion.tolist()
+    ([0, 5], [[1, 1], [0, 0]])
+    """
+    gt = np.asarray(gt).reshape(-1)
+    pred = np.asarray(pred).reshape(-1)
+    mask = (gt >= 0) & (pred >= 0)
+    gt, pred = gt[mask], pred[mask]
+    classes, inverse = np.unique(np.concatenate([gt, pred]),
+                                 return_inverse=True)
+    n_class = len(classes)
+    confusion = np.bincount(n_class * inverse[:len(gt)] + inverse[len(gt):],
+                            minlength=n_class**2).reshape(n_class, n_class)
+    return classes, confusion
+
+
+def iou_from_confusion(confusion):
+    gtj = confusion.sum(axis=1)
+    resj = confusion.sum(axis=0)
+    gtjresj = np.diag(confusion)
+    denominator = gtj + resj - gtjresj
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return gtjresj / denominator
+
+
+def scores_from_confusion(confusion):
+    """Per class iou, false positive and false negative rates, all relative
+    to the union of prediction and gt of the class.
+
+    >>> scores = scores_from_confusion(np.array([[3, 1], [0, 4]]))
+    >>> [scores[k].round(2).tolist() for k in ('iou', 'fp', 'fn')]
+    [[0.75, 0.8], [0.0, 0.2], [0.25, 0.0]]
+    """
+    gtj = confusion.sum(axis=1)
+    resj = confusion.sum(axis=0)
+    gtjresj = np.diag(confusion)
+    denominator = gtj + resj - gtjresj
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'iou': gtjresj / denominator,
+            'fp': 1. - gtj / denominator,
+            'fn': 1. - resj / denominator
+        }
+
+
+def cam_sweep_confusion(cam_dict, gt, thresholds, n_class):
+    """Confusion of the cam labels for every background threshold, the
+    argmax over the cams is shared by all thresholds.
+
+    A pixel is background when no cam exceeds the threshold, the same rule
+    as padding the cams with the threshold before the argmax.
+
+    >>> cams = np.array([[[0.1, 0.5], [0.9, 0.2]]])
+    >>> cam_dict = {'keys': np.array([2]), 'high_res': cams}
+    >>> gt = np.array([[0, 3], [3, 0]])
+    >>> confusion = cam_sweep_confusion(cam_dict, gt, [0.3, 0.6], 4)
+    >>> confusion.trace(axis1=1, axis2=2).tolist()
+    [4, 3]
+    """
+    gt = np.asarray(gt).reshape(-1)
+    valid = (gt >= 0) & (gt < n_class)
+    gt = gt[valid].astype(np.int64) * n_class
+
+    cams = np.asarray(cam_dict['high_res'])
+    if cams.shape[0] == 0:
+        max_cam = np.full(gt.shape, -np.inf, np.float32)
+        fg_label = np.zeros(gt.shape, np.int64)
+    else:
+        cams = cams.reshape(cams.shape[0], -1)[:, valid]
+        max_cam = np.max(cams, axis=0)
+        fg_label = (np.asarray(cam_dict['keys']) + 1)[np.argmax(cams, axis=0)]
+
+    confusion = np.empty((len(thresholds), n_class, n_class), np.int64)
+    for i, thres in enumerate(thresholds):
+        pred = np.where(max_cam > thres, fg_label, 0)
+        confusion[i] = np.bincount(gt + pred, minlength=n_class**2).reshape(
+            n_class, n_class)
+    return confusion
+
+
+# per pool worker, set by _init_pair_worker
+_pair_state = dict()
+
+
+def _init_pair_worker(load_pair, n_class, initializer, initargs):
+    _pair_state.update(load_pair=load_pair, n_class=n_class)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _pair_confusion(i):
+    name, pred, gt = _pair_state['load_pair'](i)
+    n_class = _pair_state['n_class']
+    if n_class is None:
+        classes, confusion = compact_confusion(pred, gt)
+        return name, confusion, classes
+    return name, confusion_matrix(pred, gt, n_class), None
+
+
+class SemSegEvaluator:
+    """Merges the confusion of (prediction, gt) pairs as they stream in.
+
+    Only the running confusion is kept, the scores of every image are
+    written to per_image_path (csv) when given and dropped. Without n_class
+    the confusion grows to the largest label seen, for predictions that
+    go beyond the gt classes, and the csv has a row per image and class.
+
+    >>> evaluator = SemSegEvaluator(2)
+    >>> evaluator.add_pair('a', np.array([0, 1, 1]), np.array([0, 1, 0]))
+    >>> evaluator.add_pair('b', np.array([1, 1]), np.array([1, 255]))
+    >>> evaluator.confusion.tolist()
+    [[1, 1], [0, 2]]
+    >>> evaluator.n_images, float(evaluator.scores()['miou'])
+    (2, 0.5833333333333333)
+    >>> evaluator = SemSegEvaluator()
+    >>> evaluator.add_pair('a', np.array([0, 1, 3]), np.array([0, 1, 1]))
+    >>> evaluator.confusion.shape, float(evaluator.scores()['miou'])
+    ((4, 4), 0.5)
+    """
+    def __init__(self, n_class=None, per_image_path=None):
+        self.n_class = n_class
+        self.confusion = np.zeros((n_class or 0, n_class or 0), np.int64)
+        self.n_images = 0
+        self.elapsed = 0.
+
+        self.per_image_file = None
+        if per_image_path is not None:
+            self.per_image_file = open(per_image_path, 'w', newline='')
+            self.per_image_writer = csv.writer(self.per_image_file)
+            if n_class is None:
+                self.per_image_writer.writerow(
+                    ['name', 'class', 'iou', 'fp', 'fn'])
+            else:
+                self.per_image_writer.writerow(
+                    ['name', 'miou'] +
+                    ['%s_%d' % (score, c) for score in ('iou', 'fp', 'fn')
+                     for c in range(n_class)])
+
+    def add(self, name, confusion, classes=None):
+        """Adds the confusion of an image, over the labels classes when
+        given (see compact_confusion) or over range(len(confusion))."""
+        if classes is None:
+            classes = np.arange(len(confusion))
+        n_class = int(classes[-1]) + 1 if len(classes) > 0 else 0
+        if n_class > len(self.confusion):
+            grow = n_class - len(self.confusion)
+            self.confusion = np.pad(self.confusion, ((0, grow), (0, grow)),
+                                    mode='constant')
+        if len(classes) == len(self.confusion):
+            self.confusion += confusion
+        else:
+            self.confusion[np.ix_(classes, classes)] += confusion
+        self.n_images += 1
+
+        if self.per_image_file is not None:
+            scores = scores_from_confusion(confusion)
+            if self.n_class is None:
+                for row in zip(classes.tolist(), scores['iou'].tolist(),
+                               scores['fp'].tolist(), scores['fn'].tolist()):
+                    self.per_image_writer.writerow((name, ) + row)
+            else:
+                self.per_image_writer.writerow(
+                    [name, np.nanmean(scores['iou'])] +
+                    np.concatenate([scores['iou'], scores['fp'], scores['fn']
+                                    ]).tolist())
+
+    def add_pair(self, name, pred, gt):
+        if self.n_class is None:
+            classes, confusion = compact_confusion(pred, gt)
+            self.add(name, confusion, classes)
+        else:
+            self.add(name, confusion_matrix(pred, gt, self.n_class))
+
+    def evaluate(self,
+                 load_pair,
+                 n_items,
+                 num_workers=1,
+                 threads=False,
+                 initializer=None,
+                 initargs=()):
+        """Adds the pairs load_pair(i) -> (name, pred, gt) of range(n_items),
+        loaded and reduced to confusions in a pool of num_workers processes
+        (or threads, for loaders that release the gil). load_pair and the
+        initializer of the pool must be picklable for processes."""
+        pool_cls = ThreadPool if threads else Pool
+        t = time.time()
+        with pool_cls(processes=max(num_workers, 1),
+                      initializer=_init_pair_worker,
+                      initargs=(load_pair, self.n_class, initializer,
+                                initargs)) as pool:
+            for name, confusion, classes in tqdm(pool.imap_unordered(
+                    _pair_confusion, range(n_items), chunksize=8),
+                                                 total=n_items):
+                self.add(name, confusion, classes)
+        self.elapsed += time.time() - t
+
+    def close(self):
+        if self.per_image_file is not None:
+            self.per_image_file.close()
+            self.per_image_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def img_per_sec(self):
+        return self.n_images / max(self.elapsed, 1e-12)
+
+    def scores(self):
+        scores = scores_from_confusion(self.confusion)
+        scores['miou'] = np.nanmean(scores['iou'])
+        return scores
+
+    def __repr__(self):
+        return '%d images in %.1fs (%.1f img/s)' % (
+            self.n_images, self.elapsed, self.img_per_sec)
@@ -0,0 +1,199 @@
+import json
+import multiprocessing
+import os
+
+import imageio
+import numpy as np
+
+from wsl_survey.segmentation.irn.misc import imutils
+from wsl_survey.segmentation.irn.misc.camstore import ALIGNMENT, \
+    INDEX_PATTERN, SHARD_PATTERN, load_index
+
+
+def cap_long_side(img, max_long=None):
+    """img rescaled (bicubic) so that its long side is at most max_long.
+
+    >>> cap_long_side(np.zeros((300, 500, 3), np.uint8), 250).shape
+    (150, 250, 3)
+    >>> cap_long_side(np.zeros((30, 50, 3), np.uint8), 250).shape
+    (30, 50, 3)
+    """
+    if max_long is None or max(img.shape[:2]) <= max_long:
+        return img
+    return imutils.pil_rescale(img, max_long / max(img.shape[:2]), 3)
+
+
+class ImageCacheWriter:
+    """Appends the decoded uint8 images of one process to its own shard,
+    indexed like the cam store: an image is indexed once it is flushed.
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> img = np.arange(2 * 8 * 3, dtype=np.uint8).reshape(2, 8, 3)
+    >>> with ImageCacheWriter(root, max_long=4) as writer:
+    ...     writer.write('a', img)
+    ...     writer.write('b', img[:, :4, 0])
+    >>> cache = ImageCache(root)
+    >>> cache.get('a').shape, cache.get('a', exact=True)
+    ((1, 4, 3), None)
+    >>> cache.get('b', exact=True).tolist() == img[:, :4, 0].tolist()
+    True
+    >>> cache.size('a'), cache.get('c')
+    ((2, 8), None)
+    """
+    def __init__(self, root, writer_id=0, max_long=None):
+        os.makedirs(root, exist_ok=True)
+
+        self.max_long = max_long
+        self.shard_name = SHARD_PATTERN % writer_id
+        self.names = set(load_index(root).keys())
+
+        self.shard = open(os.path.join(root, self.shard_name), 'ab')
+        self.index = open(os.path.join(root, INDEX_PATTERN % writer_id), 'a')
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, name, img):
+        img = np.asarray(img)
+        size = list(img.shape[:2])
+        img = np.ascontiguousarray(cap_long_side(img, self.max_long),
+                                   dtype=np.uint8)
+
+        self.shard.write(b'\0' * (-self.shard.tell() % ALIGNMENT))
+        offset = self.shard.tell()
+        self.shard.write(img.tobytes())
+        self.shard.flush()
+
+        # size is the one of the jpeg, shape the one stored
+        self.index.write(
+            json.dumps({
+                'name': name,
+                'shard': self.shard_name,
+                'offset': offset,
+                'shape': list(img.shape),
+                'size': size
+            }) + '\n')
+        self.index.flush()
+
+        self.names.add(name)
+
+    def close(self):
+        self.shard.close()
+        self.index.close()
+
+
+class ImageCache:
+    """Zero-copy uint8 views of the images of a cache, mapped copy-on-write
+    so that the views can be handed on as writable arrays."""
+    def __init__(self, root):
+        self.root = root
+        self.index = load_index(root)
+        self.__shards = dict()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def size(self, name):
+        return tuple(self.index[name]['size'])
+
+    def __get_shard(self, shard_name, end):
+        shard = self.__shards.get(shard_name)
+        if shard is None or shard.shape[0] < end:
+            shard = np.memmap(os.path.join(self.root, shard_name),
+                              dtype=np.uint8,
+                              mode='c')
+            self.__shards[shard_name] = shard
+        return shard
+
+    def get(self, name, exact=False):
+        """The image, or None when it is not cached or, with exact, only
+        cached below its original size."""
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        shape = entry['shape']
+        if exact and shape[:2] != entry['size']:
+            return None
+
+        offset = entry['offset']
+        end = offset + int(np.prod(shape))
+        return np.asarray(
+            self.__get_shard(entry['shard'], end)[offset:end]).reshape(shape)
+
+    def __getstate__(self):
+        # workers map the shards themselves
+        state = self.__dict__.copy()
+        state['_ImageCache__shards'] = dict()
+        return state
+
+
+def open_image_cache(img_cache):
+    if img_cache is None or isinstance(img_cache, ImageCache):
+        return img_cache
+    return ImageCache(img_cache)
+
+
+def _build_worker(process_id, img_name_list, voc12_root, root, max_long):
+    from tqdm import tqdm
+    from wsl_survey.segmentation.irn.voc12 import dataloader
+
+    with ImageCacheWriter(root, process_id, max_long) as writer:
+        for name in tqdm(img_name_list, position=process_id):
+            name_str = dataloader.decode_int_filename(name)
+            if name_str in writer:
+                continue
+            writer.write(
+                name_str,
+                imageio.imread(dataloader.get_img_path(name_str,
+                                                       voc12_root)))
+
+
+def build_image_cache(img_name_list, voc12_root, root, max_long=None,
+                      num_workers=1):
+    """Decodes the images not yet in the cache at root, each of
+    num_workers processes into its own shard."""
+    num_workers = max(min(num_workers, len(img_name_list)), 1)
+    processes = [
+        multiprocessing.Process(target=_build_worker,
+                                args=(i, img_name_list[i::num_workers],
+                                      voc12_root, root, max_long))
+        for i in range(num_workers)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+
+if __name__ == '__main__':
+    import argparse
+    from wsl_survey.segmentation.irn.voc12 import dataloader
+
+    parser = argparse.ArgumentParser(
+        description='Decodes the jpegs of an image list once into a sharded '
+        'uint8 image cache, see --img_cache_dir.')
+    parser.add_argument("--voc12_root", required=True, type=str)
+    parser.add_argument("--img_list", required=True, type=str)
+    parser.add_argument("--cache_dir", required=True, type=str)
+    parser.add_argument(
+        "--max_long",
+        default=None,
+        type=int,
+        help="Store the images with their long side capped, such images "
+        "only serve datasets that resize them anyway (resize_long).")
+    parser.add_argument("--num_workers", default=4, type=int)
+    args = parser.parse_args()
+
+    build_image_cache(dataloader.load_img_name_list(args.img_list),
+                      args.voc12_root, args.cache_dir, args.max_long,
+                      args.num_workers)
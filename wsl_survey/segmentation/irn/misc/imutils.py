@@ -6,14 +6,35 @@ from PIL import Image
 from pydensecrf.utils import unary_from_labels
 
 
+def _nearest_indices(n_out, n_in):
+    # the source pixels of pil: centers accumulated in double precision
+    step = n_in / n_out
+    centers = np.full(n_out, step)
+    centers[0] = step / 2
+    return np.minimum(np.cumsum(centers).astype(np.int64), n_in - 1)
+
+
+def nearest_resize(img, size):
+    """Nearest neighbour resize to size (height, width) by indexing, the
+    same pixels as pil for any dtype and number of channels.
+
+    >>> img = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    >>> nearest_resize(img, (2, 3)).tolist()
+    [[0, 2, 3], [8, 10, 11]]
+    """
+    rows = _nearest_indices(size[0], img.shape[0])
+    cols = _nearest_indices(size[1], img.shape[1])
+    return img.take(rows, axis=0).take(cols, axis=1)
+
+
 def pil_resize(img, size, order):
     if size[0] == img.shape[0] and size[1] == img.shape[1]:
         return img
 
-    if order == 3:
+    if order == 0:
+        return nearest_resize(img, size)
+    elif order == 3:
         resample = Image.BICUBIC
-    elif order == 0:
-        resample = Image.NEAREST
 
     return np.asarray(Image.fromarray(img).resize(size[::-1], resample))
 
@@ -83,22 +104,43 @@ def get_random_crop_box(imgsize, cropsize):
     return cont_top, cont_top + ch, cont_left, cont_left + cw, img_top, img_top + ch, img_left, img_left + cw
 
 
-def random_crop(images, cropsize, default_values):
+def crop_into(img, cropsize, default_value, box, out=None):
+    """The (cropsize, cropsize) crop of img given by box (see
+    get_random_crop_box), written into out when given. Only the padding
+    around the copied part is filled with default_value, which may hold a
+    value per channel.
+
+    >>> img = np.arange(6, dtype=np.uint8).reshape(2, 3)
+    >>> crop_into(img, 3, 9, (1, 3, 0, 3, 0, 2, 0, 3)).tolist()
+    [[9, 9, 9], [0, 1, 2], [3, 4, 5]]
+    """
+    cont_top, cont_bottom, cont_left, cont_right, \
+        img_top, img_bottom, img_left, img_right = box
+    if out is None:
+        out = np.empty((cropsize, cropsize) + img.shape[2:], img.dtype)
+
+    out[cont_top:cont_bottom, cont_left:cont_right] = \
+        img[img_top:img_bottom, img_left:img_right]
+
+    out[:cont_top] = default_value
+    out[cont_bottom:] = default_value
+    out[cont_top:cont_bottom, :cont_left] = default_value
+    out[cont_top:cont_bottom, cont_right:] = default_value
+    return out
+
+
+def random_crop(images, cropsize, default_values, out=None):
     if isinstance(images, np.ndarray): images = (images,)
     if isinstance(default_values, int): default_values = (default_values,)
+    if out is None or isinstance(out, np.ndarray): out = (out, ) * len(images)
 
     imgsize = images[0].shape[:2]
     box = get_random_crop_box(imgsize, cropsize)
 
-    new_images = []
-    for img, f in zip(images, default_values):
-
-        if len(img.shape) == 3:
-            cont = np.ones((cropsize, cropsize, img.shape[2]), img.dtype) * f
-        else:
-            cont = np.ones((cropsize, cropsize), img.dtype) * f
-        cont[box[0]:box[1], box[2]:box[3]] = img[box[4]:box[5], box[6]:box[7]]
-        new_images.append(cont)
+    new_images = [
+        crop_into(img, cropsize, f, box, o)
+        for img, f, o in zip(images, default_values, out)
+    ]
 
     if len(new_images) == 1:
         new_images = new_images[0]
@@ -106,24 +148,17 @@ def random_crop(images, cropsize, default_values):
     return new_images
 
 
-def top_left_crop(img, cropsize, default_value):
+def top_left_crop(img, cropsize, default_value, out=None):
     h, w = img.shape[:2]
 
     ch = min(cropsize, h)
     cw = min(cropsize, w)
 
-    if len(img.shape) == 2:
-        container = np.ones((cropsize, cropsize), img.dtype) * default_value
-    else:
-        container = np.ones(
-            (cropsize, cropsize, img.shape[2]), img.dtype) * default_value
-
-    container[:ch, :cw] = img[:ch, :cw]
-
-    return container
+    return crop_into(img, cropsize, default_value,
+                     (0, ch, 0, cw, 0, ch, 0, cw), out)
 
 
-def center_crop(img, cropsize, default_value=0):
+def center_crop(img, cropsize, default_value=0, out=None):
     h, w = img.shape[:2]
 
     ch = min(cropsize, h)
@@ -146,16 +181,9 @@ def center_crop(img, cropsize, default_value=0):
         cont_top = int(round(-sh / 2))
         img_top = 0
 
-    if len(img.shape) == 2:
-        container = np.ones((cropsize, cropsize), img.dtype) * default_value
-    else:
-        container = np.ones(
-            (cropsize, cropsize, img.shape[2]), img.dtype) * default_value
-
-    container[cont_top:cont_top + ch, cont_left:cont_left + cw] = \
-        img[img_top:img_top + ch, img_left:img_left + cw]
-
-    return container
+    return crop_into(img, cropsize, default_value,
+                     (cont_top, cont_top + ch, cont_left, cont_left + cw,
+                      img_top, img_top + ch, img_left, img_left + cw), out)
 
 
 def HWC_to_CHW(img):
@@ -163,25 +191,50 @@ def HWC_to_CHW(img):
 
 
 def crf_inference_label(img, labels, t=10, n_labels=21, gt_prob=0.7):
-    h, w = img.shape[:2]
-
-    d = dcrf.DenseCRF2D(w, h, n_labels)
-
-    unary = unary_from_labels(labels,
-                              n_labels,
-                              gt_prob=gt_prob,
-                              zero_unsure=False)
+    return DenseCRF(img, n_labels).inference_label(labels, t, gt_prob)
 
-    d.setUnaryEnergy(unary)
-    d.addPairwiseGaussian(sxy=3, compat=3)
-    d.addPairwiseBilateral(sxy=50,
-                           srgb=5,
-                           rgbim=np.ascontiguousarray(np.copy(img)),
-                           compat=10)
 
-    q = d.inference(t)
+class DenseCRF:
+    """A dense crf on one image whose pairwise terms are built once and
+    shared by every label map inferred on that image.
 
-    return np.argmax(np.array(q).reshape((n_labels, h, w)), axis=0)
+    With scale < 1 the crf runs on the rescaled image (the spatial kernel
+    widths shrink with it) and the labels are upsampled with nearest.
+    """
+    def __init__(self, img, n_labels=21, scale=1.):
+        self.size = img.shape[:2]
+        self.n_labels = n_labels
+        self.scale = scale
+
+        if scale != 1.:
+            img = pil_rescale(img, scale, order=3)
+        self.h, self.w = img.shape[:2]
+
+        self.d = dcrf.DenseCRF2D(self.w, self.h, n_labels)
+        self.d.addPairwiseGaussian(sxy=3 * scale, compat=3)
+        self.d.addPairwiseBilateral(sxy=50 * scale,
+                                    srgb=5,
+                                    rgbim=np.ascontiguousarray(img,
+                                                               dtype=np.uint8),
+                                    compat=10)
+
+    def inference_label(self, labels, t=10, gt_prob=0.7):
+        if self.scale != 1.:
+            labels = pil_resize(labels.astype(np.uint8), (self.h, self.w),
+                                order=0)
+
+        self.d.setUnaryEnergy(
+            unary_from_labels(labels,
+                              self.n_labels,
+                              gt_prob=gt_prob,
+                              zero_unsure=False))
+        q = self.d.inference(t)
+        pred = np.argmax(np.array(q).reshape((self.n_labels, self.h, self.w)),
+                         axis=0)
+
+        if self.scale != 1.:
+            pred = pil_resize(pred.astype(np.uint8), self.size, order=0)
+        return pred
 
 
 def get_strided_size(orig_size, stride):
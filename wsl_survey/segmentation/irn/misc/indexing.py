@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -16,8 +18,26 @@ class PathIndex:
         self.path_indices, self.src_indices, self.dst_indices = self.get_path_indices(
             default_size)
 
+        self.__torch_indices = dict()
+
         return
 
+    def get_torch_path_indices(self, device):
+        key = ('path_indices', str(device))
+        if key not in self.__torch_indices:
+            self.__torch_indices[key] = [
+                torch.from_numpy(p).to(device) for p in self.path_indices
+            ]
+        return self.__torch_indices[key]
+
+    def get_torch_cropped_pairs(self, size, padding, device):
+        key = ('cropped_pairs', tuple(size), padding, str(device))
+        if key not in self.__torch_indices:
+            self.__torch_indices[key] = tuple(
+                torch.from_numpy(a).to(device) for a in crop_pair_indices(
+                    self.src_indices, self.dst_indices, size, padding))
+        return self.__torch_indices[key]
+
     def get_search_paths_dst(self, max_radius=5):
 
         coord_indices_by_length = [[] for _ in range(max_radius * 4)]
@@ -101,18 +121,61 @@ class PathIndex:
         return path_indices, src_indices, dst_indices
 
 
+class PathIndexCache:
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __repr__(self):
+        return 'PathIndexCache(size=%d, capacity=%d, hits=%d, misses=%d)' % (
+            len(self), self.capacity, self.hits, self.misses)
+
+    def get(self, radius, size):
+        key = (radius, tuple(int(s) for s in size))
+
+        if key in self.__entries:
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return self.__entries[key]
+
+        self.misses += 1
+        path_index = PathIndex(radius=radius, default_size=key[1])
+        self.__entries[key] = path_index
+        self.__evict()
+
+        return path_index
+
+    def set_capacity(self, capacity):
+        self.capacity = capacity
+        self.__evict()
+
+    def clear(self):
+        self.__entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __evict(self):
+        while len(self.__entries) > max(self.capacity, 0):
+            self.__entries.popitem(last=False)
+
+
+# process-wide, keyed by (radius, padded feature map size)
+path_index_cache = PathIndexCache()
+
+
 def edge_to_affinity(edge, paths_indices):
     aff_list = []
     edge = edge.view(edge.size(0), -1)
 
-    for i in range(len(paths_indices)):
-        if isinstance(paths_indices[i], np.ndarray):
-            paths_indices[i] = torch.from_numpy(paths_indices[i])
-        paths_indices[i] = paths_indices[i]
-        if use_cuda:
-            paths_indices[i] = paths_indices[i].cuda(non_blocking=True)
-
     for ind in paths_indices:
+        if isinstance(ind, np.ndarray):
+            ind = torch.from_numpy(ind)
+        ind = ind.to(edge.device)
         ind_flat = ind.view(-1)
         dist = torch.index_select(edge, dim=-1, index=ind_flat)
         dist = dist.view(dist.size(0), ind.size(0), ind.size(1), ind.size(2))
@@ -159,20 +222,119 @@ def to_transition_matrix(affinity_dense, beta, times):
     return trans_mat
 
 
-def propagate_to_edge(x, edge, radius=5, beta=10, exp_times=8):
+def crop_pair_indices(ind_from, ind_to, size, padding):
+    # keeps only the pairs inside the unpadded region, so the operator holds
+    # O(H*W) entries instead of the (H*W)^2 dense matrix
+    height, width = size
+    hor_padded = width + padding * 2
+
+    ind_from = np.tile(ind_from, ind_to.shape[0])
+    ind_to = np.reshape(ind_to, -1)
+
+    y_from, x_from = ind_from // hor_padded, ind_from % hor_padded - padding
+    y_to, x_to = ind_to // hor_padded, ind_to % hor_padded - padding
+
+    inside = (y_from < height) & (x_from >= 0) & (x_from < width) & \
+             (y_to < height) & (x_to >= 0) & (x_to < width)
+
+    return inside, y_from[inside] * width + x_from[inside], \
+           y_to[inside] * width + x_to[inside]
+
+
+def affinity_sparse2cropped_coo(affinity_sparse, inside, ind_from, ind_to,
+                                n_vertices):
+    affinity_sparse = affinity_sparse.view(-1)[inside]
+
+    ind_id = torch.arange(0, n_vertices,
+                          dtype=torch.long,
+                          device=affinity_sparse.device)
+
+    rows = torch.cat([ind_from, ind_id, ind_to])
+    cols = torch.cat([ind_to, ind_id, ind_from])
+    values = torch.cat([
+        affinity_sparse,
+        torch.ones([n_vertices], device=affinity_sparse.device),
+        affinity_sparse
+    ])
+
+    return rows, cols, values
+
+
+def to_sparse_transition_matrix(rows, cols, values, n_vertices, beta):
+    scaled_values = torch.pow(values, beta)
+
+    col_sum = torch.zeros([n_vertices], device=values.device)
+    col_sum.index_add_(0, cols, scaled_values)
+
+    # transposed, so that x @ T can be computed as T^t @ x^t
+    trans_mat_t = torch.sparse_coo_tensor(torch.stack([cols, rows]),
+                                          scaled_values / col_sum[cols],
+                                          (n_vertices, n_vertices))
+
+    return trans_mat_t.coalesce()
+
+
+def random_walk_sparse(x, trans_mat_t, n_steps, tol=None):
+    # x: (C, N), trans_mat_t: sparse (N, N)
+    rw = x.t().contiguous()
+    for _ in range(n_steps):
+        rw_next = torch.sparse.mm(trans_mat_t, rw)
+        if tol is not None and torch.max(torch.abs(rw_next - rw)) < tol:
+            rw = rw_next
+            break
+        rw = rw_next
+
+    return rw.t().contiguous()
+
+
+def propagate_to_edge(x,
+                      edge,
+                      radius=5,
+                      beta=10,
+                      exp_times=8,
+                      sparse=False,
+                      tol=None):
+    """
+    >>> import torch
+    >>> edge = torch.rand((1, 12, 16))
+    >>> x = torch.rand((3, 12, 16))
+    >>> dense = propagate_to_edge(x, edge, radius=5, exp_times=4)
+    >>> sparse = propagate_to_edge(x, edge, radius=5, exp_times=4, sparse=True)
+    >>> bool(torch.allclose(dense, sparse, rtol=1e-3, atol=1e-5))
+    True
+    """
     height, width = x.shape[-2:]
 
     hor_padded = width + radius * 2
     ver_padded = height + radius
 
-    path_index = PathIndex(radius=radius,
-                           default_size=(ver_padded, hor_padded))
+    path_index = path_index_cache.get(radius, (ver_padded, hor_padded))
 
     edge_padded = F.pad(edge, (radius, radius, 0, radius),
                         mode='constant',
                         value=1.0)
-    sparse_aff = edge_to_affinity(torch.unsqueeze(edge_padded, 0),
-                                  path_index.path_indices)
+    sparse_aff = edge_to_affinity(
+        torch.unsqueeze(edge_padded, 0),
+        path_index.get_torch_path_indices(edge.device))
+
+    if sparse:
+        inside, ind_from, ind_to = path_index.get_torch_cropped_pairs(
+            (height, width), radius, edge.device)
+        rows, cols, values = affinity_sparse2cropped_coo(
+            sparse_aff, inside, ind_from, ind_to, height * width)
+        trans_mat_t = to_sparse_transition_matrix(rows, cols, values,
+                                                  height * width, beta)
+
+        x = x.view(-1, height, width) * (1 - edge)
+        x = x.to(values.device)
+
+        rw = random_walk_sparse(x.view(-1, height * width),
+                                trans_mat_t,
+                                n_steps=2**exp_times,
+                                tol=tol)
+        rw = rw.view(rw.size(0), 1, height, width)
+
+        return rw
 
     dense_aff = affinity_sparse2dense(sparse_aff, path_index.src_indices,
                                       path_index.dst_indices,
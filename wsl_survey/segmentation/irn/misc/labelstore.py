@@ -0,0 +1,146 @@
+import json
+import os
+
+import numpy as np
+
+META_NAME = 'meta.json'
+
+
+def is_label_store(path):
+    return os.path.exists(os.path.join(path, META_NAME))
+
+
+def write_label_store(root, names, label_indices, n_classes):
+    """Writes the class indices label_indices[i] of every names[i] as a
+    sorted name index and CSR rows, an image with a single integer label
+    has a row of one index.
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> write_label_store(root, ['b', 'a', 'c'], [[0, 2], [], [1]], 3)
+    >>> store = LabelStore(root)
+    >>> store['b'].tolist(), store.class_indices('a').tolist(), 'd' in store
+    ([1.0, 0.0, 1.0], [], False)
+    >>> store.rows(['c', 'b']).multi_hot().tolist()
+    [[0.0, 1.0, 0.0], [1.0, 0.0, 1.0]]
+    """
+    names = np.asarray([str(name) for name in names])
+    order = np.argsort(names, kind='stable')
+    names = names[order]
+    if len(np.unique(names)) != len(names):
+        raise ValueError('duplicate image names')
+
+    rows = [np.asarray(label_indices[i], np.int64).reshape(-1) for i in order]
+    indptr = np.zeros(len(rows) + 1, np.int64)
+    indptr[1:] = np.cumsum([len(row) for row in rows])
+    indices = np.concatenate(rows) if rows else np.zeros(0, np.int64)
+    if indices.size > 0 and (indices.min() < 0 or indices.max() >= n_classes):
+        raise ValueError('class index out of range')
+
+    os.makedirs(root, exist_ok=True)
+    np.save(os.path.join(root, 'names.npy'), names)
+    np.save(os.path.join(root, 'indptr.npy'), indptr)
+    # the smallest integer type that holds every class index
+    np.save(os.path.join(root, 'indices.npy'),
+            indices.astype(np.min_scalar_type(max(n_classes - 1, 0))))
+    with open(os.path.join(root, META_NAME), 'w') as f:
+        json.dump({'n_classes': int(n_classes), 'n_images': len(names)}, f)
+
+
+class LabelStore:
+    """Memory-mapped class labels of a label store, rows are made dense only
+    for the images asked for."""
+    def __init__(self, root):
+        with open(os.path.join(root, META_NAME)) as f:
+            self.n_classes = json.load(f)['n_classes']
+        self.names = np.load(os.path.join(root, 'names.npy'), mmap_mode='r')
+        self.indptr = np.load(os.path.join(root, 'indptr.npy'),
+                              mmap_mode='r')
+        self.indices = np.load(os.path.join(root, 'indices.npy'),
+                               mmap_mode='r')
+
+    def __len__(self):
+        return len(self.names)
+
+    def positions(self, names):
+        names = np.asarray([str(name) for name in names])
+        pos = np.searchsorted(self.names, names)
+        found = pos < len(self.names)
+        found[found] = self.names[pos[found]] == names[found]
+        if not np.all(found):
+            raise KeyError(str(names[~found][0]))
+        return pos
+
+    def __contains__(self, name):
+        pos = np.searchsorted(self.names, str(name))
+        return bool(pos < len(self.names) and self.names[pos] == str(name))
+
+    def indices_at(self, pos):
+        return np.asarray(self.indices[self.indptr[pos]:self.indptr[pos + 1]])
+
+    def class_indices(self, name):
+        return self.indices_at(self.positions([name])[0])
+
+    def multi_hot_at(self, pos, dtype=np.float32):
+        label = np.zeros(self.n_classes, dtype)
+        label[self.indices_at(pos)] = 1
+        return label
+
+    def __getitem__(self, name):
+        return self.multi_hot_at(self.positions([name])[0])
+
+    def rows(self, names):
+        return LabelRows(self, self.positions(names))
+
+
+class LabelRows:
+    """The labels of a list of images, indexed like the list, as the dense
+    label array of the pickled dicts was."""
+    def __init__(self, store, positions):
+        self.store = store
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, idx):
+        return self.store.multi_hot_at(self.positions[idx])
+
+    def multi_hot(self, dtype=np.float32):
+        out = np.zeros((len(self), self.store.n_classes), dtype)
+        for i, pos in enumerate(self.positions):
+            out[i, self.store.indices_at(pos)] = 1
+        return out
+
+
+def load_label_rows(class_label_path, img_name_list):
+    """The labels of img_name_list from a label store or a pickled
+    {name: multi-hot} .npy dict."""
+    if is_label_store(class_label_path):
+        return LabelStore(class_label_path).rows(img_name_list)
+    cls_labels_dict = np.load(class_label_path, allow_pickle=True).item()
+    return np.array([cls_labels_dict[img_name] for img_name in img_name_list])
+
+
+def convert_npy_to_store(npy_path, root):
+    cls_labels_dict = np.load(npy_path, allow_pickle=True).item()
+    names = list(cls_labels_dict.keys())
+    n_classes = len(np.asarray(cls_labels_dict[names[0]]).reshape(-1)) \
+        if names else 0
+    write_label_store(root, names, [
+        np.flatnonzero(np.asarray(cls_labels_dict[name]).reshape(-1))
+        for name in names
+    ], n_classes)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Converts a pickled {name: multi-hot} cls_labels .npy '
+        'dict into a label store.')
+    parser.add_argument("--npy_path", required=True, type=str)
+    parser.add_argument("--store_dir", required=True, type=str)
+    args = parser.parse_args()
+
+    convert_npy_to_store(args.npy_path, args.store_dir)
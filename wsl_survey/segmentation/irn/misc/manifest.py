@@ -0,0 +1,145 @@
+import glob
+import hashlib
+import json
+import os
+
+MANIFEST_PATTERN = 'manifest-%s.jsonl'
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _is_intact(root, entry):
+    for rel_path, (size, digest) in entry['files'].items():
+        path = os.path.join(root, rel_path)
+        if not os.path.exists(path) or os.path.getsize(path) != size or \
+                file_hash(path) != digest:
+            return False
+    return True
+
+
+def load_manifest(root, verify=False):
+    """Returns the completed entries of all processes that wrote to root.
+
+    With verify, the recorded files are hashed again and entries whose
+    files changed or disappeared are dropped.
+    """
+    manifest = dict()
+    for manifest_path in sorted(
+            glob.glob(os.path.join(root, MANIFEST_PATTERN % '*'))):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by an interrupted writer
+                    continue
+                manifest[entry['name']] = entry
+
+    if verify:
+        manifest = {
+            name: entry
+            for name, entry in manifest.items() if _is_intact(root, entry)
+        }
+    return manifest
+
+
+def filter_pending(img_name_list, roots, key=None, verify=False):
+    """Keeps the names that are not complete in every manifest of roots.
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> with open(os.path.join(root, 'a.png'), 'w') as f:
+    ...     _ = f.write('label')
+    >>> with ManifestWriter(root) as writer:
+    ...     writer.add('a', os.path.join(root, 'a.png'))
+    >>> filter_pending(['a', 'b'], root)
+    ['b']
+    >>> with open(os.path.join(root, 'a.png'), 'w') as f:
+    ...     _ = f.write('lab')
+    >>> filter_pending(['a', 'b'], root, verify=True)
+    ['a', 'b']
+    """
+    if isinstance(roots, str):
+        roots = [roots]
+    manifests = [load_manifest(root, verify) for root in roots]
+
+    return [
+        name for name in img_name_list
+        if any((name if key is None else key(name)) not in manifest
+               for manifest in manifests)
+    ]
+
+
+class ManifestWriter:
+    """Appends one line per finished image to the manifest of one process.
+
+    A line is written only after the files of the image are complete and
+    carries their sizes and hashes, so a file cut short by an interrupted
+    run is never taken as done. Work lists are filtered up front with
+    filter_pending, the writer itself only knows the names it added.
+    """
+    def __init__(self, root, writer_id=0):
+        os.makedirs(root, exist_ok=True)
+
+        self.root = root
+        self.names = set()
+        self.manifest = open(os.path.join(root, MANIFEST_PATTERN % writer_id),
+                             'a')
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, name, *paths):
+        entry = {'name': name, 'files': dict()}
+        for path in paths:
+            rel_path = os.path.relpath(path, self.root)
+            entry['files'][rel_path] = [os.path.getsize(path), file_hash(path)]
+
+        self.manifest.write(json.dumps(entry) + '\n')
+        self.manifest.flush()
+
+        self.names.add(name)
+
+    def close(self):
+        self.manifest.close()
+
+
+def rebuild_manifest(root, suffix, writer_id='rebuilt'):
+    """Records the existing files of root (e.g. outputs of a run that
+    predates the manifest) as complete."""
+    from tqdm import tqdm
+
+    done = load_manifest(root)
+    with ManifestWriter(root, writer_id) as writer:
+        for dirpath, _, filenames in tqdm(list(os.walk(root))):
+            for filename in filenames:
+                if filename.endswith(suffix):
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, root)[:-len(suffix)]
+                    if name not in done:
+                        writer.add(name, path)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Adds the existing output files of a step directory to '
+        'its manifest, so resumed runs skip them.')
+    parser.add_argument("--root", required=True, type=str)
+    parser.add_argument("--suffix", default=".png", type=str)
+    args = parser.parse_args()
+
+    rebuild_manifest(args.root, args.suffix)
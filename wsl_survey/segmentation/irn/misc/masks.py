@@ -0,0 +1,132 @@
+import numpy as np
+
+
+def rle_encode(mask):
+    """Row-major run lengths of a boolean mask, starting with a 0-run.
+
+    >>> rle_encode(np.array([[1, 1, 0], [0, 1, 1]], bool)).tolist()
+    [0, 2, 2, 2]
+    >>> rle_decode(rle_encode(np.array([[0, 1], [1, 1]], bool)), (2, 2))
+    array([[False,  True],
+           [ True,  True]])
+    """
+    flat = np.asarray(mask, bool).reshape(-1)
+    if flat.size == 0:
+        return np.zeros(1, np.int32)
+
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], changes, [flat.size]]))
+    if flat[0]:
+        counts = np.concatenate([[0], counts])
+    return counts.astype(np.int32)
+
+
+def rle_decode(counts, shape):
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(shape)
+
+
+class InstanceMasks:
+    """Instance masks kept as run-length encoded crops of their bounding
+    boxes, a full-size mask is decoded only on request.
+
+    >>> dense = np.zeros((2, 4, 5), bool)
+    >>> dense[0, 1:3, 1:4] = True
+    >>> dense[1, 3, 0] = True
+    >>> masks = InstanceMasks.from_dense(dense)
+    >>> len(masks), masks.bbox.tolist(), masks.areas.tolist()
+    (2, [[1, 1, 3, 4], [3, 0, 4, 1]], [6, 1])
+    >>> bool((masks.to_dense() == dense).all())
+    True
+    >>> bool((InstanceMasks.from_dict(masks.to_dict())[0] == dense[0]).all())
+    True
+    """
+    def __init__(self, size, bbox, counts, offsets):
+        self.size = tuple(int(s) for s in size)
+        # (y_min, x_min, y_max, x_max), max exclusive
+        self.bbox = np.asarray(bbox, np.int32).reshape(-1, 4)
+        self.counts = np.asarray(counts, np.int32)
+        self.offsets = np.asarray(offsets, np.int64)
+
+    @classmethod
+    def from_crops(cls, size, bboxes, crops):
+        counts = [rle_encode(crop) for crop in crops]
+        offsets = np.cumsum([0] + [len(c) for c in counts])
+        counts = np.concatenate(counts) if counts else np.zeros(0, np.int32)
+        return cls(size, bboxes, counts, offsets)
+
+    @classmethod
+    def from_dense(cls, masks):
+        masks = np.asarray(masks, bool)
+        bboxes = []
+        crops = []
+        for mask in masks:
+            ys = np.flatnonzero(mask.any(1))
+            xs = np.flatnonzero(mask.any(0))
+            if ys.size == 0:
+                bbox = (0, 0, 0, 0)
+            else:
+                bbox = (ys[0], xs[0], ys[-1] + 1, xs[-1] + 1)
+            bboxes.append(bbox)
+            crops.append(mask[bbox[0]:bbox[2], bbox[1]:bbox[3]])
+        return cls.from_crops(masks.shape[1:], bboxes, crops)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['size'], d['bbox'], d['rle'], d['rle_offsets'])
+
+    def to_dict(self):
+        return {
+            'size': np.asarray(self.size),
+            'bbox': self.bbox,
+            'rle': self.counts,
+            'rle_offsets': self.offsets
+        }
+
+    def __len__(self):
+        return len(self.bbox)
+
+    @property
+    def areas(self):
+        return np.array([
+            np.sum(self.counts[self.offsets[i] + 1:self.offsets[i + 1]:2])
+            for i in range(len(self))
+        ])
+
+    def crop(self, i):
+        y0, x0, y1, x1 = self.bbox[i]
+        return rle_decode(self.counts[self.offsets[i]:self.offsets[i + 1]],
+                          (y1 - y0, x1 - x0))
+
+    def __getitem__(self, i):
+        y0, x0, y1, x1 = self.bbox[i]
+        mask = np.zeros(self.size, bool)
+        mask[y0:y1, x0:x1] = self.crop(i)
+        return mask
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def to_dense(self):
+        masks = np.zeros((len(self), ) + self.size, bool)
+        for i, (y0, x0, y1, x1) in enumerate(self.bbox):
+            masks[i, y0:y1, x0:x1] = self.crop(i)
+        return masks
+
+
+def save_instances(path, detected):
+    out = {'score': detected['score'], 'class': detected['class']}
+    out.update(detected['mask'].to_dict())
+    np.save(path, out)
+
+
+def load_instances(path):
+    """Loads make_ins_seg_labels output, either format, with the masks as
+    InstanceMasks."""
+    d = np.load(path, allow_pickle=True).item()
+    if 'rle' in d:
+        masks = InstanceMasks.from_dict(d)
+    else:
+        # dense (N, H, W) masks of older runs
+        masks = InstanceMasks.from_dense(d['mask'])
+    return {'score': d['score'], 'class': d['class'], 'mask': masks}
@@ -1,8 +1,14 @@
+import contextlib
 import math
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
 
 import numpy as np
 import torch
-from torch.utils.data import Subset
+import torch.distributed as dist
+from torch.utils.data import Subset, Sampler
 
 
 class PolyOptimizer(torch.optim.SGD):
@@ -27,6 +33,144 @@ class PolyOptimizer(torch.optim.SGD):
 
         self.global_step += 1
 
+    def backward_step(self, loss, precision=None):
+        """zero_grad, backward and step, through the gradient scaler of
+        precision when it has one. A step the scaler skips (inf gradients)
+        still counts, so the poly schedule stays aligned with the data."""
+        self.zero_grad()
+        scaler = None if precision is None else precision.scaler
+        if scaler is None:
+            loss.backward()
+            self.step()
+            return
+
+        global_step = self.global_step
+        scaler.scale(loss).backward()
+        scaler.step(self)
+        scaler.update()
+        if self.global_step == global_step:
+            self.global_step += 1
+
+
+class MixedPrecision:
+    """Autocast for the forward passes of a training loop, bfloat16 on the
+    cpu and float16 with a GradScaler on cuda. Disabled, or on a torch
+    without autocast, everything stays in fp32.
+    """
+    def __init__(self, enabled, device_type='cpu'):
+        self.enabled = enabled and hasattr(torch, 'autocast')
+        if enabled and not self.enabled:
+            print('amp: torch.autocast is not available, training in fp32')
+
+        self.device_type = device_type
+        self.dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+        self.scaler = None
+        if self.enabled and device_type == 'cuda':
+            self.scaler = torch.cuda.amp.GradScaler()
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.suppress()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def __repr__(self):
+        return str(self.dtype).replace('torch.', '') if self.enabled \
+            else 'float32'
+
+
+def channels_last_available():
+    return hasattr(torch, 'channels_last')
+
+
+def to_channels_last(x):
+    """Model or NCHW batch in channels last memory format (a no-op on torch
+    builds without it)."""
+    if not channels_last_available():
+        return x
+    if isinstance(x, torch.Tensor):
+        return x.contiguous(memory_format=torch.channels_last)
+    return x.to(memory_format=torch.channels_last)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def _distributed_worker(local_rank, fn, rank_offset, world_size, args):
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(args.ddp_backend,
+                            rank=rank_offset + local_rank,
+                            world_size=world_size)
+    try:
+        fn(args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch_distributed(fn, args):
+    """Runs fn(args) in every process of a DistributedDataParallel group.
+
+    Started by a launcher (torchrun, torch.distributed.launch) the group is
+    taken from RANK, LOCAL_RANK and WORLD_SIZE, so the same command scales
+    across nodes. Otherwise args.ddp_procs local processes are spawned.
+    """
+    if 'WORLD_SIZE' in os.environ:
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        _distributed_worker(local_rank, fn,
+                            int(os.environ['RANK']) - local_rank,
+                            int(os.environ['WORLD_SIZE']), args)
+        return
+
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(args.ddp_port))
+    torch.multiprocessing.spawn(_distributed_worker,
+                                nprocs=args.ddp_procs,
+                                args=(fn, 0, args.ddp_procs, args),
+                                join=True)
+
+
+def parallelize(model):
+    """DistributedDataParallel inside a process group, DataParallel over
+    the gpus otherwise."""
+    if is_distributed():
+        # the cam and irn nets detach their backbone stages, so those
+        # parameters never get a gradient
+        if torch.cuda.is_available():
+            return torch.nn.parallel.DistributedDataParallel(
+                model.cuda(),
+                device_ids=[torch.cuda.current_device()],
+                find_unused_parameters=True)
+        return torch.nn.parallel.DistributedDataParallel(
+            model, find_unused_parameters=True)
+
+    if torch.cuda.is_available():
+        return torch.nn.DataParallel(model).cuda()
+    return model
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(tensor):
+    if is_distributed():
+        dist.all_reduce(tensor)
+    return tensor
+
 
 class SGDROptimizer(torch.optim.SGD):
     def __init__(self,
@@ -73,6 +217,135 @@ def split_dataset(dataset, n_splits):
     ]
 
 
+class WorkQueue:
+    """Hands out work items to whichever process asks next.
+
+    Unlike split_dataset, no process is bound to a fixed shard, so a process
+    that gets cheap images simply pulls more of them. The sampler only hands
+    out the items, the DataLoader prefetches some, so the processes report
+    finished items with task_done once their outputs are written.
+
+    >>> queue = WorkQueue(5, n_procs=2)
+    >>> queue.get(0), queue.get(1)
+    (0, 1)
+    >>> list(queue.sampler(1))
+    [2, 3, 4]
+    >>> queue.task_done(1)
+    >>> queue.done(1), queue.done(0)
+    (1, 0)
+    >>> queue = WorkQueue(2, n_procs=1, timers=('crf', ))
+    >>> list(queue.sampler(0, items=[[0, 2], [1]]))
+    [[0, 2], [1]]
+    >>> queue.add_time(0, 'crf', 1.5)
+    >>> queue.timer_total('crf')
+    1.5
+    """
+    def __init__(self, n_items, n_procs, timers=()):
+        ctx = multiprocessing.get_context('spawn')
+
+        self.n_items = n_items
+        self.n_procs = n_procs
+        self.__next = ctx.Value('l', 0)
+        self.__done = ctx.Array('l', n_procs)
+        # first pull and last finished item, per process
+        self.__start = ctx.Array('d', n_procs)
+        self.__end = ctx.Array('d', n_procs)
+        # time spent in named stages of the items, per process
+        self.__timers = {name: ctx.Array('d', n_procs) for name in timers}
+
+    def __len__(self):
+        return self.n_items
+
+    def get(self, process_id):
+        with self.__next.get_lock():
+            i = self.__next.value
+            if i >= self.n_items:
+                return None
+            self.__next.value = i + 1
+        return i
+
+    def start(self, process_id):
+        with self.__start.get_lock():
+            if self.__start[process_id] == 0:
+                self.__start[process_id] = time.time()
+
+    def task_done(self, process_id, n=1):
+        with self.__done.get_lock():
+            self.__done[process_id] += n
+            self.__end[process_id] = time.time()
+
+    def done(self, process_id):
+        return self.__done[process_id]
+
+    def elapsed(self, process_id):
+        if self.__done[process_id] == 0:
+            return 0.
+        return self.__end[process_id] - self.__start[process_id]
+
+    def add_time(self, process_id, name, elapsed):
+        timer = self.__timers[name]
+        with timer.get_lock():
+            timer[process_id] += elapsed
+
+    def timer_total(self, name):
+        return sum(self.__timers[name][:])
+
+    def sampler(self, process_id, items=None):
+        return WorkQueueSampler(self, process_id, items)
+
+    def __repr__(self):
+        lines = []
+        for process_id in range(self.n_procs):
+            done = self.done(process_id)
+            elapsed = self.elapsed(process_id)
+            line = 'process %d: %d items, %.1fs, %.2f items/s' % (
+                process_id, done, elapsed, done / elapsed if elapsed > 0 else 0)
+            for name, timer in self.__timers.items():
+                line += ', %s %.1fs' % (name, timer[process_id])
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+class WorkQueueSampler(Sampler):
+    """Yields the indices (or items[index], e.g. batches) pulled from a
+    WorkQueue until it runs dry, the DataLoader prefetches a few of them."""
+    def __init__(self, queue, process_id, items=None):
+        self.queue = queue
+        self.process_id = process_id
+        self.items = items
+
+    def __iter__(self):
+        self.queue.start(self.process_id)
+        while True:
+            i = self.queue.get(self.process_id)
+            if i is None:
+                break
+            yield i if self.items is None else self.items[i]
+
+
+class SizeBucketBatchSampler(Sampler):
+    """
+    >>> sizes = [(2, 3), (4, 5), (2, 3), (2, 3), (4, 5)]
+    >>> list(SizeBucketBatchSampler(sizes, batch_size=2))
+    [[0, 2], [3], [1, 4]]
+    """
+    def __init__(self, sizes, batch_size):
+        buckets = OrderedDict()
+        for i, size in enumerate(sizes):
+            buckets.setdefault(tuple(size), []).append(i)
+
+        self.batches = [
+            bucket[i:i + batch_size] for bucket in buckets.values()
+            for i in range(0, len(bucket), batch_size)
+        ]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
 def gap2d(x, keepdims=False):
     out = torch.mean(x.view(x.size(0), x.size(1), -1), -1)
     if keepdims:
@@ -1,13 +1,52 @@
 import numpy as np
+import multiprocessing
 import os
 from functools import partial
 from multiprocessing.pool import Pool
+from multiprocessing.util import Finalize
 from numpy import newaxis
 from scipy import ndimage
 from skimage.morphology import erosion, opening, closing, dilation
 from skimage.morphology import square
 from tqdm import tqdm
 
+from wsl_survey.segmentation.irn.misc import camstore
+
+MORPH_SUFFIXES = ('_eroded', '_dilated', '_opened', '_closed', '_gaussian')
+
+_cam_readers = dict()
+_cam_writers = dict()
+# per pool worker, set by _init_worker
+_state = dict(writer_id=0)
+
+
+def _get_cam_reader(folder):
+    if folder not in _cam_readers:
+        _cam_readers[folder] = camstore.open_cam_reader(folder)
+    return _cam_readers[folder]
+
+
+def _get_cam_writer(folder, cam_format):
+    if folder not in _cam_writers:
+        _cam_writers[folder] = camstore.open_cam_writer(
+            folder, cam_format, writer_id=_state['writer_id'])
+    return _cam_writers[folder]
+
+
+def _close_cam_writers():
+    for cam_writer in _cam_writers.values():
+        cam_writer.close()
+    _cam_writers.clear()
+
+
+def _init_worker(next_writer_id):
+    # the pool workers number themselves, every one appends to its own
+    # store shards and closes them when it exits
+    with next_writer_id.get_lock():
+        _state['writer_id'] = next_writer_id.value
+        next_writer_id.value += 1
+    Finalize(None, _close_cam_writers, exitpriority=10)
+
 
 def apply_morphology(imgs):
     selem = square(kernel_size)
@@ -26,15 +65,8 @@ def apply_morphology(imgs):
             closeds, axis=0), np.concatenate(gaussians, axis=0)
 
 
-def create_morph(img_name, folder):
-    eroded_folder = folder + '_eroded'
-    dilated_folder = folder + '_dilated'
-    opened_folder = folder + '_opened'
-    closed_folder = folder + '_closed'
-    gaussian_folder = folder + '_gaussian'
-
-    cam_dict = np.load(os.path.join(folder, img_name),
-                       allow_pickle=True).item()
+def create_morph(img_name, folder, cam_format='npy'):
+    cam_dict = dict(_get_cam_reader(folder)[img_name])
 
     eroded, dilated, opened, closed, gaussians = apply_morphology(
         cam_dict['high_res'])
@@ -43,48 +75,38 @@ def create_morph(img_name, folder):
     assert cam_dict[
         'high_res'].shape == eroded.shape == dilated.shape == opened.shape == closed.shape == gaussians.shape
 
-    cam_dict['high_res'] = eroded
-    cam_dict['cam'] = eroded1
-    np.save(os.path.join(eroded_folder, img_name), cam_dict)
-    cam_dict['high_res'] = dilated
-    cam_dict['cam'] = dilated1
-    np.save(os.path.join(dilated_folder, img_name), cam_dict)
-    cam_dict['high_res'] = opened
-    cam_dict['cam'] = opened1
-    np.save(os.path.join(opened_folder, img_name), cam_dict)
-    cam_dict['high_res'] = closed
-    cam_dict['cam'] = closed1
-    np.save(os.path.join(closed_folder, img_name), cam_dict)
-    cam_dict['high_res'] = gaussians
-    cam_dict['cam'] = gaussians1
-    np.save(os.path.join(gaussian_folder, img_name), cam_dict)
+    for suffix, high_res, cam in zip(
+            MORPH_SUFFIXES, (eroded, dilated, opened, closed, gaussians),
+            (eroded1, dilated1, opened1, closed1, gaussians1)):
+        cam_dict['high_res'] = high_res
+        cam_dict['cam'] = cam
+        _get_cam_writer(folder + suffix, cam_format).write(
+            img_name, **cam_dict)
     return True
 
 
-def apply(folder):
+def apply(folder, cam_format='npy'):
     grayscaled_folder = folder + '_grayscaled'
-    eroded_folder = folder + '_eroded'
-    dilated_folder = folder + '_dilated'
-    opened_folder = folder + '_opened'
-    closed_folder = folder + '_closed'
-    gaussian_folder = folder + '_gaussian'
-
     os.makedirs(grayscaled_folder, exist_ok=True)
-    os.makedirs(eroded_folder, exist_ok=True)
-    os.makedirs(dilated_folder, exist_ok=True)
-    os.makedirs(opened_folder, exist_ok=True)
-    os.makedirs(closed_folder, exist_ok=True)
-    os.makedirs(gaussian_folder, exist_ok=True)
-
-    paths = os.listdir(folder)
-    create_morph(paths[0], folder=folder)
-    with Pool(processes=16) as pool:
+    for suffix in MORPH_SUFFIXES:
+        os.makedirs(folder + suffix, exist_ok=True)
+
+    paths = _get_cam_reader(folder).keys()
+    with Pool(processes=16,
+              initializer=_init_worker,
+              initargs=(multiprocessing.Value('l', 0), )) as pool:
         with tqdm(total=len(paths)) as pbar:
             for i, _ in tqdm(
                     enumerate(
                         pool.imap_unordered(
-                            partial(create_morph, folder=folder), paths))):
+                            partial(create_morph,
+                                    folder=folder,
+                                    cam_format=cam_format), paths))):
                 pbar.update()
+        # let the workers exit, and close their writers, before the pool
+        # is terminated
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
@@ -94,10 +116,14 @@ if __name__ == '__main__':
 
     # Environment
     parser.add_argument("--kernel_size", type=int, default=5)
+    parser.add_argument("--cam_format",
+                        type=str,
+                        default="npy",
+                        choices=["npy", "store"])
     args = parser.parse_args()
     kernel_size = args.kernel_size
-    apply('./outputs/voc12/results/resnet152/cam')
-    apply('./outputs/voc12/results/resnet152/cam_val')
+    apply('./outputs/voc12/results/resnet152/cam', args.cam_format)
+    apply('./outputs/voc12/results/resnet152/cam_val', args.cam_format)
     # apply('/Users/cenk.bircanoglu/wsl/wsl_survey/results/resnet101/cam')
     # apply('/Users/cenk.bircanoglu/wsl/wsl_survey/results/resnet101/cam_val')
     # apply('/Users/cenk.bircanoglu/wsl/wsl_survey/results/resnet154/cam')
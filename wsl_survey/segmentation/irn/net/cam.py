@@ -73,3 +73,21 @@ class CAM(Net):
         x = x[0] + x[1].flip(-1)
 
         return x
+
+    def forward_msf(self, x):
+        # x holds (image, flipped image) pairs of several images
+        # stacked along the batch axis
+        x = self.stage1(x)
+
+        x = self.stage2(x)
+
+        x = self.stage3(x)
+        x = self.stage4(x)
+
+        x = F.conv2d(x, self.classifier.weight)
+        x = F.relu(x)
+
+        x = x.view(-1, 2, x.size(1), x.size(2), x.size(3))
+        x = x[:, 0] + x[:, 1].flip(-1)
+
+        return x
@@ -138,7 +138,7 @@ class AffinityDisplacementLoss(Net):
 
     def to_affinity(self, edge):
         aff_list = []
-        edge = edge.view(edge.size(0), -1)
+        edge = edge.reshape(edge.size(0), -1)
 
         for i in range(self.n_path_lengths):
             ind = self._buffers[AffinityDisplacementLoss.path_indices_prefix +
@@ -172,8 +172,8 @@ class AffinityDisplacementLoss(Net):
         disp_dst = torch.stack(disp_dst, 2)
 
         pair_disp = torch.unsqueeze(disp_src, 2) - disp_dst
-        pair_disp = pair_disp.view(pair_disp.size(0), pair_disp.size(1),
-                                   pair_disp.size(2), -1)
+        pair_disp = pair_disp.reshape(pair_disp.size(0), pair_disp.size(1),
+                                      pair_disp.size(2), -1)
 
         return pair_disp
 
@@ -181,7 +181,10 @@ class AffinityDisplacementLoss(Net):
         return torch.abs(pair_disp - self.disp_target)
 
     def forward(self, *inputs):
-        x, return_loss = inputs
+        # an optional third input also returns the (N, 2) mean displacement
+        # of every image, for the mean shift
+        x, return_loss = inputs[:2]
+        return_dp_mean = len(inputs) > 2 and inputs[2]
         edge_out, dp_out = super().forward(x)
 
         if return_loss is False:
@@ -195,6 +198,10 @@ class AffinityDisplacementLoss(Net):
         dp_fg_loss = self.to_displacement_loss(pair_disp)
         dp_bg_loss = torch.abs(pair_disp)
 
+        if return_dp_mean:
+            return pos_aff_loss, neg_aff_loss, dp_fg_loss, dp_bg_loss, \
+                torch.mean(dp_out.detach(), dim=(2, 3))
+
         return pos_aff_loss, neg_aff_loss, dp_fg_loss, dp_bg_loss
 
 
@@ -65,7 +65,8 @@ def run(args):
         hor_flip=True,
         crop_size=512,
         crop_method="random",
-        class_label_dict_path=args.class_label_dict_path)
+        class_label_dict_path=args.class_label_dict_path,
+        img_cache=args.img_cache_dir)
     print('[ ', end='')
     _work_cpu_1(model, dataset, args)
     print(']')
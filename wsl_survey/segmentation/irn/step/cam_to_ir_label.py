@@ -1,87 +1,83 @@
 import os
+import time
 
-import cv2
 import imageio
 import numpy as np
 from torch import multiprocessing
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from wsl_survey.segmentation.irn.misc import torchutils, imutils
+from wsl_survey.segmentation.irn.misc import torchutils, imutils, camstore, \
+    manifest, bboxes
 from wsl_survey.segmentation.irn.voc12 import dataloader
 
 
-def generate_bbox(path, output_path):
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    mask_img = cv2.imread(path)
-    ret, threshed_img = cv2.threshold(cv2.cvtColor(mask_img, cv2.COLOR_BGR2GRAY), 100, 255, cv2.THRESH_BINARY)
-    kernel = np.ones((3, 3), np.uint8)
-    closing = cv2.morphologyEx(threshed_img, cv2.MORPH_CLOSE, kernel, iterations=8)
-
-    contours, hierarchy = cv2.findContours(closing, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    biggest_area = float('-inf')
-    x, y, w, h = None, None, None, None
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
-        if area > biggest_area:
-            biggest_area = area
-            x, y, w, h = cv2.boundingRect(cnt)
-    with open(output_path, mode='w') as f:
-        f.write('%s\t%s\t%s\t%s\n' % (x, y, w, h))
-
-
-def _work(process_id, infer_dataset, args):
-    databin = infer_dataset[process_id]
-    infer_data_loader = DataLoader(databin,
-                                   shuffle=False,
+def make_ir_label(img, cams, keys, args):
+    keys = np.pad(keys + 1, (1, 0), mode='constant')
+
+    # the fg and bg hypotheses share the pairwise terms of the image
+    crf = imutils.DenseCRF(img, n_labels=keys.shape[0], scale=args.crf_scale)
+
+    # 1. find confident fg & bg
+    fg_conf_cam = np.pad(cams, ((1, 0), (0, 0), (0, 0)),
+                         mode='constant',
+                         constant_values=args.conf_fg_thres)
+    fg_conf_cam = np.argmax(fg_conf_cam, axis=0)
+    fg_conf = keys[crf.inference_label(fg_conf_cam)]
+
+    bg_conf_cam = np.pad(cams, ((1, 0), (0, 0), (0, 0)),
+                         mode='constant',
+                         constant_values=args.conf_bg_thres)
+    bg_conf_cam = np.argmax(bg_conf_cam, axis=0)
+    bg_conf = keys[crf.inference_label(bg_conf_cam)]
+
+    # 2. combine confident fg & bg
+    conf = fg_conf.copy()
+    conf[fg_conf == 0] = 255
+    conf[bg_conf + fg_conf == 0] = 0
+
+    return conf
+
+
+def _work(process_id, infer_dataset, work_queue, args):
+    infer_data_loader = DataLoader(infer_dataset,
+                                   sampler=work_queue.sampler(process_id),
                                    num_workers=0,
                                    pin_memory=False)
-
-    for iter, pack in tqdm(enumerate(infer_data_loader), total=len(databin)):
+    cam_reader = camstore.open_cam_reader(args.cam_out_dir)
+    manifest_writer = manifest.ManifestWriter(args.ir_label_out_dir,
+                                              process_id)
+    bbox_writer = None
+    if args.bbox_out_dir is not None:
+        bbox_writer = bboxes.BboxWriter(args.bbox_out_dir, process_id)
+
+    for iter, pack in tqdm(enumerate(infer_data_loader)):
         try:
             img_name = dataloader.decode_int_filename(pack['name'][0])
             path = os.path.join(args.ir_label_out_dir, img_name + '.png')
-            bbox_path = os.path.join(args.bbox_out_dir, img_name + '.txt')
-            if not os.path.exists(path):
+            if img_name not in manifest_writer:
                 os.makedirs(os.path.dirname(path), exist_ok=True)
                 img = pack['img'][0].numpy()
-                cam_dict = np.load(os.path.join(args.cam_out_dir, img_name + '.npy'),
-                                   allow_pickle=True).item()
-
-                cams = cam_dict['high_res']
-                keys = np.pad(cam_dict['keys'] + 1, (1, 0), mode='constant')
-                # 1. find confident fg & bg
-                fg_conf_cam = np.pad(cams, ((1, 0), (0, 0), (0, 0)),
-                                     mode='constant',
-                                     constant_values=args.conf_fg_thres)
-                fg_conf_cam = np.argmax(fg_conf_cam, axis=0)
-                pred = imutils.crf_inference_label(img,
-                                                   fg_conf_cam,
-                                                   n_labels=keys.shape[0])
-                fg_conf = keys[pred]
-
-                bg_conf_cam = np.pad(cams, ((1, 0), (0, 0), (0, 0)),
-                                     mode='constant',
-                                     constant_values=args.conf_bg_thres)
-                bg_conf_cam = np.argmax(bg_conf_cam, axis=0)
-                pred = imutils.crf_inference_label(img,
-                                                   bg_conf_cam,
-                                                   n_labels=keys.shape[0])
-                bg_conf = keys[pred]
-
-                # 2. combine confident fg & bg
-                conf = fg_conf.copy()
-                conf[fg_conf == 0] = 255
-                conf[bg_conf + fg_conf == 0] = 0
-
-                imageio.imwrite(path, conf.astype(np.uint8))
-
-                if process_id == args.num_workers - 1 and iter % (len(databin) //
-                                                                  20) == 0:
-                    print("%d " % ((5 * iter + 1) // (len(databin) // 20)), end='')
-            generate_bbox(path, bbox_path)
+                cam_dict = cam_reader[img_name]
+
+                t = time.time()
+                conf = make_ir_label(img, cam_dict['high_res'],
+                                     cam_dict['keys'], args)
+                work_queue.add_time(process_id, 'crf', time.time() - t)
+
+                conf = conf.astype(np.uint8)
+                imageio.imwrite(path, conf)
+                if bbox_writer is not None:
+                    bbox_writer.write(img_name, bboxes.largest_bbox(conf))
+                manifest_writer.add(img_name, path)
         except Exception as e:
             print(e)
+        work_queue.task_done(process_id)
+
+    manifest_writer.close()
+    if bbox_writer is not None:
+        bbox_writer.close()
+
 
 def run(args):
     assert args.voc12_root is not None
@@ -89,18 +85,29 @@ def run(args):
     assert args.ir_label_out_dir is not None
     assert args.cam_out_dir is not None
 
-    dataset = dataloader.VOC12ImageDataset(args.train_list,
+    # skip finished images before the dataset is built
+    img_name_list = manifest.filter_pending(
+        dataloader.load_img_name_list(args.train_list),
+        args.ir_label_out_dir,
+        key=dataloader.decode_int_filename,
+        verify=args.manifest_verify)
+
+    dataset = dataloader.VOC12ImageDataset(img_name_list,
                                            voc12_root=args.voc12_root,
                                            img_normal=None,
-                                           to_torch=False)
-    dataset = torchutils.split_dataset(dataset, args.num_workers)
+                                           to_torch=False,
+                                           img_cache=args.img_cache_dir)
+    work_queue = torchutils.WorkQueue(len(dataset),
+                                      args.num_workers,
+                                      timers=('crf', ))
 
     print('[ ', end='')
     multiprocessing.spawn(_work,
                           nprocs=args.num_workers,
-                          args=(dataset, args),
+                          args=(dataset, work_queue, args),
                           join=True)
     print(']')
+    print(work_queue)
 
 
 if __name__ == '__main__':
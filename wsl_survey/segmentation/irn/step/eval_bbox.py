@@ -1,42 +1,59 @@
 import os
-from statistics import mean
 
-from tqdm import tqdm
 import numpy as np
+
+from wsl_survey.segmentation.irn.misc import bboxes, labelstore
 from wsl_survey.segmentation.irn.voc12 import dataloader
-from wsl_survey.utils.iou import bb_intersection_over_union
+from wsl_survey.utils.iou import box_iou
+
+
+def _load_gt_bboxes(voc12_root, img_names):
+    """(N, 4) xyxy boxes from the last line of the label txt of every
+    image, nan where it is missing."""
+    gt = np.full((len(img_names), 4), np.nan)
+    for i, img_name in enumerate(img_names):
+        bbox_org_path = os.path.join(voc12_root,
+                                     img_name.replace('image', 'label') + '.txt')
+        try:
+            with open(bbox_org_path, mode='r') as f:
+                gt[i] = [float(v) for v in f.readlines()[-1].strip().split(' ')]
+        except Exception:
+            pass
+    return gt
 
 
 def run(args):
     assert args.voc12_root is not None
+    assert args.bbox_out_dir is not None
 
-    dataset = dataloader.VOC12ImageDataset(args.infer_list,
-                                           voc12_root=args.voc12_root,
-                                           img_normal=None,
-                                           to_torch=False)
-
-    preds = []
-    preds_dict = {}
-    error_cnt = 0
-    label_dict = np.load(args.class_label_dict_path, allow_pickle=True).item()
-    for data in tqdm(dataset):
-        img_name = data['name']
-        label = np.argmax(label_dict[img_name])
-        bbox_org_path = os.path.join(args.voc12_root, img_name.replace('image', 'label') + '.txt')
-        try:
-            with open(bbox_org_path, mode='r') as f:
-                bbox_org = f.readlines()[-1].strip().split(' ')
-            bbox_path = os.path.join(args.bbox_out_dir, img_name + '.txt')
-            with open(bbox_path, mode='r') as f:
-                bbox = f.readlines()[0].strip().split('\t')
-            iou = bb_intersection_over_union(bbox, bbox_org)
-            preds.append(iou)
-            preds_dict.setdefault(label, []).append(iou)
-        except Exception as e:
-            error_cnt += 1
-
-    print({'miou': mean(preds)}, len(preds), error_cnt, args.bbox_out_dir)
-    print({key: mean(value) for key, value in preds_dict.items()})
+    img_names = np.array([
+        dataloader.decode_int_filename(name)
+        for name in dataloader.load_img_name_list(args.infer_list)
+    ])
+    label_rows = labelstore.load_label_rows(args.class_label_dict_path,
+                                            img_names)
+    labels = np.array(
+        [np.argmax(label_rows[i]) for i in range(len(img_names))])
+
+    names, pred = bboxes.load_bboxes(args.bbox_out_dir)
+    index = dict(zip(names, range(len(names))))
+    pred = np.array([
+        pred[index[name]] if name in index else [np.nan] * 4
+        for name in img_names
+    ]).reshape(-1, 4)
+    gt = _load_gt_bboxes(args.voc12_root, img_names)
+
+    valid = ~(np.isnan(pred).any(axis=1) | np.isnan(gt).any(axis=1))
+    # predictions are xywh, the ground truth xyxy, both in whole pixels
+    iou = box_iou(np.trunc(pred[valid]), np.trunc(gt[valid]), fmt_a='xywh')
+    labels = labels[valid]
+    error_cnt = len(img_names) - len(iou)
+
+    print({'miou': np.mean(iou)}, len(iou), error_cnt, args.bbox_out_dir)
+    print({
+        label: np.mean(iou[labels == label])
+        for label in np.unique(labels).tolist()
+    })
 
 
 if __name__ == '__main__':
@@ -1,10 +1,40 @@
 import os
+from multiprocessing.pool import Pool
 
 import numpy as np
 from chainercv.datasets import VOCSemanticSegmentationDataset
-from chainercv.evaluations import calc_semantic_segmentation_confusion
 from tqdm import tqdm
 
+from wsl_survey.segmentation.irn.misc import camstore, evaluation
+
+
+def cam_to_label(cam_dict, thres):
+    cams = np.pad(cam_dict['high_res'], ((1, 0), (0, 0), (0, 0)),
+                  mode='constant',
+                  constant_values=thres)
+    keys = np.pad(cam_dict['keys'] + 1, (1, 0), mode='constant')
+    cls_labels = np.argmax(cams, axis=0)
+    return keys[cls_labels]
+
+
+# per pool process, set by _init_worker
+_state = dict()
+
+
+def _init_worker(dataset, cam_out_dir, thresholds, n_class):
+    _state.update(dataset=dataset,
+                  cam_reader=camstore.open_cam_reader(cam_out_dir),
+                  thresholds=thresholds,
+                  n_class=n_class)
+
+
+def _work(i):
+    dataset = _state['dataset']
+    gt = dataset.get_example_by_keys(i, (1, ))[0]
+    cam_dict = _state['cam_reader'][dataset.ids[i]]
+    return evaluation.cam_sweep_confusion(cam_dict, gt, _state['thresholds'],
+                                          _state['n_class'])
+
 
 def run(args):
     assert args.voc12_root is not None
@@ -13,31 +43,39 @@ def run(args):
 
     dataset = VOCSemanticSegmentationDataset(split=args.chainer_eval_set,
                                              data_dir=args.voc12_root)
-    labels = [
-        dataset.get_example_by_keys(i, (1, ))[0] for i in range(len(dataset))
-    ]
-
-    preds = []
-    for id in tqdm(dataset.ids):
-        cam_dict = np.load(os.path.join(args.cam_out_dir, id + '.npy'),
-                           allow_pickle=True).item()
-        cams = cam_dict['high_res']
-        cams = np.pad(cams, ((1, 0), (0, 0), (0, 0)),
-                      mode='constant',
-                      constant_values=args.cam_eval_thres)
-        keys = np.pad(cam_dict['keys'] + 1, (1, 0), mode='constant')
-        cls_labels = np.argmax(cams, axis=0)
-        cls_labels = keys[cls_labels]
-        preds.append(cls_labels.copy())
-    confusion = calc_semantic_segmentation_confusion(preds, labels)
-
-    gtj = confusion.sum(axis=1)
-    resj = confusion.sum(axis=0)
-    gtjresj = np.diag(confusion)
-    denominator = gtj + resj - gtjresj
-    iou = gtjresj / denominator
-
-    print({'iou': iou, 'miou': np.nanmean(iou)})
+
+    thresholds = args.cam_eval_thres_sweep or [args.cam_eval_thres]
+    n_class = args.num_classes + 1
+
+    # one pass over the cams, the confusion of every threshold is summed
+    # image by image
+    confusion = np.zeros((len(thresholds), n_class, n_class), np.int64)
+    init_args = (dataset, args.cam_out_dir, thresholds, n_class)
+    with Pool(processes=min(args.num_workers, os.cpu_count()),
+              initializer=_init_worker,
+              initargs=init_args) as pool:
+        for c in tqdm(pool.imap_unordered(_work, range(len(dataset)),
+                                          chunksize=8),
+                      total=len(dataset)):
+            confusion += c
+
+    results = []
+    for thres, c in zip(thresholds, confusion):
+        iou = evaluation.iou_from_confusion(c)
+        results.append({'thres': thres, 'iou': iou, 'miou': np.nanmean(iou)})
+
+    if len(results) == 1:
+        print({'iou': results[0]['iou'], 'miou': results[0]['miou']})
+    else:
+        for result in results:
+            print('thres %.3f miou %.4f' % (result['thres'], result['miou']))
+        best = max(results, key=lambda r: r['miou'])
+        print('best thres %.3f' % best['thres'], {
+            'iou': best['iou'],
+            'miou': best['miou']
+        })
+
+    return results
 
 
 if __name__ == '__main__':
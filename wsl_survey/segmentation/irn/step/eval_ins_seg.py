@@ -1,10 +1,11 @@
 import os
 
 import chainercv
-import numpy as np
 from chainercv.datasets import VOCInstanceSegmentationDataset
 from tqdm import tqdm
 
+from wsl_survey.segmentation.irn.misc import masks
+
 
 def run(args):
     assert args.voc12_root is not None
@@ -24,14 +25,19 @@ def run(args):
     pred_mask = []
     pred_score = []
     for id in tqdm(dataset.ids):
-        ins_out = np.load(os.path.join(args.ins_seg_out_dir, id + '.npy'),
-                          allow_pickle=True).item()
+        ins_out = masks.load_instances(
+            os.path.join(args.ins_seg_out_dir, id + '.npy'))
         pred_class.append(ins_out['class'])
         pred_mask.append(ins_out['mask'])
         pred_score.append(ins_out['score'])
+
+    def dense_pred_mask():
+        # full-size masks of one image at a time
+        return (m.to_dense() for m in pred_mask)
+
     print(
         '0.5iou:',
-        chainercv.evaluations.eval_instance_segmentation_voc(pred_mask,
+        chainercv.evaluations.eval_instance_segmentation_voc(dense_pred_mask(),
                                                              pred_class,
                                                              pred_score,
                                                              gt_masks,
@@ -39,7 +45,7 @@ def run(args):
                                                              iou_thresh=0.5))
     print(
         '0.7iou:',
-        chainercv.evaluations.eval_instance_segmentation_voc(pred_mask,
+        chainercv.evaluations.eval_instance_segmentation_voc(dense_pred_mask(),
                                                              pred_class,
                                                              pred_score,
                                                              gt_masks,
@@ -3,8 +3,24 @@ import os
 import imageio
 import numpy as np
 from chainercv.datasets import VOCSemanticSegmentationDataset
-from chainercv.evaluations import calc_semantic_segmentation_confusion
-from tqdm import tqdm
+
+from wsl_survey.segmentation.irn.misc import evaluation
+
+# per pool worker, set by _init_worker
+_state = dict()
+
+
+def _init_worker(dataset, sem_seg_out_dir):
+    _state.update(dataset=dataset, sem_seg_out_dir=sem_seg_out_dir)
+
+
+def _load_pair(i):
+    dataset = _state['dataset']
+    name = dataset.ids[i]
+    cls_labels = imageio.imread(
+        os.path.join(_state['sem_seg_out_dir'], name + '.png')).astype(np.uint8)
+    cls_labels[cls_labels == 255] = 0
+    return name, cls_labels, dataset.get_example_by_keys(i, (1, ))[0]
 
 
 def run(args):
@@ -14,30 +30,25 @@ def run(args):
 
     dataset = VOCSemanticSegmentationDataset(split=args.chainer_eval_set,
                                              data_dir=args.voc12_root)
-    labels = [
-        dataset.get_example_by_keys(i, (1, ))[0] for i in range(len(dataset))
-    ]
-
-    preds = []
-    for id in tqdm(dataset.ids):
-        cls_labels = imageio.imread(
-            os.path.join(args.sem_seg_out_dir, id + '.png')).astype(np.uint8)
-        cls_labels[cls_labels == 255] = 0
-        preds.append(cls_labels.copy())
-    confusion = calc_semantic_segmentation_confusion(preds, labels)[:21, :21]
-
-    gtj = confusion.sum(axis=1)
-    resj = confusion.sum(axis=0)
-    gtjresj = np.diag(confusion)
-    denominator = gtj + resj - gtjresj
-    fp = 1. - gtj / denominator
-    fn = 1. - resj / denominator
-    iou = gtjresj / denominator
 
+    with evaluation.SemSegEvaluator(args.num_classes + 1,
+                                    args.eval_per_image_out) as evaluator:
+        evaluator.evaluate(_load_pair,
+                           len(dataset),
+                           num_workers=min(args.num_workers, os.cpu_count()),
+                           threads=args.eval_threads,
+                           initializer=_init_worker,
+                           initargs=(dataset, args.sem_seg_out_dir))
+    scores = evaluator.scores()
+    fp, fn, iou = scores['fp'], scores['fn'], scores['iou']
+
+    print(evaluator)
     print(fp[0], fn[0])
     print(np.mean(fp[1:]), np.mean(fn[1:]))
 
-    print({'iou': iou, 'miou': np.nanmean(iou)})
+    print({'iou': iou, 'miou': scores['miou']})
+
+    return scores
 
 
 if __name__ == '__main__':
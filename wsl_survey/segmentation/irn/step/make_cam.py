@@ -1,7 +1,6 @@
 import importlib
 import os
 
-import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import multiprocessing, cuda
@@ -9,36 +8,49 @@ from torch.backends import cudnn
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from wsl_survey.segmentation.irn.misc import torchutils, imutils
+from wsl_survey.segmentation.irn.misc import torchutils, imutils, camstore
 from wsl_survey.segmentation.irn.voc12 import dataloader
 
 cudnn.enabled = True
 use_gpu = torch.cuda.is_available()
 
 
-def _work_cpu(process_id, model, dataset, args):
-    databin = dataset[process_id]
+def msf_imgs(pack, args, device):
+    """The scaled images and flips of pack, built on device from the scale
+    1.0 image with cam_device_pyramid."""
+    if not args.cam_device_pyramid:
+        return pack['img']
+    return dataloader.make_msf_pyramid(
+        pack['img'].to(device, non_blocking=True), args.cam_scales)
 
-    data_loader = DataLoader(databin,
-                             shuffle=False,
+
+def _work_cpu(process_id, model, dataset, work_queue, args):
+    data_loader = DataLoader(dataset,
+                             sampler=work_queue.sampler(process_id),
                              num_workers=16,
                              pin_memory=False)
 
+    cam_writer = camstore.open_cam_writer(args.cam_out_dir,
+                                          args.cam_format,
+                                          writer_id=process_id,
+                                          precision=args.cam_precision)
+
     with torch.no_grad():
 
-        for iter, pack in tqdm(enumerate(data_loader), total=len(databin)):
+        for iter, pack in tqdm(enumerate(data_loader)):
             try:
                 img_name = pack['name'][0]
-                path = os.path.join(args.cam_out_dir, img_name + '.npy')
-                if not os.path.exists(path):
-                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                if img_name not in cam_writer:
                     label = pack['label'][0]
                     size = pack['size']
 
                     strided_size = imutils.get_strided_size(size, 4)
                     strided_up_size = imutils.get_strided_up_size(size, 16)
 
-                    outputs = [model(img[0]) for img in pack['img']]
+                    outputs = [
+                        model(dataloader.normalize_batch(img[0]))
+                        for img in msf_imgs(pack, args, torch.device('cpu'))
+                    ]
 
                     strided_cam = torch.sum(
                         torch.stack([
@@ -65,18 +77,15 @@ def _work_cpu(process_id, model, dataset, args):
                     highres_cam = highres_cam[valid_cat]
                     highres_cam /= F.adaptive_max_pool2d(highres_cam, (1, 1)) + 1e-5
                     # save cams
-                    np.save(
-                        os.path.join(args.cam_out_dir, img_name + '.npy'), {
-                            "keys": valid_cat,
-                            "cam": strided_cam.cpu(),
-                            "high_res": highres_cam.cpu().numpy()
-                        })
-
-                    if process_id == args.num_workers - 1 and iter % (len(databin) //
-                                                                      4) == 0:
-                        print("%d " % ((5 * iter + 1) // (len(databin) // 4)), end='')
+                    cam_writer.write(img_name,
+                                     keys=valid_cat,
+                                     cam=strided_cam.cpu(),
+                                     high_res=highres_cam.cpu())
             except Exception as e:
                 print(e)
+            work_queue.task_done(process_id)
+
+    cam_writer.close()
 
 
 def _work_cpu_1(model, dataset, args):
@@ -85,21 +94,27 @@ def _work_cpu_1(model, dataset, args):
                              num_workers=1,
                              pin_memory=False)
 
+    cam_writer = camstore.open_cam_writer(args.cam_out_dir,
+                                          args.cam_format,
+                                          writer_id=0,
+                                          precision=args.cam_precision)
+
     with torch.no_grad():
 
         for iter, pack in tqdm(enumerate(data_loader), total=len(dataset)):
             try:
                 img_name = pack['name'][0]
-                path = os.path.join(args.cam_out_dir, img_name + '.npy')
-                if not os.path.exists(path):
-                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                if img_name not in cam_writer:
                     label = pack['label'][0]
                     size = pack['size']
 
                     strided_size = imutils.get_strided_size(size, 4)
                     strided_up_size = imutils.get_strided_up_size(size, 16)
 
-                    outputs = [model(img[0]) for img in pack['img']]
+                    outputs = [
+                        model(dataloader.normalize_batch(img[0]))
+                        for img in msf_imgs(pack, args, torch.device('cpu'))
+                    ]
 
                     strided_cam = torch.sum(
                         torch.stack([
@@ -126,35 +141,37 @@ def _work_cpu_1(model, dataset, args):
                     highres_cam = highres_cam[valid_cat]
                     highres_cam /= F.adaptive_max_pool2d(highres_cam, (1, 1)) + 1e-5
                     # save cams
-                    np.save(
-                        os.path.join(args.cam_out_dir, img_name + '.npy'), {
-                            "keys": valid_cat,
-                            "cam": strided_cam.cpu(),
-                            "high_res": highres_cam.cpu().numpy()
-                        })
+                    cam_writer.write(img_name,
+                                     keys=valid_cat,
+                                     cam=strided_cam.cpu(),
+                                     high_res=highres_cam.cpu())
 
             except Exception as e:
                 print(e)
 
+    cam_writer.close()
+
 
-def _work_gpu(process_id, model, dataset, args):
-    databin = dataset[process_id]
+def _work_gpu(process_id, model, dataset, work_queue, args):
     n_gpus = torch.cuda.device_count()
-    data_loader = DataLoader(databin,
-                             shuffle=False,
+    data_loader = DataLoader(dataset,
+                             sampler=work_queue.sampler(process_id),
                              num_workers=args.num_workers // n_gpus,
                              pin_memory=False)
 
+    cam_writer = camstore.open_cam_writer(args.cam_out_dir,
+                                          args.cam_format,
+                                          writer_id=process_id,
+                                          precision=args.cam_precision)
+
     with torch.no_grad(), cuda.device(process_id):
 
         model.cuda()
 
-        for iter, pack in tqdm(enumerate(data_loader), total=len(databin)):
+        for iter, pack in tqdm(enumerate(data_loader)):
 
             img_name = pack['name'][0]
-            path = os.path.join(args.cam_out_dir, img_name + '.npy')
-            if not os.path.exists(path):
-                os.makedirs(os.path.dirname(path), exist_ok=True)
+            if img_name not in cam_writer:
                 label = pack['label'][0]
                 size = pack['size']
 
@@ -162,7 +179,10 @@ def _work_gpu(process_id, model, dataset, args):
                 strided_up_size = imutils.get_strided_up_size(size, 16)
 
                 outputs = [
-                    model(img[0].cuda(non_blocking=True)) for img in pack['img']
+                    model(
+                        dataloader.normalize_batch(
+                            img[0].cuda(non_blocking=True)))
+                    for img in msf_imgs(pack, args, torch.device('cuda'))
                 ]
 
                 strided_cam = torch.sum(
@@ -191,15 +211,13 @@ def _work_gpu(process_id, model, dataset, args):
                 highres_cam /= F.adaptive_max_pool2d(highres_cam, (1, 1)) + 1e-5
 
                 # save cams
-                np.save(
-                    path, {
-                        "keys": valid_cat,
-                        "cam": strided_cam.cpu(),
-                        "high_res": highres_cam.cpu().numpy()
-                    })
+                cam_writer.write(img_name,
+                                 keys=valid_cat,
+                                 cam=strided_cam.cpu(),
+                                 high_res=highres_cam.cpu())
+            work_queue.task_done(process_id)
 
-                if process_id == n_gpus - 1 and iter % (len(databin) // 4) == 0:
-                    print("%d " % ((5 * iter + 1) // (len(databin) // 4)), end='')
+    cam_writer.close()
 
 
 def _work_gpu_1(model, dataset, args):
@@ -209,6 +227,11 @@ def _work_gpu_1(model, dataset, args):
                              num_workers=args.num_workers // n_gpus,
                              pin_memory=False)
 
+    cam_writer = camstore.open_cam_writer(args.cam_out_dir,
+                                          args.cam_format,
+                                          writer_id=0,
+                                          precision=args.cam_precision)
+
     with torch.no_grad():
 
         model.cuda()
@@ -216,9 +239,7 @@ def _work_gpu_1(model, dataset, args):
         for iter, pack in tqdm(enumerate(data_loader), total=len(dataset)):
             try:
                 img_name = pack['name'][0]
-                path = os.path.join(args.cam_out_dir, img_name + '.npy')
-                if not os.path.exists(path):
-                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                if img_name not in cam_writer:
                     label = pack['label'][0]
                     size = pack['size']
 
@@ -226,7 +247,10 @@ def _work_gpu_1(model, dataset, args):
                     strided_up_size = imutils.get_strided_up_size(size, 16)
 
                     outputs = [
-                        model(img[0].cuda(non_blocking=True)) for img in pack['img']
+                        model(
+                            dataloader.normalize_batch(
+                                img[0].cuda(non_blocking=True)))
+                        for img in msf_imgs(pack, args, torch.device('cuda'))
                     ]
 
                     strided_cam = torch.sum(
@@ -255,16 +279,93 @@ def _work_gpu_1(model, dataset, args):
                     highres_cam /= F.adaptive_max_pool2d(highres_cam, (1, 1)) + 1e-5
 
                     # save cams
-                    np.save(
-                        path, {
-                            "keys": valid_cat,
-                            "cam": strided_cam.cpu(),
-                            "high_res": highres_cam.cpu().numpy()
-                        })
+                    cam_writer.write(img_name,
+                                     keys=valid_cat,
+                                     cam=strided_cam.cpu(),
+                                     high_res=highres_cam.cpu())
 
             except Exception as e:
                 print(e)
 
+    cam_writer.close()
+
+
+def make_cams(model, imgs, size, labels, device):
+    strided_size = imutils.get_strided_size(size, 4)
+    strided_up_size = imutils.get_strided_up_size(size, 16)
+
+    strided_cam = 0
+    highres_cam = 0
+    for img in imgs:
+        # (batch, flip, channel, height, width) -> (batch * flip, ...)
+        img = dataloader.normalize_batch(img.to(device, non_blocking=True))
+        outputs = model.forward_msf(img.view(-1, *img.shape[2:]))
+
+        strided_cam += F.interpolate(outputs,
+                                     strided_size,
+                                     mode='bilinear',
+                                     align_corners=False)
+        highres_cam += F.interpolate(outputs,
+                                     strided_up_size,
+                                     mode='bilinear',
+                                     align_corners=False)
+    highres_cam = highres_cam[..., :size[0], :size[1]]
+
+    for i in range(labels.size(0)):
+        valid_cat = torch.nonzero(labels[i])[:, 0]
+
+        img_strided_cam = strided_cam[i, valid_cat.to(device)]
+        img_strided_cam /= F.adaptive_max_pool2d(img_strided_cam,
+                                                 (1, 1)) + 1e-5
+
+        img_highres_cam = highres_cam[i, valid_cat.to(device)]
+        img_highres_cam /= F.adaptive_max_pool2d(img_highres_cam,
+                                                 (1, 1)) + 1e-5
+
+        yield valid_cat, img_strided_cam, img_highres_cam
+
+
+def _work_batched(process_id, model, dataset, batches, work_queue, args):
+    if use_gpu:
+        device = torch.device('cuda', process_id)
+        num_workers = args.num_workers // torch.cuda.device_count()
+    else:
+        device = torch.device('cpu')
+        num_workers = args.num_workers // work_queue.n_procs
+
+    cam_writer = camstore.open_cam_writer(args.cam_out_dir,
+                                          args.cam_format,
+                                          writer_id=process_id,
+                                          precision=args.cam_precision)
+
+    data_loader = DataLoader(dataset,
+                             batch_sampler=work_queue.sampler(process_id,
+                                                              items=batches),
+                             num_workers=num_workers,
+                             pin_memory=False)
+
+    with torch.no_grad():
+
+        model.to(device)
+
+        for iter, pack in tqdm(enumerate(data_loader)):
+            imgs = msf_imgs(pack, args, device)
+            if not isinstance(imgs, list):
+                imgs = [imgs]
+            size = (int(pack['size'][0][0]), int(pack['size'][1][0]))
+
+            cams = make_cams(model, imgs, size, pack['label'], device)
+            for img_name, (valid_cat, strided_cam,
+                           highres_cam) in zip(pack['name'], cams):
+                # save cams
+                cam_writer.write(img_name,
+                                 keys=valid_cat,
+                                 cam=strided_cam.cpu(),
+                                 high_res=highres_cam.cpu())
+            work_queue.task_done(process_id)
+
+    cam_writer.close()
+
 
 def run(args):
     assert args.voc12_root is not None
@@ -285,32 +386,67 @@ def run(args):
                                          map_location=torch.device('cpu')),
                               strict=True)
     model.eval()
+
+    # skip finished images before the dataset is built
+    cam_reader = camstore.open_cam_reader(args.cam_out_dir,
+                                          verify=args.manifest_verify)
+    img_name_list = [
+        name for name in dataloader.load_img_name_list(args.train_list)
+        if dataloader.decode_int_filename(name) not in cam_reader
+    ]
+
     dataset = dataloader.VOC12ClassificationDatasetMSF(
-        args.train_list,
+        img_name_list,
         voc12_root=args.voc12_root,
         scales=args.cam_scales,
-        class_label_dict_path=args.class_label_dict_path)
+        class_label_dict_path=args.class_label_dict_path,
+        img_normal=dataloader.make_img_normal(args.normalize_on_device),
+        img_cache=args.img_cache_dir,
+        device_pyramid=args.cam_device_pyramid)
     print('[ ', end='')
-    if use_gpu:
+    if args.cam_infer_batch_size > 1:
+        if use_gpu:
+            n_procs = torch.cuda.device_count()
+        else:
+            n_procs = 1 if args.num_workers == 1 else 2
+
+        sizes = dataloader.load_img_size_list(dataset.img_name_list,
+                                              args.voc12_root,
+                                              dataset.img_cache)
+        batches = torchutils.SizeBucketBatchSampler(
+            sizes, args.cam_infer_batch_size).batches
+
+        work_queue = torchutils.WorkQueue(len(batches), n_procs)
+        if n_procs == 1:
+            _work_batched(0, model, dataset, batches, work_queue, args)
+        else:
+            multiprocessing.spawn(_work_batched,
+                                  nprocs=n_procs,
+                                  args=(model, dataset, batches, work_queue,
+                                        args),
+                                  join=True)
+        print(work_queue)
+    elif use_gpu:
         n_gpus = torch.cuda.device_count()
         if n_gpus == 1:
             _work_gpu_1(model, dataset, args)
         else:
-
-            dataset = torchutils.split_dataset(dataset, n_gpus)
+            work_queue = torchutils.WorkQueue(len(dataset), n_gpus)
             multiprocessing.spawn(_work_gpu,
                                   nprocs=n_gpus,
-                                  args=(model, dataset, args),
+                                  args=(model, dataset, work_queue, args),
                                   join=True)
+            print(work_queue)
     else:
         if args.num_workers == 1:
             _work_cpu_1(model, dataset, args)
         else:
-            dataset = torchutils.split_dataset(dataset, 2)
+            work_queue = torchutils.WorkQueue(len(dataset), 2)
             multiprocessing.spawn(_work_cpu,
                                   nprocs=2,
-                                  args=(model, dataset, args),
+                                  args=(model, dataset, work_queue, args),
                                   join=True)
+            print(work_queue)
     print(']')
 
     torch.cuda.empty_cache()
@@ -1,11 +1,11 @@
 import json
 import os
 
-import numpy as np
 from pycococreatortools import pycococreatortools
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
+from wsl_survey.segmentation.irn.misc import masks
 from wsl_survey.segmentation.irn.voc12 import dataloader
 
 VOC2012_JSON_FOLDER = ""
@@ -40,15 +40,16 @@ def run(args):
         image_info = pycococreatortools.create_image_info(
             img_id, img_name + ".jpg", (img_size[1], img_size[0]))
         coco_output["images"].append(image_info)
-        ann = np.load(os.path.join(args.ins_seg_out_dir, img_name) + '.npy',
-                      allow_pickle=True).item()
+        ann = masks.load_instances(
+            os.path.join(args.ins_seg_out_dir, img_name) + '.npy')
 
         instance_id = 1
 
-        for score, mask, class_id in zip(ann['score'], ann['mask'],
-                                         ann['class']):
+        for i, (score, class_id) in enumerate(zip(ann['score'],
+                                                  ann['class'])):
             if score < 1e-5:
                 continue
+            mask = ann['mask'][i]
             category_info = {'id': class_id, 'is_crowd': False}
 
             annotation_info = pycococreatortools.create_annotation_info(
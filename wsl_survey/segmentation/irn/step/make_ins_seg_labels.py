@@ -4,6 +4,7 @@ import os
 import numpy as np
 import torch
 import torch.nn.functional as F
+from scipy import ndimage
 from skimage import measure
 from torch import multiprocessing, cuda
 from torch.backends import cudnn
@@ -11,54 +12,70 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from wsl_survey.segmentation.irn.misc import torchutils, imutils, pyutils, \
-    indexing
+    indexing, camstore, manifest, masks
 from wsl_survey.segmentation.irn.voc12 import dataloader
 
 cudnn.enabled = True
 
 use_gpu = torch.cuda.is_available()
 
+# refinement steps taken per image, reported by the workers
+refinement_iterations = []
 
-def find_centroids_with_refinement(displacement, iterations=300):
+
+def find_centroids_with_refinement(displacement,
+                                   iterations=300,
+                                   tol=None,
+                                   return_iterations=False):
     # iteration: the number of refinement steps (u), set to any integer >= 100.
+    # tol: stop once no centroid moves more than tol pixels in one step.
 
+    displacement = torch.as_tensor(displacement, dtype=torch.float32)
     height, width = displacement.shape[1:3]
-
-    # 1. initialize centroids as their coordinates
-    centroid_y = np.repeat(np.expand_dims(np.arange(height), 1), width,
-                           axis=1).astype(np.float32)
-    centroid_x = np.repeat(np.expand_dims(np.arange(width), 0), height,
-                           axis=0).astype(np.float32)
-
-    for i in range(iterations):
-        # 2. find numbers after the decimals
-        uy = np.ceil(centroid_y).astype(np.int32)
-        dy = np.floor(centroid_y).astype(np.int32)
-        y_c = centroid_y - dy
-
-        ux = np.ceil(centroid_x).astype(np.int32)
-        dx = np.floor(centroid_x).astype(np.int32)
-        x_c = centroid_x - dx
+    device = displacement.device
+
+    # (dy, dx) channels -> one (dx, dy) sampling target per pixel
+    displacement = displacement.unsqueeze(0)
+
+    # 1. initialize centroids as their coordinates, (x, y) as in grid_sample
+    ys, xs = torch.meshgrid(torch.arange(height, dtype=torch.float32),
+                            torch.arange(width, dtype=torch.float32))
+    centroid = torch.stack([xs, ys], -1).unsqueeze(0).to(device)
+    moved = torch.empty_like(centroid)
+    grid = torch.empty_like(centroid)
+    to_grid = torch.tensor([2 / max(width - 1, 1), 2 / max(height - 1, 1)],
+                           device=device)
+
+    n_iter = 0
+    for n_iter in range(1, iterations + 1):
+        # 2. bilinear lookup of the displacement at the centroids
+        torch.mul(centroid, to_grid, out=grid)
+        grid.sub_(1)
+        step = F.grid_sample(displacement,
+                             grid,
+                             mode='bilinear',
+                             padding_mode='border',
+                             align_corners=True)
 
         # 3. move centroids
-        centroid_y += displacement[0][uy, ux] * y_c * x_c + \
-                      displacement[0][dy, ux] * (1 - y_c) * x_c + \
-                      displacement[0][uy, dx] * y_c * (1 - x_c) + \
-                      displacement[0][dy, dx] * (1 - y_c) * (1 - x_c)
-
-        centroid_x += displacement[1][uy, ux] * y_c * x_c + \
-                      displacement[1][dy, ux] * (1 - y_c) * x_c + \
-                      displacement[1][uy, dx] * y_c * (1 - x_c) + \
-                      displacement[1][dy, dx] * (1 - y_c) * (1 - x_c)
+        torch.add(centroid, step.permute(0, 2, 3, 1).flip(-1), out=moved)
 
         # 4. bound centroids
-        centroid_y = np.clip(centroid_y, 0, height - 1)
-        centroid_x = np.clip(centroid_x, 0, width - 1)
+        moved[..., 0].clamp_(0, width - 1)
+        moved[..., 1].clamp_(0, height - 1)
 
-    centroid_y = np.round(centroid_y).astype(np.int32)
-    centroid_x = np.round(centroid_x).astype(np.int32)
+        centroid, moved = moved, centroid
+        if tol is not None and \
+                torch.max(torch.abs(centroid - moved)).item() < tol:
+            break
 
-    return np.stack([centroid_y, centroid_x], axis=0)
+    centroid = torch.round(centroid[0]).to(torch.int32)
+    centroids = torch.stack([centroid[..., 1], centroid[..., 0]],
+                            0).cpu().numpy()
+
+    if return_iterations:
+        return centroids, n_iter
+    return centroids
 
 
 def cluster_centroids(centroids, displacement, thres=2.5):
@@ -82,9 +99,9 @@ def cluster_centroids(centroids, displacement, thres=2.5):
     return pyutils.to_one_hot(cluster_map)
 
 
-def separte_score_by_mask(scores, masks):
+def separte_score_by_mask(scores, instance_masks):
     instacne_map_expanded = torch.from_numpy(
-        np.expand_dims(masks, 0).astype(np.float32))
+        np.expand_dims(instance_masks, 0).astype(np.float32))
     if use_gpu:
         instance_score = torch.unsqueeze(scores,
                                          1) * instacne_map_expanded.cuda()
@@ -93,173 +110,163 @@ def separte_score_by_mask(scores, masks):
     return instance_score
 
 
-def detect_instance(score_map, mask, class_id, max_fragment_size=0):
+def detect_instance(score_map, instance_label, class_id, max_fragment_size=0):
     # converting pixel-wise instance ids into detection form
+    # instance_label: (H, W), 0 for background and k for score_map[k - 1]
 
     pred_score = []
     pred_label = []
-    pred_mask = []
+    pred_bbox = []
+    pred_crop = []
 
-    for ag_score, ag_mask, ag_class in zip(score_map, mask, class_id):
-        if np.sum(ag_mask) < 1:
+    for k, ag_slice in enumerate(ndimage.find_objects(instance_label)):
+        if ag_slice is None:
             continue
-        segments = pyutils.to_one_hot(
-            measure.label(ag_mask, connectivity=1, background=0))[1:]
-        # connected components analysis
+        ag_mask = instance_label[ag_slice] == k + 1
+        ag_score = score_map[k][ag_slice]
+
+        # connected components analysis, inside the bounding box only
+        segments = measure.label(ag_mask, connectivity=1, background=0)
 
-        for seg_mask in segments:
+        for s, seg_slice in enumerate(ndimage.find_objects(segments)):
+            seg_mask = segments[seg_slice] == s + 1
             if np.sum(seg_mask) < max_fragment_size:
                 pred_score.append(0)
             else:
-                pred_score.append(np.max(ag_score * seg_mask))
-            pred_label.append(ag_class)
-            pred_mask.append(seg_mask)
+                pred_score.append(np.max(ag_score[seg_slice] * seg_mask))
+            pred_label.append(class_id[k])
+            pred_bbox.append(
+                (ag_slice[0].start + seg_slice[0].start,
+                 ag_slice[1].start + seg_slice[1].start,
+                 ag_slice[0].start + seg_slice[0].stop,
+                 ag_slice[1].start + seg_slice[1].stop))
+            pred_crop.append(seg_mask)
 
     return {
-        'score': np.stack(pred_score, 0),
-        'mask': np.stack(pred_mask, 0),
-        'class': np.stack(pred_label, 0)
+        'score': np.array(pred_score, np.float32),
+        'mask': masks.InstanceMasks.from_crops(instance_label.shape,
+                                               pred_bbox, pred_crop),
+        'class': np.array(pred_label, np.asarray(class_id).dtype)
     }
 
 
-def _work_cpu(process_id, model, dataset, args):
-    databin = dataset[process_id]
-    data_loader = DataLoader(databin,
-                             shuffle=False,
+def make_ins_seg_label(cams, keys, edge, dp, size, args):
+    centroids, n_iter = find_centroids_with_refinement(dp,
+                                                       tol=args.centroid_tol,
+                                                       return_iterations=True)
+    refinement_iterations.append(n_iter)
+
+    dp = dp.cpu().numpy()
+    instance_map = cluster_centroids(centroids, dp)
+    instance_cam = separte_score_by_mask(cams, instance_map)
+
+    rw = indexing.propagate_to_edge(instance_cam,
+                                    edge,
+                                    beta=args.beta,
+                                    exp_times=args.exp_times,
+                                    radius=5,
+                                    sparse=args.rw_sparse,
+                                    tol=args.rw_tol)
+
+    rw_up = F.interpolate(rw,
+                          scale_factor=4,
+                          mode='bilinear',
+                          align_corners=False)[:, 0, :size[0], :size[1]]
+    rw_up = rw_up / torch.max(rw_up)
+
+    rw_up_bg = F.pad(rw_up, (0, 0, 0, 0, 1, 0), value=args.ins_seg_bg_thres)
+
+    num_instances = instance_map.shape[0]
+
+    # kept as a label map, masks are only cut out per detected fragment
+    instance_shape = torch.argmax(rw_up_bg, 0).cpu().numpy()
+    instance_class_id = np.repeat(keys, num_instances)
+
+    return detect_instance(rw_up.cpu().numpy(),
+                           instance_shape,
+                           instance_class_id,
+                           max_fragment_size=size[0] * size[1] * 0.01)
+
+
+def _work_cpu(process_id, model, dataset, work_queue, args):
+    data_loader = DataLoader(dataset,
+                             sampler=work_queue.sampler(process_id),
                              num_workers=1,
                              pin_memory=False)
 
+    indexing.path_index_cache.set_capacity(args.path_index_cache_size)
+    cam_reader = camstore.open_cam_reader(args.cam_out_dir)
+    manifest_writer = manifest.ManifestWriter(args.ins_seg_out_dir, process_id)
+
     with torch.no_grad():
 
-        for iter, pack in tqdm(enumerate(data_loader), total=len(databin)):
+        for iter, pack in tqdm(enumerate(data_loader)):
             img_name = pack['name'][0]
             path = os.path.join(args.ins_seg_out_dir, img_name + '.npy')
-            if not os.path.exists(path):
+            if img_name not in manifest_writer:
                 os.makedirs(os.path.dirname(path), exist_ok=True)
                 size = np.asarray(pack['size'])
 
                 edge, dp = model(pack['img'][0])
 
-                dp = dp.cpu().numpy()
+                cam_dict = cam_reader[img_name]
 
-                cam_dict = np.load(args.cam_out_dir + '/' + img_name + '.npy',
-                                   allow_pickle=True).item()
+                cams = torch.from_numpy(np.array(cam_dict['cam']))
 
-                cams = cam_dict['cam']
-                keys = cam_dict['keys']
+                detected = make_ins_seg_label(cams, cam_dict['keys'], edge,
+                                              dp, size, args)
 
-                centroids = find_centroids_with_refinement(dp)
-                instance_map = cluster_centroids(centroids, dp)
-                instance_cam = separte_score_by_mask(cams, instance_map)
+                masks.save_instances(path, detected)
+                manifest_writer.add(img_name, path)
+            work_queue.task_done(process_id)
 
-                rw = indexing.propagate_to_edge(instance_cam,
-                                                edge,
-                                                beta=args.beta,
-                                                exp_times=args.exp_times,
-                                                radius=5)
+    manifest_writer.close()
+    print('process %d:' % process_id, indexing.path_index_cache)
+    if refinement_iterations:
+        print('process %d: %.1f centroid refinement steps per image' %
+              (process_id, np.mean(refinement_iterations)))
 
-                rw_up = F.interpolate(rw,
-                                      scale_factor=4,
-                                      mode='bilinear',
-                                      align_corners=False)[:,
-                        0, :size[0], :size[1]]
-                rw_up = rw_up / torch.max(rw_up)
 
-                rw_up_bg = F.pad(rw_up, (0, 0, 0, 0, 1, 0),
-                                 value=args.ins_seg_bg_thres)
-
-                num_classes = len(keys)
-                num_instances = instance_map.shape[0]
-
-                instance_shape = torch.argmax(rw_up_bg, 0).cpu().numpy()
-                instance_shape = pyutils.to_one_hot(
-                    instance_shape,
-                    maximum_val=num_instances * num_classes + 1)[1:]
-                instance_class_id = np.repeat(keys, num_instances)
-
-                detected = detect_instance(rw_up.cpu().numpy(),
-                                           instance_shape,
-                                           instance_class_id,
-                                           max_fragment_size=size[0] * size[1] *
-                                                             0.01)
-
-                np.save(path,
-                        detected)
-
-                if process_id == args.num_workers - 1 and iter % (len(databin) //
-                                                                  4) == 0:
-                    print("%d " % ((5 * iter + 1) // (len(databin) // 4)), end='')
-
-
-def _work_gpu(process_id, model, dataset, args):
+def _work_gpu(process_id, model, dataset, work_queue, args):
     n_gpus = torch.cuda.device_count()
-    databin = dataset[process_id]
-    data_loader = DataLoader(databin,
-                             shuffle=False,
+    data_loader = DataLoader(dataset,
+                             sampler=work_queue.sampler(process_id),
                              num_workers=args.num_workers // n_gpus,
                              pin_memory=False)
 
+    indexing.path_index_cache.set_capacity(args.path_index_cache_size)
+    cam_reader = camstore.open_cam_reader(args.cam_out_dir)
+    manifest_writer = manifest.ManifestWriter(args.ins_seg_out_dir, process_id)
+
     with torch.no_grad(), cuda.device(process_id):
 
         model.cuda()
 
-        for iter, pack in tqdm(enumerate(data_loader), total=len(databin)):
+        for iter, pack in tqdm(enumerate(data_loader)):
             img_name = pack['name'][0]
             path = os.path.join(args.ins_seg_out_dir, img_name + '.npy')
-            if not os.path.exists(path):
+            if img_name not in manifest_writer:
                 os.makedirs(os.path.dirname(path), exist_ok=True)
                 size = np.asarray(pack['size'])
 
                 edge, dp = model(pack['img'][0].cuda(non_blocking=True))
 
-                dp = dp.cpu().numpy()
+                cam_dict = cam_reader[img_name]
 
-                cam_dict = np.load(args.cam_out_dir + '/' + img_name + '.npy',
-                                   allow_pickle=True).item()
+                cams = torch.from_numpy(np.array(cam_dict['cam'])).cuda()
 
-                cams = cam_dict['cam'].cuda()
-                keys = cam_dict['keys']
+                detected = make_ins_seg_label(cams, cam_dict['keys'], edge,
+                                              dp, size, args)
 
-                centroids = find_centroids_with_refinement(dp)
-                instance_map = cluster_centroids(centroids, dp)
-                instance_cam = separte_score_by_mask(cams, instance_map)
+                masks.save_instances(path, detected)
+                manifest_writer.add(img_name, path)
+            work_queue.task_done(process_id)
 
-                rw = indexing.propagate_to_edge(instance_cam,
-                                                edge,
-                                                beta=args.beta,
-                                                exp_times=args.exp_times,
-                                                radius=5)
-
-                rw_up = F.interpolate(rw,
-                                      scale_factor=4,
-                                      mode='bilinear',
-                                      align_corners=False)[:,
-                        0, :size[0], :size[1]]
-                rw_up = rw_up / torch.max(rw_up)
-
-                rw_up_bg = F.pad(rw_up, (0, 0, 0, 0, 1, 0),
-                                 value=args.ins_seg_bg_thres)
-
-                num_classes = len(keys)
-                num_instances = instance_map.shape[0]
-
-                instance_shape = torch.argmax(rw_up_bg, 0).cpu().numpy()
-                instance_shape = pyutils.to_one_hot(
-                    instance_shape,
-                    maximum_val=num_instances * num_classes + 1)[1:]
-                instance_class_id = np.repeat(keys, num_instances)
-
-                detected = detect_instance(rw_up.cpu().numpy(),
-                                           instance_shape,
-                                           instance_class_id,
-                                           max_fragment_size=size[0] * size[1] *
-                                                             0.01)
-
-                np.save(path,
-                        detected)
-
-                if process_id == n_gpus - 1 and iter % (len(databin) // 4) == 0:
-                    print("%d " % ((5 * iter + 1) // (len(databin) // 4)), end='')
+    manifest_writer.close()
+    print('process %d:' % process_id, indexing.path_index_cache)
+    if refinement_iterations:
+        print('process %d: %.1f centroid refinement steps per image' %
+              (process_id, np.mean(refinement_iterations)))
 
 
 def run(args):
@@ -277,29 +284,38 @@ def run(args):
 
     model.load_state_dict(torch.load(args.irn_weights_name), strict=False)
     model.eval()
+    # skip finished images before the dataset is built
+    img_name_list = manifest.filter_pending(
+        dataloader.load_img_name_list(args.infer_list),
+        args.ins_seg_out_dir,
+        key=dataloader.decode_int_filename,
+        verify=args.manifest_verify)
+
     dataset = dataloader.VOC12ClassificationDatasetMSF(
-        args.infer_list,
+        img_name_list,
         voc12_root=args.voc12_root,
         scales=(1.0,),
-        class_label_dict_path=args.class_label_dict_path)
+        class_label_dict_path=args.class_label_dict_path,
+        img_cache=args.img_cache_dir)
 
     if use_gpu:
         n_gpus = torch.cuda.device_count()
 
-        dataset = torchutils.split_dataset(dataset, n_gpus)
+        work_queue = torchutils.WorkQueue(len(dataset), n_gpus)
         multiprocessing.spawn(_work_gpu,
                               nprocs=n_gpus,
-                              args=(model, dataset, args),
+                              args=(model, dataset, work_queue, args),
                               join=True)
     else:
-        dataset = torchutils.split_dataset(dataset, args.num_workers)
+        work_queue = torchutils.WorkQueue(len(dataset), args.num_workers)
         multiprocessing.spawn(_work_cpu,
                               nprocs=args.num_workers,
-                              args=(model, dataset, args),
+                              args=(model, dataset, work_queue, args),
                               join=True)
     print("[ ", end='')
 
     print("]")
+    print(work_queue)
 
 
 if __name__ == '__main__':
@@ -10,119 +10,112 @@ from torch.backends import cudnn
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from wsl_survey.segmentation.irn.misc import torchutils, indexing
+from wsl_survey.segmentation.irn.misc import torchutils, indexing, camstore, \
+    manifest
 from wsl_survey.segmentation.irn.voc12 import dataloader
 
 cudnn.enabled = True
 use_gpu = torch.cuda.is_available()
 
 
-def _work_cpu(process_id, model, dataset, args):
-    databin = dataset[process_id]
-    data_loader = DataLoader(databin,
-                             shuffle=False,
+def make_sem_seg_label(cams, keys, edge, size, args):
+    keys = np.pad(keys + 1, (1, 0), mode='constant')
+
+    rw = indexing.propagate_to_edge(cams,
+                                    edge,
+                                    beta=args.beta,
+                                    exp_times=args.exp_times,
+                                    radius=5,
+                                    sparse=args.rw_sparse,
+                                    tol=args.rw_tol)
+
+    rw_up = F.interpolate(rw, scale_factor=4, mode='bilinear',
+                          align_corners=False)[..., 0, :size[0], :size[1]]
+    rw_up = rw_up / torch.max(rw_up)
+
+    rw_up_bg = F.pad(rw_up, (0, 0, 0, 0, 1, 0), value=args.sem_seg_bg_thres)
+    rw_pred = torch.argmax(rw_up_bg, dim=0).cpu().numpy()
+
+    return keys[rw_pred]
+
+
+def _work_cpu(process_id, model, dataset, work_queue, args):
+    data_loader = DataLoader(dataset,
+                             sampler=work_queue.sampler(process_id),
                              num_workers=1,
                              pin_memory=False)
 
+    indexing.path_index_cache.set_capacity(args.path_index_cache_size)
+    cam_reader = camstore.open_cam_reader(args.cam_out_dir)
+    manifest_writer = manifest.ManifestWriter(args.sem_seg_out_dir, process_id)
+
     with torch.no_grad():
 
-        for iter, pack in tqdm(enumerate(data_loader), total=len(databin)):
+        for iter, pack in tqdm(enumerate(data_loader)):
             img_name = dataloader.decode_int_filename(pack['name'][0])
             path = os.path.join(args.sem_seg_out_dir, img_name + '.png')
-            if not os.path.exists(path):
+            if img_name not in manifest_writer:
                 os.makedirs(os.path.dirname(path), exist_ok=True)
                 orig_img_size = np.asarray(pack['size'])
 
                 edge, dp = model(pack['img'][0])
 
-                cam_dict = np.load(args.cam_out_dir + '/' + img_name + '.npy',
-                                   allow_pickle=True).item()
-
-                cams = cam_dict['cam']
-                keys = np.pad(cam_dict['keys'] + 1, (1, 0), mode='constant')
-
-                cam_downsized_values = cams
+                cam_dict = cam_reader[img_name]
 
-                rw = indexing.propagate_to_edge(cam_downsized_values,
-                                                edge,
-                                                beta=args.beta,
-                                                exp_times=args.exp_times,
-                                                radius=5)
+                cams = torch.from_numpy(np.array(cam_dict['cam']))
 
-                rw_up = F.interpolate(
-                    rw, scale_factor=4, mode='bilinear',
-                    align_corners=False)[...,
-                        0, :orig_img_size[0], :orig_img_size[1]]
-                rw_up = rw_up / torch.max(rw_up)
-
-                rw_up_bg = F.pad(rw_up, (0, 0, 0, 0, 1, 0),
-                                 value=args.sem_seg_bg_thres)
-                rw_pred = torch.argmax(rw_up_bg, dim=0).cpu().numpy()
-
-                rw_pred = keys[rw_pred]
+                rw_pred = make_sem_seg_label(cams, cam_dict['keys'], edge,
+                                             orig_img_size, args)
 
                 imageio.imsave(
                     path,
                     rw_pred.astype(np.uint8))
+                manifest_writer.add(img_name, path)
+            work_queue.task_done(process_id)
 
-                if process_id == args.num_workers - 1 and iter % (len(databin) //
-                                                                  4) == 0:
-                    print("%d " % ((5 * iter + 1) // (len(databin) // 4)), end='')
+    manifest_writer.close()
+    print('process %d:' % process_id, indexing.path_index_cache)
 
 
-def _work_gpu(process_id, model, dataset, args):
+def _work_gpu(process_id, model, dataset, work_queue, args):
     n_gpus = torch.cuda.device_count()
-    databin = dataset[process_id]
-    data_loader = DataLoader(databin,
-                             shuffle=False,
+    data_loader = DataLoader(dataset,
+                             sampler=work_queue.sampler(process_id),
                              num_workers=args.num_workers // n_gpus,
                              pin_memory=False)
 
+    indexing.path_index_cache.set_capacity(args.path_index_cache_size)
+    cam_reader = camstore.open_cam_reader(args.cam_out_dir)
+    manifest_writer = manifest.ManifestWriter(args.sem_seg_out_dir, process_id)
+
     with torch.no_grad(), cuda.device(process_id):
 
         model.cuda()
 
-        for iter, pack in tqdm(enumerate(data_loader), total=len(databin)):
+        for iter, pack in tqdm(enumerate(data_loader)):
             img_name = dataloader.decode_int_filename(pack['name'][0])
             path = os.path.join(args.sem_seg_out_dir, img_name + '.png')
-            if not os.path.exists(path):
+            if img_name not in manifest_writer:
                 os.makedirs(os.path.dirname(path), exist_ok=True)
                 orig_img_size = np.asarray(pack['size'])
 
                 edge, dp = model(pack['img'][0].cuda(non_blocking=True))
 
-                cam_dict = np.load(args.cam_out_dir + '/' + img_name + '.npy',
-                                   allow_pickle=True).item()
-
-                cams = cam_dict['cam']
-                keys = np.pad(cam_dict['keys'] + 1, (1, 0), mode='constant')
+                cam_dict = cam_reader[img_name]
 
-                cam_downsized_values = cams.cuda()
+                cams = torch.from_numpy(np.array(cam_dict['cam'])).cuda()
 
-                rw = indexing.propagate_to_edge(cam_downsized_values,
-                                                edge,
-                                                beta=args.beta,
-                                                exp_times=args.exp_times,
-                                                radius=5)
-
-                rw_up = F.interpolate(
-                    rw, scale_factor=4, mode='bilinear',
-                    align_corners=False)[...,
-                        0, :orig_img_size[0], :orig_img_size[1]]
-                rw_up = rw_up / torch.max(rw_up)
-
-                rw_up_bg = F.pad(rw_up, (0, 0, 0, 0, 1, 0),
-                                 value=args.sem_seg_bg_thres)
-                rw_pred = torch.argmax(rw_up_bg, dim=0).cpu().numpy()
-
-                rw_pred = keys[rw_pred]
+                rw_pred = make_sem_seg_label(cams, cam_dict['keys'], edge,
+                                             orig_img_size, args)
 
                 imageio.imsave(
                     path,
                     rw_pred.astype(np.uint8))
+                manifest_writer.add(img_name, path)
+            work_queue.task_done(process_id)
 
-                if process_id == n_gpus - 1 and iter % (len(databin) // 4) == 0:
-                    print("%d " % ((5 * iter + 1) // (len(databin) // 4)), end='')
+    manifest_writer.close()
+    print('process %d:' % process_id, indexing.path_index_cache)
 
 
 def run(args):
@@ -141,28 +134,37 @@ def run(args):
     model.load_state_dict(torch.load(args.irn_weights_name), strict=False)
     model.eval()
 
+    # skip finished images before the dataset is built
+    img_name_list = manifest.filter_pending(
+        dataloader.load_img_name_list(args.infer_list),
+        args.sem_seg_out_dir,
+        key=dataloader.decode_int_filename,
+        verify=args.manifest_verify)
+
     dataset = dataloader.VOC12ClassificationDatasetMSF(
-        args.infer_list,
+        img_name_list,
         voc12_root=args.voc12_root,
         scales=(1.0,),
-        class_label_dict_path=args.class_label_dict_path)
+        class_label_dict_path=args.class_label_dict_path,
+        img_cache=args.img_cache_dir)
     print("[", end='')
     if use_gpu:
         n_gpus = torch.cuda.device_count()
 
-        dataset = torchutils.split_dataset(dataset, n_gpus)
+        work_queue = torchutils.WorkQueue(len(dataset), n_gpus)
 
         multiprocessing.spawn(_work_gpu,
                               nprocs=n_gpus,
-                              args=(model, dataset, args),
+                              args=(model, dataset, work_queue, args),
                               join=True)
     else:
-        dataset = torchutils.split_dataset(dataset, args.num_workers)
+        work_queue = torchutils.WorkQueue(len(dataset), args.num_workers)
         multiprocessing.spawn(_work_cpu,
                               nprocs=args.num_workers,
-                              args=(model, dataset, args),
+                              args=(model, dataset, work_queue, args),
                               join=True)
     print("]")
+    print(work_queue)
 
     torch.cuda.empty_cache()
 
@@ -0,0 +1,247 @@
+import importlib
+import os
+import time
+
+import imageio
+import numpy as np
+import torch
+from torch import multiprocessing
+from torch.backends import cudnn
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from wsl_survey.segmentation.irn.misc import torchutils, indexing, camstore, \
+    manifest, masks, bboxes
+from wsl_survey.segmentation.irn.step import make_cam, cam_to_ir_label, \
+    make_sem_seg_labels, make_ins_seg_labels
+from wsl_survey.segmentation.irn.voc12 import dataloader
+
+cudnn.enabled = True
+use_gpu = torch.cuda.is_available()
+
+
+def _get_out_dirs(args):
+    out_dirs = dict()
+    if 'ir_label' in args.stream_outputs:
+        out_dirs['ir_label'] = args.ir_label_out_dir
+    if 'sem_seg' in args.stream_outputs:
+        out_dirs['sem_seg'] = args.sem_seg_out_dir
+    if 'ins_seg' in args.stream_outputs:
+        out_dirs['ins_seg'] = args.ins_seg_out_dir
+    return out_dirs
+
+
+def _get_out_paths(img_name, args):
+    out_paths = dict()
+    if 'ir_label' in args.stream_outputs:
+        out_paths['ir_label'] = os.path.join(args.ir_label_out_dir,
+                                             img_name + '.png')
+    if 'sem_seg' in args.stream_outputs:
+        out_paths['sem_seg'] = os.path.join(args.sem_seg_out_dir,
+                                            img_name + '.png')
+    if 'ins_seg' in args.stream_outputs:
+        out_paths['ins_seg'] = os.path.join(args.ins_seg_out_dir,
+                                            img_name + '.npy')
+    return out_paths
+
+
+def _work(process_id, cam_model, irn_model, dataset, work_queue, args):
+    if use_gpu:
+        device = torch.device('cuda', process_id)
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+
+    indexing.path_index_cache.set_capacity(args.path_index_cache_size)
+    cam_reader, cam_writer = None, None
+    if 'cam' in args.stream_outputs:
+        cam_reader = camstore.open_cam_reader(args.cam_out_dir)
+        cam_writer = camstore.open_cam_writer(args.cam_out_dir,
+                                              args.cam_format,
+                                              writer_id=process_id,
+                                              precision=args.cam_precision)
+    bbox_writer = None
+    if 'ir_label' in args.stream_outputs and args.bbox_out_dir is not None:
+        bbox_writer = bboxes.BboxWriter(args.bbox_out_dir, process_id)
+    manifest_writers = {
+        artifact: manifest.ManifestWriter(out_dir, process_id)
+        for artifact, out_dir in _get_out_dirs(args).items()
+    }
+
+    data_loader = DataLoader(dataset,
+                             sampler=work_queue.sampler(process_id),
+                             num_workers=1,
+                             pin_memory=False)
+
+    scale_index = list(args.cam_scales).index(1.0)
+
+    with torch.no_grad():
+
+        cam_model.to(device)
+        irn_model.to(device)
+
+        for pack in tqdm(data_loader):
+            img_name = pack['name'][0]
+            size = (int(pack['size'][0][0]), int(pack['size'][1][0]))
+            out_paths = _get_out_paths(img_name, args)
+            for path in out_paths.values():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            imgs = make_cam.msf_imgs(pack, args, device)
+            if not isinstance(imgs, list):
+                imgs = [imgs]
+
+            valid_cat, strided_cam, highres_cam = next(
+                make_cam.make_cams(cam_model, imgs, size, pack['label'],
+                                   device))
+            keys = valid_cat.numpy()
+
+            if cam_writer is not None and img_name not in cam_reader:
+                cam_writer.write(img_name,
+                                 keys=valid_cat,
+                                 cam=strided_cam.cpu(),
+                                 high_res=highres_cam.cpu())
+
+            if 'ir_label' in out_paths:
+                t = time.time()
+                conf = cam_to_ir_label.make_ir_label(
+                    pack['raw_img'][0].numpy(),
+                    highres_cam.cpu().numpy(), keys, args)
+                work_queue.add_time(process_id, 'crf', time.time() - t)
+                conf = conf.astype(np.uint8)
+                imageio.imwrite(out_paths['ir_label'], conf)
+                if bbox_writer is not None:
+                    bbox_writer.write(img_name, bboxes.largest_bbox(conf))
+                manifest_writers['ir_label'].add(img_name,
+                                                 out_paths['ir_label'])
+
+            if 'sem_seg' not in out_paths and 'ins_seg' not in out_paths:
+                work_queue.task_done(process_id)
+                continue
+
+            # the irn runs on the flipped pair of the scale 1.0 image
+            edge, dp = irn_model(imgs[scale_index][0].to(device,
+                                                         non_blocking=True))
+
+            if 'sem_seg' in out_paths:
+                rw_pred = make_sem_seg_labels.make_sem_seg_label(
+                    strided_cam, keys, edge, size, args)
+                imageio.imsave(out_paths['sem_seg'], rw_pred.astype(np.uint8))
+                manifest_writers['sem_seg'].add(img_name, out_paths['sem_seg'])
+
+            if 'ins_seg' in out_paths:
+                detected = make_ins_seg_labels.make_ins_seg_label(
+                    strided_cam, keys, edge, dp, size, args)
+                masks.save_instances(out_paths['ins_seg'], detected)
+                manifest_writers['ins_seg'].add(img_name, out_paths['ins_seg'])
+            work_queue.task_done(process_id)
+
+    if cam_writer is not None:
+        cam_writer.close()
+    if bbox_writer is not None:
+        bbox_writer.close()
+    for manifest_writer in manifest_writers.values():
+        manifest_writer.close()
+    print('process %d:' % process_id, indexing.path_index_cache)
+
+
+def run(args):
+    assert args.voc12_root is not None
+    assert args.class_label_dict_path is not None
+    assert args.infer_list is not None
+    assert args.cam_weights_name is not None
+    assert args.cam_network is not None
+    assert args.cam_network_module is not None
+    assert args.irn_weights_name is not None
+    assert args.irn_network is not None
+    assert args.irn_network_module is not None
+    assert 1.0 in args.cam_scales, 'the irn needs the scale 1.0 image'
+    if 'cam' in args.stream_outputs:
+        assert args.cam_out_dir is not None
+    if 'ir_label' in args.stream_outputs:
+        assert args.ir_label_out_dir is not None
+    if 'sem_seg' in args.stream_outputs:
+        assert args.sem_seg_out_dir is not None
+    if 'ins_seg' in args.stream_outputs:
+        assert args.ins_seg_out_dir is not None
+
+    map_location = None if use_gpu else torch.device('cpu')
+
+    cam_model = getattr(importlib.import_module(args.cam_network_module),
+                        args.cam_network + 'CAM')(num_classes=args.num_classes)
+    cam_model.load_state_dict(torch.load(args.cam_weights_name + '.pth',
+                                         map_location=map_location),
+                              strict=True)
+    cam_model.eval()
+
+    irn_model = getattr(importlib.import_module(args.irn_network_module),
+                        args.irn_network + 'EdgeDisplacement')()
+    irn_model.load_state_dict(torch.load(args.irn_weights_name,
+                                         map_location=map_location),
+                              strict=False)
+    irn_model.eval()
+
+    # skip images whose requested artifacts are all complete before the
+    # dataset is built
+    img_name_list = dataloader.load_img_name_list(args.infer_list)
+    pending = set(
+        manifest.filter_pending(img_name_list,
+                                list(_get_out_dirs(args).values()),
+                                key=dataloader.decode_int_filename,
+                                verify=args.manifest_verify))
+    cam_reader = None
+    if 'cam' in args.stream_outputs:
+        cam_reader = camstore.open_cam_reader(args.cam_out_dir,
+                                              verify=args.manifest_verify)
+    img_name_list = [
+        name for name in img_name_list if name in pending or
+        (cam_reader is not None and
+         dataloader.decode_int_filename(name) not in cam_reader)
+    ]
+
+    dataset = dataloader.VOC12ClassificationDatasetMSF(
+        img_name_list,
+        voc12_root=args.voc12_root,
+        scales=args.cam_scales,
+        class_label_dict_path=args.class_label_dict_path,
+        with_raw_img='ir_label' in args.stream_outputs,
+        img_cache=args.img_cache_dir,
+        device_pyramid=args.cam_device_pyramid)
+
+    n_procs = torch.cuda.device_count() if use_gpu else args.num_workers
+    work_queue = torchutils.WorkQueue(len(dataset),
+                                      n_procs,
+                                      timers=('crf', ))
+
+    print('[ ', end='')
+    multiprocessing.spawn(_work,
+                          nprocs=n_procs,
+                          args=(cam_model, irn_model, dataset, work_queue,
+                                args),
+                          join=True)
+    print(']')
+    print(work_queue)
+
+    torch.cuda.empty_cache()
+
+
+if __name__ == '__main__':
+    from wsl_survey.segmentation.irn.config import make_parser
+
+    parser = make_parser()
+    parser.set_defaults(
+        voc12_root='./data/test1/VOC2012',
+        class_label_dict_path='./data/voc12/cls_labels.npy',
+        infer_list='./data/test1/VOC2012/ImageSets/Segmentation/val.txt',
+        cam_weights_name='./outputs/test1/results/resnet18/sess/cam.pth',
+        cam_network='ResNet18',
+        cam_network_module='wsl_survey.segmentation.irn.net.resnet_cam',
+        irn_weights_name='./outputs/test1/results/resnet18/sess/irn.pth',
+        irn_network='ResNet18',
+        irn_network_module='wsl_survey.segmentation.irn.net.resnet_irn',
+        num_workers=1,
+        sem_seg_out_dir='./outputs/test1/results/resnet18/sem_seg',
+        stream_outputs=['sem_seg'],
+    )
+    args = parser.parse_args()
+    run(args)
@@ -6,10 +6,11 @@ from tqdm import tqdm
 
 cudnn.enabled = True
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 import torch.nn.functional as F
 
 from wsl_survey.segmentation.irn.voc12 import dataloader
-from wsl_survey.segmentation.irn.misc import pyutils, torchutils
+from wsl_survey.segmentation.irn.misc import pyutils, torchutils, checkpoint
 
 use_gpu = torch.cuda.is_available()
 
@@ -27,8 +28,9 @@ def validate(model, data_loader):
 
             label = pack['label']
             if use_gpu:
+                img = img.cuda(non_blocking=True)
                 label = label.cuda(non_blocking=True)
-            x = model(img)
+            x = model(dataloader.normalize_batch(img))
             loss1 = F.multilabel_soft_margin_loss(x, label)
 
             val_loss_meter.add({'loss1': loss1.item()})
@@ -40,15 +42,9 @@ def validate(model, data_loader):
     return
 
 
-def run(args):
-    assert args.voc12_root is not None
-    assert args.class_label_dict_path is not None
-    assert args.train_list is not None
-    assert args.val_list is not None
-    assert args.cam_weights_name is not None
-    assert args.cam_network is not None
-    assert args.cam_num_epoches is not None
-    assert args.cam_network_module is not None
+def _train(args):
+    is_main = torchutils.is_main_process()
+    world_size = torchutils.get_world_size()
 
     model = getattr(importlib.import_module(args.cam_network_module),
                     args.cam_network)(num_classes=args.num_classes)
@@ -60,21 +56,37 @@ def run(args):
         hor_flip=True,
         crop_size=512,
         crop_method="random",
-        class_label_dict_path=args.class_label_dict_path)
+        class_label_dict_path=args.class_label_dict_path,
+        img_normal=dataloader.make_img_normal(args.normalize_on_device),
+        img_cache=args.img_cache_dir)
+    # every process loads its share of the batch, the global batch size
+    # and so the schedule stay those of a single process
+    checkpoint_path = args.cam_weights_name + '.ckpt'
+    train_sampler = None
+    if args.checkpoint_interval > 0 or args.resume:
+        train_sampler = checkpoint.resumable_sampler(train_dataset,
+                                                     torchutils.get_rank(),
+                                                     world_size)
+    elif torchutils.is_distributed():
+        train_sampler = DistributedSampler(train_dataset)
     train_data_loader = DataLoader(train_dataset,
-                                   batch_size=args.cam_batch_size,
-                                   shuffle=True,
+                                   batch_size=max(
+                                       args.cam_batch_size // world_size, 1),
+                                   shuffle=train_sampler is None,
+                                   sampler=train_sampler,
                                    num_workers=args.num_workers,
                                    pin_memory=True,
                                    drop_last=True)
-    max_step = (len(train_dataset) //
-                args.cam_batch_size) * args.cam_num_epoches
+    steps_per_epoch = len(train_data_loader)
+    max_step = steps_per_epoch * args.cam_num_epoches
 
     val_dataset = dataloader.VOC12ClassificationDataset(
         args.val_list,
         voc12_root=args.voc12_root,
         crop_size=512,
-        class_label_dict_path=args.class_label_dict_path)
+        class_label_dict_path=args.class_label_dict_path,
+        img_normal=dataloader.make_img_normal(args.normalize_on_device),
+        img_cache=args.img_cache_dir)
     val_data_loader = DataLoader(val_dataset,
                                  batch_size=args.cam_batch_size,
                                  shuffle=False,
@@ -99,29 +111,59 @@ def run(args):
                                          weight_decay=args.cam_weight_decay,
                                          max_step=max_step)
 
-    if use_gpu:
-        model = torch.nn.DataParallel(model).cuda()
+    precision = torchutils.MixedPrecision(args.amp,
+                                          'cuda' if use_gpu else 'cpu')
+    if args.channels_last:
+        model = torchutils.to_channels_last(model)
+
+    model = torchutils.parallelize(model)
     model.train()
 
     avg_meter = pyutils.AverageMeter()
 
     timer = pyutils.Timer()
 
-    for ep in range(args.cam_num_epoches):
-
-        print('Epoch %d/%d' % (ep + 1, args.cam_num_epoches))
+    start_epoch = 0
+    state = checkpoint.load_checkpoint(
+        checkpoint_path) if args.resume else None
+    if state is not None:
+        checkpoint.restore_training_state(state, model, optimizer, precision)
+        start_epoch = state['epoch']
+        # the batches of the epoch trained before the checkpoint
+        train_sampler.skip = (optimizer.global_step - start_epoch *
+                              steps_per_epoch) * train_data_loader.batch_size
+        if is_main:
+            print('Resuming from step %d of %s' %
+                  (optimizer.global_step, checkpoint_path))
+    elif args.resume and is_main:
+        print('No checkpoint at %s, training from scratch' % checkpoint_path)
+    checkpoint_writer = checkpoint.CheckpointWriter(checkpoint_path)
+
+    for ep in range(start_epoch, args.cam_num_epoches):
+
+        if train_sampler is not None:
+            train_sampler.set_epoch(ep)
+        if is_main:
+            print('Epoch %d/%d' % (ep + 1, args.cam_num_epoches))
         correct = 0.
         total = 0.
         for step, pack in tqdm(enumerate(train_data_loader),
-                               total=len(train_dataset) //
-                               args.cam_batch_size):
+                               total=len(train_data_loader),
+                               disable=not is_main):
 
             img = pack['img']
             label = pack['label']
             if use_gpu:
+                img = img.cuda(non_blocking=True)
                 label = label.cuda(non_blocking=True)
+            img = dataloader.normalize_batch(img)
+            if args.channels_last:
+                img = torchutils.to_channels_last(img)
 
-            x = model(img)
+            with precision.autocast():
+                x = model(img)
+            # the loss is computed in fp32
+            x = x.float()
 
             _, predicted = torch.max(x.data, 1)
             _, actual = torch.max(label.data, 1)
@@ -132,17 +174,22 @@ def run(args):
 
             avg_meter.add({'loss1': loss.item()})
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            optimizer.backward_step(loss, precision)
+
+            if is_main and args.checkpoint_interval > 0 and \
+                    optimizer.global_step % args.checkpoint_interval == 0:
+                checkpoint_writer.save(
+                    checkpoint.training_state(
+                        model, optimizer,
+                        optimizer.global_step // steps_per_epoch, precision))
 
-            if (optimizer.global_step - 1) % 100 == 0:
+            if is_main and (optimizer.global_step - 1) % 100 == 0:
                 acc = 100 * correct / total
                 timer.update_progress(optimizer.global_step / max_step)
 
                 print('step:%5d/%5d' % (optimizer.global_step - 1, max_step),
                       'loss:%.4f' % (avg_meter.pop('loss1')),
-                      'imps:%.1f' % ((step + 1) * args.cam_batch_size /
+                      'imps:%.1f' % ((step + 1) * len(img) * world_size /
                                      timer.get_stage_elapsed()),
                       'lr: %.4f' % (optimizer.param_groups[0]['lr']),
                       'etc:%s' % (timer.str_estimated_complete()),
@@ -150,17 +197,40 @@ def run(args):
                       flush=True)
 
         else:
-            validate(model, val_data_loader)
+            if is_main:
+                # the bare module, validating does not involve the group
+                validate(
+                    model.module if torchutils.is_distributed() else model,
+                    val_data_loader)
+            torchutils.barrier()
             timer.reset_stage()
-    try:
-        state_dict = model.module.state_dict()
-    except:
-        state_dict = model.state_dict()
-    torch.save(state_dict, args.cam_weights_name + '.pth')
+    checkpoint_writer.wait()
+    if is_main:
+        try:
+            state_dict = model.module.state_dict()
+        except:
+            state_dict = model.state_dict()
+        torch.save(state_dict, args.cam_weights_name + '.pth')
     if use_gpu:
         torch.cuda.empty_cache()
 
 
+def run(args):
+    assert args.voc12_root is not None
+    assert args.class_label_dict_path is not None
+    assert args.train_list is not None
+    assert args.val_list is not None
+    assert args.cam_weights_name is not None
+    assert args.cam_network is not None
+    assert args.cam_num_epoches is not None
+    assert args.cam_network_module is not None
+
+    if args.ddp:
+        torchutils.launch_distributed(_train, args)
+    else:
+        _train(args)
+
+
 if __name__ == '__main__':
     from wsl_survey.segmentation.irn.config import make_parser
     import os
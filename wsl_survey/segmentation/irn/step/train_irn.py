@@ -1,4 +1,5 @@
 import importlib
+import time
 
 import torch
 from torch.backends import cudnn
@@ -6,20 +7,59 @@ from tqdm import tqdm
 
 cudnn.enabled = True
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from wsl_survey.segmentation.irn.voc12 import dataloader
 from wsl_survey.segmentation.irn.misc import pyutils, torchutils, indexing
+from wsl_survey.segmentation.irn.misc import checkpoint
 
 use_gpu = torch.cuda.is_available()
 
 
-def run(args):
-    assert args.voc12_root is not None
-    assert args.class_label_dict_path is not None
-    assert args.train_list is not None
-    assert args.ir_label_out_dir is not None
-    assert args.infer_list is not None
-    assert args.irn_network is not None
-    assert args.irn_network_module is not None
+def _set_dp_mean(model, dp_mean):
+    try:
+        model.module.mean_shift.running_mean = dp_mean
+    except:
+        model.mean_shift.running_mean = dp_mean
+
+
+def _dp_mean_pass(model, args):
+    infer_dataset = dataloader.VOC12ImageDataset(
+        args.infer_list,
+        voc12_root=args.voc12_root,
+        crop_size=args.irn_crop_size,
+        crop_method="top_left",
+        img_normal=dataloader.make_img_normal(args.normalize_on_device),
+        img_cache=args.img_cache_dir)
+    infer_data_loader = DataLoader(infer_dataset,
+                                   batch_size=args.irn_batch_size,
+                                   shuffle=False,
+                                   num_workers=args.num_workers,
+                                   pin_memory=True,
+                                   drop_last=True)
+
+    model.eval()
+    print('Analyzing displacements mean ... ', end='')
+
+    dp_mean_list = []
+
+    with torch.no_grad():
+        for iter, pack in tqdm(enumerate(infer_data_loader),
+                               total=len(infer_dataset) //
+                               args.irn_batch_size):
+
+            img = pack['img']
+            if use_gpu:
+                img = img.cuda(non_blocking=True)
+            aff, dp = model(dataloader.normalize_batch(img), False)
+
+            dp_mean_list.append(torch.mean(dp, dim=(0, 2, 3)).cpu())
+        _set_dp_mean(model, torch.mean(torch.stack(dp_mean_list), dim=0))
+    print('done.')
+
+
+def _train(args):
+    is_main = torchutils.is_main_process()
+    world_size = torchutils.get_world_size()
 
     path_index = indexing.PathIndex(radius=10,
                                     default_size=(args.irn_crop_size // 4,
@@ -37,16 +77,30 @@ def run(args):
         hor_flip=True,
         crop_size=args.irn_crop_size,
         crop_method="random",
-        rescale=(0.5, 1.5))
+        rescale=(0.5, 1.5),
+        img_normal=dataloader.make_img_normal(args.normalize_on_device),
+        aff_label_on_device=args.irn_aff_label_on_device,
+        img_cache=args.img_cache_dir)
+    # every process loads its share of the batch, the global batch size
+    # and so the schedule stay those of a single process
+    checkpoint_path = args.irn_weights_name + '.ckpt'
+    train_sampler = None
+    if args.checkpoint_interval > 0 or args.resume:
+        train_sampler = checkpoint.resumable_sampler(train_dataset,
+                                                     torchutils.get_rank(),
+                                                     world_size)
+    elif torchutils.is_distributed():
+        train_sampler = DistributedSampler(train_dataset)
     train_data_loader = DataLoader(train_dataset,
-                                   batch_size=args.irn_batch_size,
-                                   shuffle=True,
+                                   batch_size=max(
+                                       args.irn_batch_size // world_size, 1),
+                                   shuffle=train_sampler is None,
+                                   sampler=train_sampler,
                                    num_workers=args.num_workers,
                                    pin_memory=True,
                                    drop_last=True)
 
-    max_step = (len(train_dataset) //
-                args.irn_batch_size) * args.irn_num_epoches
+    max_step = len(train_data_loader) * args.irn_num_epoches
 
     param_groups = model.trainable_parameters()
     optimizer = torchutils.PolyOptimizer([{
@@ -62,34 +116,101 @@ def run(args):
                                          weight_decay=args.irn_weight_decay,
                                          max_step=max_step)
 
-    if use_gpu:
-        model = torch.nn.DataParallel(model).cuda()
+    precision = torchutils.MixedPrecision(args.amp,
+                                          'cuda' if use_gpu else 'cpu')
+    if args.channels_last:
+        model = torchutils.to_channels_last(model)
+
+    model = torchutils.parallelize(model)
     model.train()
 
+    extract_aff_lab_func = None
+    if args.irn_aff_label_on_device:
+        extract_aff_lab_func = dataloader.BatchedAffinityLabelFromIndices(
+            path_index.src_indices, path_index.dst_indices,
+            torch.device('cuda', torch.cuda.current_device())
+            if use_gpu else torch.device('cpu'))
+
     avg_meter = pyutils.AverageMeter()
 
     timer = pyutils.Timer()
 
-    for ep in range(args.irn_num_epoches):
-
-        print('Epoch %d/%d' % (ep + 1, args.irn_num_epoches))
+    # the mean displacement of the mean shift is taken over the images of
+    # the last steps, by default the last epoch
+    steps_per_epoch = len(train_data_loader)
+    if args.irn_dp_mean_samples > 0:
+        dp_mean_steps = -(-args.irn_dp_mean_samples // args.irn_batch_size)
+    else:
+        dp_mean_steps = steps_per_epoch
+    dp_sum, dp_count = torch.zeros(2), 0
+
+    start_epoch = 0
+    state = checkpoint.load_checkpoint(
+        checkpoint_path) if args.resume else None
+    if state is not None:
+        checkpoint.restore_training_state(state, model, optimizer, precision)
+        start_epoch = state['epoch']
+        # the displacement sums of all processes are in the one of rank 0
+        if is_main:
+            dp_sum, dp_count = state['dp_sum'], state['dp_count']
+        # the batches of the epoch trained before the checkpoint
+        train_sampler.skip = (optimizer.global_step - start_epoch *
+                              steps_per_epoch) * train_data_loader.batch_size
+        if is_main:
+            print('Resuming from step %d of %s' %
+                  (optimizer.global_step, checkpoint_path))
+    elif args.resume and is_main:
+        print('No checkpoint at %s, training from scratch' % checkpoint_path)
+    checkpoint_writer = checkpoint.CheckpointWriter(checkpoint_path)
+    start_step = optimizer.global_step
+    train_start = time.time()
+
+    for ep in range(start_epoch, args.irn_num_epoches):
+
+        if train_sampler is not None:
+            train_sampler.set_epoch(ep)
+        if is_main:
+            print('Epoch %d/%d' % (ep + 1, args.irn_num_epoches))
 
         for iter, pack in tqdm(enumerate(train_data_loader),
-                               total=len(train_dataset) //
-                               args.irn_batch_size):
+                               total=len(train_data_loader),
+                               disable=not is_main):
 
             img = pack['img']
-            bg_pos_label = pack['aff_bg_pos_label']
-            fg_pos_label = pack['aff_fg_pos_label']
-            neg_label = pack['aff_neg_label']
-            if use_gpu:
-                img = img.cuda(non_blocking=True)
-                bg_pos_label = bg_pos_label.cuda(non_blocking=True)
-                fg_pos_label = fg_pos_label.cuda(non_blocking=True)
-                neg_label = neg_label.cuda(non_blocking=True)
-
-            pos_aff_loss, neg_aff_loss, dp_fg_loss, dp_bg_loss = model(
-                img, True)
+            if extract_aff_lab_func is not None:
+                reduced_label = pack['reduced_label']
+                if use_gpu:
+                    img = img.cuda(non_blocking=True)
+                    reduced_label = reduced_label.cuda(non_blocking=True)
+                bg_pos_label, fg_pos_label, neg_label = extract_aff_lab_func(
+                    reduced_label)
+            else:
+                bg_pos_label = pack['aff_bg_pos_label']
+                fg_pos_label = pack['aff_fg_pos_label']
+                neg_label = pack['aff_neg_label']
+                if use_gpu:
+                    img = img.cuda(non_blocking=True)
+                    bg_pos_label = bg_pos_label.cuda(non_blocking=True)
+                    fg_pos_label = fg_pos_label.cuda(non_blocking=True)
+                    neg_label = neg_label.cuda(non_blocking=True)
+
+            img = dataloader.normalize_batch(img)
+            if args.channels_last:
+                img = torchutils.to_channels_last(img)
+
+            with precision.autocast():
+                if not args.irn_dp_mean_pass and \
+                        optimizer.global_step >= max_step - dp_mean_steps:
+                    outputs = model(img, True, True)
+                    dp_mean = outputs[4].float()
+                    dp_sum += torch.sum(dp_mean, dim=0).cpu()
+                    dp_count += dp_mean.size(0)
+                else:
+                    outputs = model(img, True)
+            # the losses are reduced in fp32
+            pos_aff_loss, neg_aff_loss, dp_fg_loss, dp_bg_loss = [
+                loss.float() for loss in outputs[:4]
+            ]
 
             bg_pos_aff_loss = torch.sum(
                 bg_pos_label * pos_aff_loss) / (torch.sum(bg_pos_label) + 1e-5)
@@ -114,69 +235,87 @@ def run(args):
             total_loss = (pos_aff_loss + neg_aff_loss) / 2 + (dp_fg_loss +
                                                               dp_bg_loss) / 2
 
-            optimizer.zero_grad()
-            total_loss.backward()
-            optimizer.step()
-
-            if (optimizer.global_step - 1) % 50 == 0:
+            optimizer.backward_step(total_loss, precision)
+
+            if args.checkpoint_interval > 0 and \
+                    optimizer.global_step % args.checkpoint_interval == 0:
+                ckpt_dp_count = torchutils.all_reduce_sum(
+                    torch.tensor([dp_count]))
+                ckpt_dp_sum = torchutils.all_reduce_sum(dp_sum.clone())
+                if is_main:
+                    checkpoint_writer.save(
+                        checkpoint.training_state(
+                            model,
+                            optimizer,
+                            optimizer.global_step // steps_per_epoch,
+                            precision,
+                            dp_sum=ckpt_dp_sum,
+                            dp_count=int(ckpt_dp_count[0])))
+
+            if is_main and (optimizer.global_step - 1) % 50 == 0:
                 timer.update_progress(optimizer.global_step / max_step)
 
                 print('step:%5d/%5d' % (optimizer.global_step - 1, max_step),
                       'loss:%.4f %.4f %.4f %.4f' %
                       (avg_meter.pop('loss1'), avg_meter.pop('loss2'),
                        avg_meter.pop('loss3'), avg_meter.pop('loss4')),
-                      'imps:%.1f' % ((iter + 1) * args.irn_batch_size /
+                      'imps:%.1f' % ((iter + 1) * len(img) * world_size /
                                      timer.get_stage_elapsed()),
                       'lr: %.4f' % (optimizer.param_groups[0]['lr']),
                       'etc:%s' % (timer.str_estimated_complete()),
                       flush=True)
         else:
             timer.reset_stage()
+    checkpoint_writer.wait()
+    train_time = time.time() - train_start
 
-    infer_dataset = dataloader.VOC12ImageDataset(args.infer_list,
-                                                 voc12_root=args.voc12_root,
-                                                 crop_size=args.irn_crop_size,
-                                                 crop_method="top_left")
-    infer_data_loader = DataLoader(infer_dataset,
-                                   batch_size=args.irn_batch_size,
-                                   shuffle=False,
-                                   num_workers=args.num_workers,
-                                   pin_memory=True,
-                                   drop_last=True)
-
-    model.eval()
-    print('Analyzing displacements mean ... ', end='')
+    # the mean over the images of all processes
+    dp_count = int(torchutils.all_reduce_sum(torch.tensor([dp_count]))[0])
+    dp_sum = torchutils.all_reduce_sum(dp_sum)
 
-    dp_mean_list = []
-
-    with torch.no_grad():
-        for iter, pack in tqdm(enumerate(infer_data_loader),
-                               total=len(infer_dataset) //
-                               args.irn_batch_size):
+    if is_main:
+        if torchutils.is_distributed():
+            model = model.module
 
-            img = pack['img']
-            if use_gpu:
-                img = img.cuda(non_blocking=True)
-            aff, dp = model(img, False)
+        if args.irn_dp_mean_pass:
+            t = time.time()
+            _dp_mean_pass(model, args)
+            print('displacement mean pass: %.1fs' % (time.time() - t))
+        else:
+            _set_dp_mean(model, dp_sum / max(dp_count, 1))
+            # the skipped pass would have forwarded the infer list,
+            # estimated at the training throughput
+            n_infer = len(dataloader.load_img_name_list(args.infer_list))
+            train_imps = (max_step - start_step) * args.irn_batch_size / max(
+                train_time, 1e-12)
+            print('displacement mean from the last %d training images, '
+                  'skipped pass over %d images (~%.1fs saved)' %
+                  (dp_count, n_infer, n_infer / train_imps))
 
-            dp_mean_list.append(torch.mean(dp, dim=(0, 2, 3)).cpu())
         try:
-            model.module.mean_shift.running_mean = torch.mean(
-                torch.stack(dp_mean_list), dim=0)
+            state_dict = model.module.state_dict()
         except:
-            model.mean_shift.running_mean = torch.mean(
-                torch.stack(dp_mean_list), dim=0)
-    print('done.')
-
-    try:
-        state_dict = model.module.state_dict()
-    except:
-        state_dict = model.state_dict()
-    torch.save(state_dict, args.irn_weights_name)
+            state_dict = model.state_dict()
+        torch.save(state_dict, args.irn_weights_name)
     if use_gpu:
         torch.cuda.empty_cache()
 
 
+def run(args):
+    assert args.voc12_root is not None
+    assert args.class_label_dict_path is not None
+    assert args.train_list is not None
+    assert args.ir_label_out_dir is not None
+    assert args.infer_list is not None
+    assert args.irn_network is not None
+    assert args.irn_network_module is not None
+
+    if args.ddp:
+        torchutils.launch_distributed(_train, args)
+    else:
+        _train(args)
+
+
 if __name__ == '__main__':
     from wsl_survey.segmentation.irn.config import make_parser
     import os
@@ -3,9 +3,11 @@ import os.path
 import imageio
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 
-from wsl_survey.segmentation.irn.misc import imutils, indexing
+from wsl_survey.segmentation.irn.misc import imutils, indexing, imgcache, \
+    labelstore
 
 IMG_FOLDER_NAME = "JPEGImages"
 ANNOT_FOLDER_NAME = "Annotations"
@@ -57,8 +59,8 @@ def load_image_label_list_from_xml(img_name_list, voc12_root):
 
 
 def load_image_label_list_from_npy(img_name_list, class_label_dict_path):
-    cls_labels_dict = np.load(class_label_dict_path, allow_pickle=True).item()
-    return np.array([cls_labels_dict[img_name] for img_name in img_name_list])
+    # a label store (misc/labelstore.py) or a pickled dict
+    return labelstore.load_label_rows(class_label_dict_path, img_name_list)
 
 
 def get_img_path(img_name, voc12_root):
@@ -69,26 +71,168 @@ def get_img_path(img_name, voc12_root):
     return os.path.join(voc12_root, IMG_FOLDER_NAME, img_name + '.jpg')
 
 
+def get_img_size(img_name, voc12_root):
+    from PIL import Image
+
+    # only the header is read, the image is not decoded
+    with Image.open(get_img_path(img_name, voc12_root)) as img:
+        return img.size[1], img.size[0]
+
+
+def load_img(name_str, voc12_root, img_cache=None, exact=True):
+    """The uint8 image, from img_cache (an ImageCache) when it holds it,
+    decoded from the jpeg otherwise. Without exact, an image cached with
+    a capped long side will do."""
+    if img_cache is not None:
+        img = img_cache.get(name_str, exact)
+        if img is not None:
+            return img
+    return np.asarray(imageio.imread(get_img_path(name_str, voc12_root)))
+
+
+def load_img_size_list(img_name_list, voc12_root, img_cache=None):
+    sizes = []
+    for img_name in img_name_list:
+        name_str = decode_int_filename(img_name)
+        # the cache records the original sizes, no file has to be opened
+        if img_cache is not None and name_str in img_cache:
+            sizes.append(img_cache.size(name_str))
+        else:
+            sizes.append(get_img_size(name_str, voc12_root))
+    return sizes
+
+
 def load_img_name_list(dataset_path):
+    if not isinstance(dataset_path, str):
+        # an already loaded (e.g. filtered) list of names
+        return np.asarray(dataset_path)
+
     img_name_list = np.loadtxt(dataset_path, dtype=np.str)
 
     return img_name_list
 
 
 class TorchvisionNormalize():
+    """(img / 255 - mean) / std as one multiply-add per pixel in float32.
+
+    >>> img = np.array([[[0, 128, 255]]], np.uint8)
+    >>> normal = TorchvisionNormalize()
+    >>> normal(img).astype(np.float64).round(3).tolist()
+    [[[-2.118, 0.205, 2.64]]]
+    >>> chw = normal.to_chw(np.repeat(img, 2, axis=1))
+    >>> chw.shape, chw.flags.c_contiguous
+    ((3, 1, 2), True)
+    """
+    dtype = np.float32
+
     def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
         self.mean = mean
         self.std = std
 
-    def __call__(self, img):
+        self.scale = 1. / (255. * np.asarray(std, np.float32))
+        self.bias = -np.asarray(mean, np.float32) / np.asarray(std, np.float32)
+
+    def __call__(self, img, out=None):
+        imgarr = np.asarray(img)
+        out = np.multiply(imgarr, self.scale, out=out, dtype=np.float32)
+        out += self.bias
+        return out
+
+    def to_chw(self, img, out=None):
+        """The normalized HWC img as CHW, written into the contiguous
+        (C, H, W) out when given."""
         imgarr = np.asarray(img)
-        proc_img = np.empty_like(imgarr, np.float32)
+        if out is None:
+            out = np.empty((imgarr.shape[2], ) + imgarr.shape[:2], np.float32)
+        np.multiply(imgarr.transpose(2, 0, 1),
+                    self.scale[:, None, None],
+                    out=out,
+                    dtype=np.float32)
+        out += self.bias[:, None, None]
+        return out
+
+
+class DeviceNormalize(TorchvisionNormalize):
+    """Leaves the images uint8, a quarter of the bytes to pass from the
+    workers, for normalize_batch to normalize them on the device.
+
+    Crops are padded with the mean color, which normalizes to within 0.01
+    of the zero padding of the normalized images.
+    """
+    dtype = np.uint8
+
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super().__init__(mean, std)
+        self.pad_value = np.round(np.asarray(mean) * 255).astype(np.uint8)
+
+    def __call__(self, img, out=None):
+        if out is None:
+            return np.asarray(img)
+        out[...] = img
+        return out
+
+    def to_chw(self, img, out=None):
+        imgarr = np.asarray(img).transpose(2, 0, 1)
+        if out is None:
+            return np.ascontiguousarray(imgarr)
+        out[...] = imgarr
+        return out
+
+
+def make_img_normal(on_device=False):
+    return DeviceNormalize() if on_device else TorchvisionNormalize()
 
-        proc_img[..., 0] = (imgarr[..., 0] / 255. - self.mean[0]) / self.std[0]
-        proc_img[..., 1] = (imgarr[..., 1] / 255. - self.mean[1]) / self.std[1]
-        proc_img[..., 2] = (imgarr[..., 2] / 255. - self.mean[2]) / self.std[2]
 
-        return proc_img
+def normalize_batch(img, img_normal=TorchvisionNormalize()):
+    """A batch of uint8 images (..., C, H, W), as loaded with DeviceNormalize,
+    normalized in float32 on its device. Images already normalized in the
+    workers are returned as they are."""
+    if img.dtype != torch.uint8:
+        return img
+    scale = torch.as_tensor(img_normal.scale, device=img.device)
+    bias = torch.as_tensor(img_normal.bias, device=img.device)
+    # in place on the float copy, which keeps its memory format
+    return img.float().mul_(scale.view(-1, 1, 1)).add_(bias.view(-1, 1, 1))
+
+
+def _resize_bicubic(img, size):
+    try:
+        # antialiased when downscaling, as pil does
+        return F.interpolate(img,
+                             size,
+                             mode='bicubic',
+                             align_corners=False,
+                             antialias=True)
+    except TypeError:
+        return F.interpolate(img, size, mode='bicubic', align_corners=False)
+
+
+def make_msf_pyramid(img, scales, img_normal=TorchvisionNormalize()):
+    """The "img" of VOC12ClassificationDatasetMSF built from the (B, C, H, W)
+    scale 1.0 images of device_pyramid on their device: per scale a
+    (B, 2, C, h, w) batch of the rescaled images and their flips.
+
+    The images are resized after normalization, clamped to the range of
+    normalized uint8 images like the uint8 resizing of pil.
+    """
+    img = normalize_batch(img, img_normal)
+    lo = torch.as_tensor(img_normal.bias, device=img.device).view(-1, 1, 1)
+    hi = lo + torch.as_tensor(img_normal.scale * 255., device=img.device).view(
+        -1, 1, 1)
+
+    height, width = img.shape[2:]
+    ms_img_list = []
+    for s in scales:
+        # the sizes of imutils.pil_rescale
+        size = (int(np.round(height * s)), int(np.round(width * s)))
+        s_img = img
+        if size != (height, width):
+            s_img = torch.max(torch.min(_resize_bicubic(img, size), hi), lo)
+        ms_img_list.append(
+            torch.stack([s_img, torch.flip(s_img, (-1, ))], dim=1))
+    if len(scales) == 1:
+        ms_img_list = ms_img_list[0]
+    return ms_img_list
 
 
 class GetAffinityLabelFromIndices():
@@ -116,7 +260,7 @@ class GetAffinityLabelFromIndices():
         fg_pos_affinity_label = np.logical_and(pos_affinity_label,
                                                np.greater(segm_label_from,
                                                           0)).astype(
-            np.float32)
+                                                              np.float32)
 
         neg_affinity_label = np.logical_and(np.logical_not(equal_label),
                                             valid_label).astype(np.float32)
@@ -126,6 +270,41 @@ class GetAffinityLabelFromIndices():
                torch.from_numpy(neg_affinity_label)
 
 
+class BatchedAffinityLabelFromIndices():
+    """GetAffinityLabelFromIndices for a (B, H, W) batch of reduced label
+    maps on the training device, the indices are moved there once."""
+    def __init__(self, indices_from, indices_to, device):
+        self.indices_from = torch.as_tensor(indices_from,
+                                            dtype=torch.long,
+                                            device=device)
+        self.indices_to = torch.as_tensor(indices_to,
+                                          dtype=torch.long,
+                                          device=device)
+
+    def __call__(self, segm_maps):
+        segm_maps_flat = segm_maps.reshape(segm_maps.shape[0], -1).long()
+
+        segm_label_from = segm_maps_flat[:, self.indices_from].unsqueeze(1)
+        segm_label_to = segm_maps_flat[:, self.indices_to.reshape(-1)].reshape(
+            (segm_maps.shape[0], ) + self.indices_to.shape)
+
+        valid_label = (segm_label_from < 21) & (segm_label_to < 21)
+
+        equal_label = segm_label_from == segm_label_to
+
+        pos_affinity_label = equal_label & valid_label
+
+        bg_pos_affinity_label = (pos_affinity_label &
+                                 (segm_label_from == 0)).float()
+        fg_pos_affinity_label = (pos_affinity_label &
+                                 (segm_label_from > 0)).float()
+
+        neg_affinity_label = (~equal_label & valid_label).float()
+
+        return bg_pos_affinity_label, fg_pos_affinity_label, \
+            neg_affinity_label
+
+
 class VOC12ImageDataset(Dataset):
     def __init__(self,
                  img_name_list_path,
@@ -136,10 +315,12 @@ class VOC12ImageDataset(Dataset):
                  hor_flip=False,
                  crop_size=None,
                  crop_method=None,
-                 to_torch=True):
+                 to_torch=True,
+                 img_cache=None):
 
         self.img_name_list = load_img_name_list(img_name_list_path)
         self.voc12_root = voc12_root
+        self.img_cache = imgcache.open_image_cache(img_cache)
 
         self.resize_long = resize_long
         self.rescale = rescale
@@ -148,6 +329,8 @@ class VOC12ImageDataset(Dataset):
         self.hor_flip = hor_flip
         self.crop_method = crop_method
         self.to_torch = to_torch
+        # uint8 images left to normalize_batch are padded with the mean
+        self.img_pad = getattr(img_normal, 'pad_value', 0)
 
     def __len__(self):
         return len(self.img_name_list)
@@ -156,8 +339,11 @@ class VOC12ImageDataset(Dataset):
         name = self.img_name_list[idx]
         name_str = decode_int_filename(name)
 
-        img = np.asarray(
-            imageio.imread(get_img_path(name_str, self.voc12_root)))
+        # resize_long does not depend on the size of the source image
+        img = load_img(name_str,
+                       self.voc12_root,
+                       self.img_cache,
+                       exact=not self.resize_long)
 
         if self.resize_long:
             img = imutils.random_resize_long(img, self.resize_long[0],
@@ -174,9 +360,10 @@ class VOC12ImageDataset(Dataset):
 
         if self.crop_size:
             if self.crop_method == "random":
-                img = imutils.random_crop(img, self.crop_size, 0)
+                img = imutils.random_crop(img, self.crop_size,
+                                          (self.img_pad, ))
             else:
-                img = imutils.top_left_crop(img, self.crop_size, 0)
+                img = imutils.top_left_crop(img, self.crop_size, self.img_pad)
 
         if self.to_torch:
             img = imutils.HWC_to_CHW(img)
@@ -194,9 +381,17 @@ class VOC12ClassificationDataset(VOC12ImageDataset):
                  hor_flip=False,
                  crop_size=None,
                  crop_method=None,
-                 class_label_dict_path=None):
-        super().__init__(img_name_list_path, voc12_root, resize_long, rescale,
-                         img_normal, hor_flip, crop_size, crop_method)
+                 class_label_dict_path=None,
+                 img_cache=None):
+        super().__init__(img_name_list_path,
+                         voc12_root,
+                         resize_long,
+                         rescale,
+                         img_normal,
+                         hor_flip,
+                         crop_size,
+                         crop_method,
+                         img_cache=img_cache)
         self.label_list = load_image_label_list_from_npy(
             self.img_name_list, class_label_dict_path)
 
@@ -213,33 +408,46 @@ class VOC12ClassificationDatasetMSF(VOC12ClassificationDataset):
                  img_name_list_path,
                  voc12_root,
                  img_normal=TorchvisionNormalize(),
-                 scales=(1.0,),
-                 class_label_dict_path=None):
+                 scales=(1.0, ),
+                 class_label_dict_path=None,
+                 with_raw_img=False,
+                 img_cache=None,
+                 device_pyramid=False):
         self.scales = scales
+        self.with_raw_img = with_raw_img
+        # only the scale 1.0 image leaves the workers, make_msf_pyramid
+        # builds the scales and flips on the device of the consumer
+        self.device_pyramid = device_pyramid
 
         super().__init__(img_name_list_path,
                          voc12_root,
                          img_normal=img_normal,
-                         class_label_dict_path=class_label_dict_path)
+                         class_label_dict_path=class_label_dict_path,
+                         img_cache=img_cache)
         self.scales = scales
 
+    def __scaled_pair(self, img, s):
+        if s != 1:
+            img = imutils.pil_rescale(img, s, order=3)
+        # the image and its flip, normalized straight into one buffer
+        pair = np.empty((2, img.shape[2]) + img.shape[:2],
+                        self.img_normal.dtype)
+        self.img_normal.to_chw(img, pair[0])
+        pair[1] = pair[0, ..., ::-1]
+        return pair
+
     def __getitem__(self, idx):
         name = self.img_name_list[idx]
         name_str = decode_int_filename(name)
 
-        img = imageio.imread(get_img_path(name_str, self.voc12_root))
+        img = load_img(name_str, self.voc12_root, self.img_cache)
 
-        ms_img_list = []
-        for s in self.scales:
-            if s == 1:
-                s_img = img
-            else:
-                s_img = imutils.pil_rescale(img, s, order=3)
-            s_img = self.img_normal(s_img)
-            s_img = imutils.HWC_to_CHW(s_img)
-            ms_img_list.append(np.stack([s_img, np.flip(s_img, -1)], axis=0))
-        if len(self.scales) == 1:
-            ms_img_list = ms_img_list[0]
+        if self.device_pyramid:
+            ms_img_list = self.img_normal.to_chw(img)
+        else:
+            ms_img_list = [self.__scaled_pair(img, s) for s in self.scales]
+            if len(self.scales) == 1:
+                ms_img_list = ms_img_list[0]
 
         out = {
             "name": name_str,
@@ -247,6 +455,8 @@ class VOC12ClassificationDatasetMSF(VOC12ClassificationDataset):
             "size": (img.shape[0], img.shape[1]),
             "label": torch.from_numpy(self.label_list[idx])
         }
+        if self.with_raw_img:
+            out["raw_img"] = np.asarray(img)
         return out
 
 
@@ -259,10 +469,12 @@ class VOC12SegmentationDataset(Dataset):
                  rescale=None,
                  img_normal=TorchvisionNormalize(),
                  hor_flip=False,
-                 crop_method='random'):
+                 crop_method='random',
+                 img_cache=None):
 
         self.img_name_list = load_img_name_list(img_name_list_path)
         self.voc12_root = voc12_root
+        self.img_cache = imgcache.open_image_cache(img_cache)
 
         self.label_dir = label_dir
 
@@ -271,6 +483,7 @@ class VOC12SegmentationDataset(Dataset):
         self.img_normal = img_normal
         self.hor_flip = hor_flip
         self.crop_method = crop_method
+        self.img_pad = getattr(img_normal, 'pad_value', 0)
 
     def __len__(self):
         return len(self.img_name_list)
@@ -279,11 +492,9 @@ class VOC12SegmentationDataset(Dataset):
         name = self.img_name_list[idx]
         name_str = decode_int_filename(name)
 
-        img = imageio.imread(get_img_path(name_str, self.voc12_root))
+        img = load_img(name_str, self.voc12_root, self.img_cache)
         label = imageio.imread(os.path.join(self.label_dir, name_str + '.png'))
 
-        img = np.asarray(img)
-
         if self.rescale:
             img, label = imutils.random_scale((img, label),
                                               scale_range=self.rescale,
@@ -297,9 +508,9 @@ class VOC12SegmentationDataset(Dataset):
 
         if self.crop_method == "random":
             img, label = imutils.random_crop((img, label), self.crop_size,
-                                             (0, 255))
+                                             (self.img_pad, 255))
         else:
-            img = imutils.top_left_crop(img, self.crop_size, 0)
+            img = imutils.top_left_crop(img, self.crop_size, self.img_pad)
             label = imutils.top_left_crop(label, self.crop_size, 255)
 
         img = imutils.HWC_to_CHW(img)
@@ -318,7 +529,9 @@ class VOC12AffinityDataset(VOC12SegmentationDataset):
                  rescale=None,
                  img_normal=TorchvisionNormalize(),
                  hor_flip=False,
-                 crop_method=None):
+                 crop_method=None,
+                 aff_label_on_device=False,
+                 img_cache=None):
         super().__init__(img_name_list_path,
                          label_dir,
                          crop_size,
@@ -326,8 +539,13 @@ class VOC12AffinityDataset(VOC12SegmentationDataset):
                          rescale,
                          img_normal,
                          hor_flip,
-                         crop_method=crop_method)
+                         crop_method=crop_method,
+                         img_cache=img_cache)
 
+        # with aff_label_on_device only the reduced label map leaves the
+        # workers, the affinity labels are made from it batch-wise by
+        # BatchedAffinityLabelFromIndices
+        self.aff_label_on_device = aff_label_on_device
         self.extract_aff_lab_func = GetAffinityLabelFromIndices(
             indices_from, indices_to)
 
@@ -339,6 +557,10 @@ class VOC12AffinityDataset(VOC12SegmentationDataset):
 
         reduced_label = imutils.pil_rescale(out['label'], 0.25, 0)
 
+        if self.aff_label_on_device:
+            out['reduced_label'] = torch.from_numpy(reduced_label)
+            return out
+
         out['aff_bg_pos_label'], out['aff_fg_pos_label'], out[
             'aff_neg_label'] = self.extract_aff_lab_func(reduced_label)
 
@@ -377,8 +599,7 @@ if __name__ == '__main__':
         break
 
     path_index = indexing.PathIndex(radius=10,
-                                    default_size=(512 // 4,
-                                                  512 // 4))
+                                    default_size=(512 // 4, 512 // 4))
 
     train_dataset = VOC12AffinityDataset(
         './data/test1/VOC2012/ImageSets/Segmentation/train_aug.txt',
@@ -23,6 +23,16 @@ def make_parser():
         "voc12/train.txt or voc12/val.txt to quickly check the quality of the labels."
     )
     parser.add_argument("--chainer_eval_set", type=str)
+    parser.add_argument(
+        "--eval_threads",
+        default=False,
+        type=bool,
+        help="Load the evaluated images in threads instead of processes.")
+    parser.add_argument(
+        "--eval_per_image_out",
+        default=None,
+        type=str,
+        help="Csv file for the iou, fp and fn of every evaluated image.")
 
     # Class Activation Map
     parser.add_argument("--cam_network", type=str)
@@ -40,6 +50,12 @@ def make_parser():
     # Mining Inter-pixel Relations
     parser.add_argument("--conf_fg_thres", default=0.30, type=float)
     parser.add_argument("--conf_bg_thres", default=0.05, type=float)
+    parser.add_argument(
+        "--crf_scale",
+        default=1.0,
+        type=float,
+        help="Runs the crf of the ir labels on the image rescaled by this "
+        "factor, the labels are upsampled to the full size.")
 
     # Inter-pixel Relation Network (IRNet)
     parser.add_argument("--irn_network", type=str)
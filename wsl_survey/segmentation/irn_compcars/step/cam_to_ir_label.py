@@ -28,24 +28,23 @@ def _work(process_id, infer_dataset, args):
                 cams = cam_dict['high_res']
                 keys = np.pad(cam_dict['keys'] + 1, (1, 0), mode='constant')
 
+                # the fg and bg hypotheses share the pairwise terms
+                crf = imutils.DenseCRF(img,
+                                       n_labels=keys.shape[0],
+                                       scale=args.crf_scale)
+
                 # 1. find confident fg & bg
                 fg_conf_cam = np.pad(cams, ((1, 0), (0, 0), (0, 0)),
                                      mode='constant',
                                      constant_values=args.conf_fg_thres)
                 fg_conf_cam = np.argmax(fg_conf_cam, axis=0)
-                pred = imutils.crf_inference_label(img,
-                                                   fg_conf_cam,
-                                                   n_labels=keys.shape[0])
-                fg_conf = keys[pred]
+                fg_conf = keys[crf.inference_label(fg_conf_cam)]
 
                 bg_conf_cam = np.pad(cams, ((1, 0), (0, 0), (0, 0)),
                                      mode='constant',
                                      constant_values=args.conf_bg_thres)
                 bg_conf_cam = np.argmax(bg_conf_cam, axis=0)
-                pred = imutils.crf_inference_label(img,
-                                                   bg_conf_cam,
-                                                   n_labels=keys.shape[0])
-                bg_conf = keys[pred]
+                bg_conf = keys[crf.inference_label(bg_conf_cam)]
 
                 # 2. combine confident fg & bg
                 conf = fg_conf.copy()
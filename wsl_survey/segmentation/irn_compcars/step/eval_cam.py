@@ -2,8 +2,32 @@ import os
 
 import numpy as np
 from chainercv.datasets import VOCSemanticSegmentationDataset
-from chainercv.evaluations import calc_semantic_segmentation_confusion
-from tqdm import tqdm
+
+from wsl_survey.segmentation.irn.misc import evaluation
+
+# per pool worker, set by _init_worker
+_state = dict()
+
+
+def _init_worker(dataset, cam_out_dir, cam_eval_thres):
+    _state.update(dataset=dataset,
+                  cam_out_dir=cam_out_dir,
+                  cam_eval_thres=cam_eval_thres)
+
+
+def _load_pair(i):
+    dataset = _state['dataset']
+    name = dataset.ids[i]
+    cam_dict = np.load(os.path.join(_state['cam_out_dir'], name + '.npy'),
+                       allow_pickle=True).item()
+    cams = cam_dict['high_res']
+    cams = np.pad(cams, ((1, 0), (0, 0), (0, 0)),
+                  mode='constant',
+                  constant_values=_state['cam_eval_thres'])
+    keys = np.pad(cam_dict['keys'] + 1, (1, 0), mode='constant')
+    cls_labels = np.argmax(cams, axis=0)
+    cls_labels = keys[cls_labels]
+    return name, cls_labels, dataset.get_example_by_keys(i, (1, ))[0]
 
 
 def run(args):
@@ -13,35 +37,27 @@ def run(args):
 
     dataset = VOCSemanticSegmentationDataset(split=args.chainer_eval_set,
                                              data_dir=args.voc12_root)
-    labels = [
-        dataset.get_example_by_keys(i, (1, ))[0] for i in range(len(dataset))
-    ]
-
-    preds = []
-    for id in tqdm(dataset.ids):
-        cam_dict = np.load(os.path.join(args.cam_out_dir, id + '.npy'),
-                           allow_pickle=True).item()
-        cams = cam_dict['high_res']
-        cams = np.pad(cams, ((1, 0), (0, 0), (0, 0)),
-                      mode='constant',
-                      constant_values=args.cam_eval_thres)
-        keys = np.pad(cam_dict['keys'] + 1, (1, 0), mode='constant')
-        cls_labels = np.argmax(cams, axis=0)
-        cls_labels = keys[cls_labels]
-        preds.append(cls_labels.copy())
-    confusion = calc_semantic_segmentation_confusion(preds, labels)
-
-    gtj = confusion.sum(axis=1)
-    resj = confusion.sum(axis=0)
-    gtjresj = np.diag(confusion)
-    denominator = gtj + resj - gtjresj
-    iou = gtjresj / denominator
-
-    print({'iou': iou, 'miou': np.nanmean(iou)})
+
+    # the cam keys go beyond the 21 voc classes, the confusion grows to them
+    with evaluation.SemSegEvaluator(
+            per_image_path=args.eval_per_image_out) as evaluator:
+        evaluator.evaluate(_load_pair,
+                           len(dataset),
+                           num_workers=min(args.num_workers, os.cpu_count()),
+                           threads=args.eval_threads,
+                           initializer=_init_worker,
+                           initargs=(dataset, args.cam_out_dir,
+                                     args.cam_eval_thres))
+    scores = evaluator.scores()
+
+    print(evaluator)
+    print({'iou': scores['iou'], 'miou': scores['miou']})
+
+    return scores
 
 
 if __name__ == '__main__':
-    from wsl_survey.segmentation.irn.config import make_parser
+    from wsl_survey.segmentation.irn_compcars.config import make_parser
 
     parser = make_parser()
     parser.set_defaults(voc12_root='./data/test1/VOC2012',
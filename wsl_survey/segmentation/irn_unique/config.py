@@ -23,6 +23,16 @@ def make_parser():
         "voc12/train.txt or voc12/val.txt to quickly check the quality of the labels."
     )
     parser.add_argument("--chainer_eval_set", type=str)
+    parser.add_argument(
+        "--eval_threads",
+        default=False,
+        type=bool,
+        help="Load the evaluated images in threads instead of processes.")
+    parser.add_argument(
+        "--eval_per_image_out",
+        default=None,
+        type=str,
+        help="Csv file for the iou, fp and fn of every evaluated image.")
 
     # Class Activation Map
     parser.add_argument("--cam_network", type=str)
@@ -5,6 +5,7 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset
 
+from wsl_survey.segmentation.irn.misc import labelstore
 from wsl_survey.segmentation.irn_unique.misc import imutils, indexing
 
 IMG_FOLDER_NAME = "JPEGImages"
@@ -54,8 +55,8 @@ def load_image_label_list_from_xml(img_name_list, voc12_root):
 
 
 def load_image_label_list_from_npy(img_name_list, class_label_dict_path):
-    cls_labels_dict = np.load(class_label_dict_path, allow_pickle=True).item()
-    return np.array([cls_labels_dict[img_name] for img_name in img_name_list])
+    # a label store (misc/labelstore.py) or a pickled dict
+    return labelstore.load_label_rows(class_label_dict_path, img_name_list)
 
 
 def get_img_path(img_name, voc12_root):
@@ -2,6 +2,7 @@ import argparse
 
 import numpy as np
 
+from wsl_survey.segmentation.irn.misc import labelstore
 from wsl_survey.segmentation.irn_unique.voc12 import dataloader
 
 if __name__ == '__main__':
@@ -27,7 +28,7 @@ if __name__ == '__main__':
     parser.add_argument(
         "--out",
         default=
-        "/Users/cenk.bircanoglu/wsl/wsl_survey/data/voc12/cls_labels_unique.npy",
+        "/Users/cenk.bircanoglu/wsl/wsl_survey/data/voc12/cls_labels_unique",
         type=str)
     parser.add_argument(
         "--voc12_root",
@@ -41,16 +42,10 @@ if __name__ == '__main__':
     train_val_name_list = np.concatenate([train_aug_list], axis=0)
     train_val_name_list = np.unique(train_val_name_list)
 
-
-    total_label = np.zeros(train_val_name_list.shape[0])
     print(train_val_name_list.shape[0])
 
-    d = dict()
-    for label, img_name in enumerate(train_val_name_list):
-        lab = np.zeros(train_val_name_list.shape[0])
-        lab[label] = 1
-        d[img_name] = lab
-        total_label += label
-
-    print(total_label)
-    np.save(args.out, d)
+    # every image is its own class: one index per image instead of a one-hot
+    # vector as long as the list
+    labelstore.write_label_store(args.out, train_val_name_list,
+                                 np.arange(train_val_name_list.shape[0]),
+                                 train_val_name_list.shape[0])
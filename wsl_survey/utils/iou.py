@@ -1,29 +1,93 @@
+import numpy as np
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+def _is_tensor(x):
+    return torch is not None and isinstance(x, torch.Tensor)
+
+
+def to_xyxy(boxes, fmt='xyxy'):
+    """(N, 4) boxes as (x1, y1, x2, y2), from xyxy or xywh (top left corner
+    and size). Numpy arrays, lists and torch tensors are accepted.
+
+    >>> to_xyxy([[1, 2, 3, 4]], 'xywh').tolist()
+    [[1.0, 2.0, 4.0, 6.0]]
+    """
+    if fmt not in ('xyxy', 'xywh'):
+        raise ValueError('unknown box format %s' % fmt)
+
+    if _is_tensor(boxes):
+        boxes = boxes.reshape(-1, 4).to(torch.float64)
+        if fmt == 'xywh':
+            boxes = torch.cat([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], 1)
+        return boxes
+
+    boxes = np.asarray(boxes, np.float64).reshape(-1, 4)
+    if fmt == 'xywh':
+        boxes = np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], 1)
+    return boxes
+
+
+def _iou(a, b):
+    # a, b: xyxy boxes broadcastable against each other
+    if _is_tensor(a):
+        wh = (torch.min(a[..., 2:], b[..., 2:]) -
+              torch.max(a[..., :2], b[..., :2])).clamp(min=0)
+        area_a = (a[..., 2:] - a[..., :2]).prod(-1).abs()
+        area_b = (b[..., 2:] - b[..., :2]).prod(-1).abs()
+        inter = wh.prod(-1)
+        union = area_a + area_b - inter
+        return torch.where(inter > 0, inter / union.clamp(min=1e-12),
+                           torch.zeros_like(inter))
+
+    wh = np.clip(np.minimum(a[..., 2:], b[..., 2:]) -
+                 np.maximum(a[..., :2], b[..., :2]),
+                 a_min=0,
+                 a_max=None)
+    area_a = np.abs(np.prod(a[..., 2:] - a[..., :2], axis=-1))
+    area_b = np.abs(np.prod(b[..., 2:] - b[..., :2], axis=-1))
+    inter = np.prod(wh, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(inter > 0, inter / (area_a + area_b - inter), 0.)
+
+
+def box_iou(boxes_a, boxes_b, fmt_a='xyxy', fmt_b='xyxy'):
+    """IoU of the N pairs boxes_a[i], boxes_b[i], each (N, 4) in its own
+    format. Boxes that do not overlap (or are nan) get 0.
+
+    >>> box_iou([[0, 0, 10, 10], [0, 0, 2, 2]],
+    ...         [[1, 1, 9, 9], [1, 1, 3, 3]]).round(4).tolist()
+    [0.64, 0.1429]
+    >>> box_iou([[0, 0, 2, 2]], [[1, 1, 3, 3]], fmt_a='xywh').tolist()
+    [0.14285714285714285]
+    """
+    return _iou(to_xyxy(boxes_a, fmt_a), to_xyxy(boxes_b, fmt_b))
+
+
+def pairwise_iou(boxes_a, boxes_b, fmt_a='xyxy', fmt_b='xyxy'):
+    """(M, N) IoU of every box of boxes_a (M, 4) against every box of
+    boxes_b (N, 4), e.g. to match predictions to ground truth boxes.
+
+    >>> iou = pairwise_iou([[0, 0, 2, 2], [4, 4, 6, 6]],
+    ...                    [[1, 1, 3, 3], [4, 4, 6, 6], [0, 0, 2, 2]])
+    >>> iou.round(3).tolist()
+    [[0.143, 0.0, 1.0], [0.0, 1.0, 0.0]]
+    """
+    a = to_xyxy(boxes_a, fmt_a)
+    b = to_xyxy(boxes_b, fmt_b)
+    return _iou(a[:, None, :], b[None, :, :])
+
+
 def bb_intersection_over_union(boxA, boxB):
-    # determine the (x, y)-coordinates of the intersection rectangle
-    boxA = [int(float(i)) for i in boxA]
-    boxA[2] = boxA[2] + boxA[0]
-    boxA[3] = boxA[3] + boxA[1]
-
-    boxB = [int(float(i)) for i in boxB]
-
-    xA = max(boxA[0], boxB[0])
-    yA = max(boxA[1], boxB[1])
-    xB = min(boxA[2], boxB[2])
-    yB = min(boxA[3], boxB[3])
-    # compute the area of intersection rectangle
-    interArea = abs(max((xB - xA, 0)) * max((yB - yA), 0))
-    if interArea == 0:
-        return 0
-    # compute the area of both the prediction and ground-truth
-    # rectangles
-    boxAArea = abs((boxA[2] - boxA[0]) * (boxA[3] - boxA[1]))
-    boxBArea = abs((boxB[2] - boxB[0]) * (boxB[3] - boxB[1]))
-    # compute the intersection over union by taking the intersection
-    # area and dividing it by the sum of prediction + ground-truth
-    # areas - the interesection area
-    iou = interArea / float(boxAArea + boxBArea - interArea)
-    # return the intersection over union value
-    return iou
+    """IoU of one xywh box (boxA) and one xyxy box (boxB) given as lists
+    of numbers or numeric strings, truncated to ints."""
+    boxA = np.trunc([float(i) for i in boxA])
+    boxB = np.trunc([float(i) for i in boxB])
+    return float(box_iou(boxA, boxB, fmt_a='xywh')[0])
 
 
 if __name__ == '__main__':